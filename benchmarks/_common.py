@@ -0,0 +1,69 @@
+# Shared helpers for the benchmark scripts.
+#
+# The benchmarks run outside of GIMP. To import the plugin's GIMP-independent
+# modules (e.g. gimp_stable_boy.codec) without executing the package's
+# __init__, which pulls in the GIMP bindings, the package is registered as a
+# bare namespace pointing at src/gimp_stable_boy.
+
+import os
+import sys
+import time
+import types
+import random
+import statistics
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+PKG_DIR = os.path.join(SRC_DIR, 'gimp_stable_boy')
+
+if 'gimp_stable_boy' not in sys.modules:
+    _pkg = types.ModuleType('gimp_stable_boy')
+    _pkg.__path__ = [PKG_DIR]
+    _pkg.__version__ = 'bench'
+    sys.modules['gimp_stable_boy'] = _pkg
+
+
+# Returns width * height * channels bytes of pixel data that compresses roughly
+# like a photo: smooth gradients with a bit of noise. With opaque=True, the
+# alpha channel (of 2 or 4 channels) is fully opaque, like a photo's layer.
+def synthetic_pixels(width, height, channels=4, seed=0, opaque=False):
+    rng = random.Random(seed)
+    stride = width * channels
+    base_row = bytes((i * 255 // max(stride - 1, 1)) & 0xff for i in range(stride))
+    noise = rng.randbytes(stride * 16)
+    rows = []
+    for y in range(height):
+        shift = (y * channels) % stride
+        row = bytearray(base_row[shift:] + base_row[:shift])
+        offset = (y % 16) * stride
+        for i in range(0, stride, 7):
+            row[i] = noise[offset + i]
+        rows.append(bytes(row))
+    pixels = b''.join(rows)
+    if opaque and channels in (2, 4):
+        pixels = bytearray(pixels)
+        pixels[channels - 1::channels] = b'\xff' * (width * height)
+        pixels = bytes(pixels)
+    return pixels
+
+
+# Runs func `repeat` times and returns the timings in milliseconds.
+def measure(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * pct / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def median(values):
+    return statistics.median(values) if values else 0.0
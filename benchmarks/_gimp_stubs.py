@@ -0,0 +1,122 @@
+# Stand-ins for the GIMP bindings, so that the command classes can be imported
+# and run outside of GIMP by bench_pipeline.py.
+#
+# `gi.repository` returns a stub for each GIMP library; stubs accept any
+# attribute access and call and return further stubs. gimp_funcs' functions that read
+# from or write to an image are replaced by install_gimp_funcs: images are
+# synthetic pixels, and results are decoded (that part is real) and counted
+# instead of being turned into layers.
+
+import sys
+import types
+import threading
+from concurrent.futures import Future
+
+from _common import synthetic_pixels
+
+
+class Stub:
+
+    def __init__(self, name='stub'):
+        self._name = name
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return Stub(self._name + '.' + name)
+
+    def __call__(self, *args, **kwargs):
+        return Stub(self._name + '()')
+
+    def __repr__(self):
+        return '<' + self._name + '>'
+
+
+# Libraries used by the plugin. Anything else (e.g. GdkPixbuf) can't be imported, like when it isn't installed.
+STUBBED_LIBRARIES = ['Gimp', 'GimpUi', 'Gegl', 'Gio', 'GLib', 'GObject', 'Gtk']
+
+
+class _Repository(types.ModuleType):
+
+    def __getattr__(self, name):
+        if name not in STUBBED_LIBRARIES:
+            raise AttributeError(name)
+        stub = Stub(name)
+        setattr(self, name, stub)
+        return stub
+
+
+# This function registers the stub `gi` package. Must be called before importing any plugin module that uses gi.
+def install_gi():
+    gi = types.ModuleType('gi')
+    gi.require_version = lambda *args: None
+    gi.repository = _Repository('gi.repository')
+    gi.__path__ = []
+    sys.modules['gi'] = gi
+    sys.modules['gi.repository'] = gi.repository
+
+
+# Procedure config with fixed property values
+class ProcedureConfig:
+
+    def __init__(self, **properties):
+        self.properties = properties
+
+    def get_property(self, name):
+        return self.properties[name]
+
+    def set_property(self, name, value):
+        self.properties[name] = value
+
+
+# Counts results instead of creating layers
+class ResultSink:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.images = 0
+        self.bytes = 0
+
+    def add(self, image_data):
+        if isinstance(image_data, Future):
+            image_data = image_data.result()
+        with self.lock:
+            self.images += 1
+            self.bytes += len(getattr(image_data, 'pixels', image_data))
+
+    def add_layers(self, layers_data):
+        for layer_item in layers_data:
+            if layer_item.children:
+                self.add_layers(layer_item.children)
+            elif layer_item.img:
+                self.add(layer_item.img)
+
+
+# This function replaces the GIMP-facing functions of gimp_funcs. The image is width x height pixels
+# (opaque ones with opaque=True) and has an inpainting mask covering all of it.
+def install_gimp_funcs(gimp_funcs, api_base_url, width, height, sink, opaque=False):
+    pixels = synthetic_pixels(width, height, 4, opaque=opaque)
+    mask = b'\x00' * (width * height)
+
+    gimp_funcs.pref_value = lambda group_name, key_name, default=None: api_base_url if key_name == 'api_base_url' else default
+    gimp_funcs.active_area = lambda img: (0, 0, width, height)
+    gimp_funcs.autofit_inpainting_area = lambda img: (0, 0, width, height)
+    gimp_funcs.extract_region = lambda img, x, y, w, h: _crop(pixels, width, 4, x, y, w, h)
+    gimp_funcs.extract_mask_region = lambda img, x, y, w, h: _crop(mask, width, 1, x, y, w, h)
+    gimp_funcs.inpainting_regions = lambda img, min_size=512: []
+    gimp_funcs.open_images = lambda images_data: [sink.add(image_data) for image_data in images_data or []]
+    gimp_funcs.create_layers = lambda img, layers_data, x, y, *args, **kwargs: sink.add_layers(layers_data or [])
+    gimp_funcs.new_layer_group = lambda img, name, parent=None, position=0: Stub('group')
+    gimp_funcs.new_tile_canvas = lambda w, h: (Stub('canvas'), Stub('group'))
+    gimp_funcs.add_tile = lambda canvas, group, image_data, *args: sink.add(image_data)
+    gimp_funcs.merge_tiles = lambda canvas, group, name=None: None
+    gimp_funcs.new_grid_canvas = lambda layout, *args: (Stub('grid'), Stub('group'))
+    gimp_funcs.update_preview_layer = lambda img, layer, decoded, *args: layer or Stub('preview')
+    gimp_funcs.remove_preview_layer = lambda img, layer: None
+
+
+def _crop(pixels, stride_pixels, channels, x, y, w, h):
+    if x == 0 and w == stride_pixels:
+        return pixels[y * w * channels:(y + h) * w * channels]
+    stride = stride_pixels * channels
+    return b''.join(pixels[row * stride + x * channels:row * stride + (x + w) * channels] for row in range(y, y + h))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# Measures how long it takes to turn a batch of base64 PNG results into raw
+# pixels, as done by gimp_funcs.decode_async before the layers are created:
+# one image after the other, and in a pool of DECODE_THREADS worker threads.
+# The previous temp-file path (decode base64, write the PNG to disk) is shown
+# for reference; inside GIMP it was followed by a gimp-file-load-layer call per
+# image in the main thread.
+#
+# Prints which PNG decoder is used (GdkPixbuf or the pure Python fallback).
+#
+# Usage: python benchmarks/bench_decode.py [--size 512] [--batch 4] [--repeat 5]
+
+import os
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from _common import synthetic_pixels, measure, median
+
+from gimp_stable_boy import codec
+
+DECODE_THREADS = min(4, os.cpu_count() or 1)
+
+
+def decode(encoded):
+    return codec.decode_png(codec.decode_base64(encoded))
+
+
+def decode_serial(batch):
+    return [decode(encoded) for encoded in batch]
+
+
+def decode_pooled(pool, batch):
+    return [future.result() for future in [pool.submit(decode, encoded) for encoded in batch]]
+
+
+def write_temp_files(batch):
+    for encoded in batch:
+        img_path = tempfile.mktemp(suffix='.png')
+        with open(img_path, 'wb') as img_file:
+            img_file.write(codec.decode_base64(encoded))
+        os.remove(img_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measures how long decoding base64 PNG results takes, serially and in a thread pool.')
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--batch', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    batch = [codec.data_url(codec.encode_png(synthetic_pixels(args.size, args.size, 3, seed=i), args.size, args.size, 3))
+             for i in range(args.batch)]
+    print(f"decoder: {'GdkPixbuf' if codec.GdkPixbuf else 'pure Python'}, {DECODE_THREADS} threads")
+    with ThreadPoolExecutor(max_workers=DECODE_THREADS) as pool:
+        serial = median(measure(lambda: decode_serial(batch), args.repeat))
+        pooled = median(measure(lambda: decode_pooled(pool, batch), args.repeat))
+    temp_files = median(measure(lambda: write_temp_files(batch), args.repeat))
+    print(f"{args.batch} x {args.size}x{args.size}: serial {serial:.1f} ms, pooled {pooled:.1f} ms, "
+          f"temp files only {temp_files:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#
+# Compares the in-memory PNG/base64 encoding path used by gimp_funcs.encode_img
+# and encode_mask with the previous temp-file round trip (write PNG to disk,
+# read it back, delete it) across a range of region sizes.
+#
+# The temp-file variant uses the same PNG encoder so that only the disk round
+# trip is measured. Inside GIMP the old path additionally paid for the
+# file-png-save PDB call, so real-world savings are larger than shown here.
+#
+# Usage: python benchmarks/bench_encode.py [--sizes 512 1024 2048] [--repeat 5]
+
+import os
+import argparse
+import tempfile
+
+from _common import synthetic_pixels, measure, median
+
+from gimp_stable_boy import codec
+
+
+def encode_in_memory(pixels, width, height, channels):
+    return codec.data_url(codec.encode_png(pixels, width, height, channels))
+
+
+def encode_via_temp_file(pixels, width, height, channels):
+    img_path = tempfile.mktemp(suffix='.png')
+    with open(img_path, 'wb') as img_file:
+        img_file.write(codec.encode_png(pixels, width, height, channels))
+    with open(img_path, 'rb') as img_file:
+        encoded = codec.data_url(img_file.read())
+    os.remove(img_path)
+    return encoded
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compares in-memory PNG/base64 encoding with the temp-file round trip.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024, 2048, 4096])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--channels', type=int, default=4, choices=[1, 3, 4])
+    args = parser.parse_args()
+
+    print(f"{'region':>11} {'in-memory ms':>13} {'temp file ms':>13} {'speedup':>8} {'payload KiB':>12}")
+    for size in args.sizes:
+        pixels = synthetic_pixels(size, size, args.channels)
+        payload = encode_in_memory(pixels, size, size, args.channels)
+        mem = median(measure(lambda: encode_in_memory(pixels, size, size, args.channels), args.repeat))
+        tmp = median(measure(lambda: encode_via_temp_file(pixels, size, size, args.channels), args.repeat))
+        print(f"{size:>5}x{size:<5} {mem:>13.1f} {tmp:>13.1f} {tmp / mem:>7.2f}x {len(payload) / 1024:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
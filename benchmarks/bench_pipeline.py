@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Runs the commands' request/response pipeline against a local fake A1111
+# server (fake_a1111.py) with the GIMP bindings stubbed out (_gimp_stubs.py).
+# Everything between reading the image and creating layers is real: request
+# building and PNG encoding, scheduling, sending, streaming the response,
+# caching, and decoding the results.
+#
+# For each scenario, the commands are run --iterations times and the script
+# reports throughput (result images per second), latency percentiles per
+# command, and the peak memory allocated by Python during one extra run.
+#
+# Usage: python benchmarks/bench_pipeline.py [--scenarios txt2img upscale] [--iterations 10]
+#            [--size 512] [--batch 4] [--latency 0.05] [--per-step 0.002] [--backends 1]
+
+import os
+import time
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+
+import _common
+import _gimp_stubs
+from _common import percentile
+
+_gimp_stubs.install_gi()
+
+from gimp_stable_boy.config import Config
+Config.CACHE_DIR = tempfile.mkdtemp(prefix='sb_bench_')  # before any module derives paths from it
+
+import gimp_stable_boy as sb
+from gimp_stable_boy import constants, config, gimp_funcs
+sb.constants, sb.config, sb.gimp = constants, config, gimp_funcs
+
+from fake_a1111 import FakeA1111
+
+COMMON = {'prompt': 'a lighthouse at dusk', 'negative_prompt': '', 'seed': '-1', 'steps': 20, 'sampler_index': 0,
+          'restore_faces': False, 'cfg_scale': 7.5, 'img_target': 0, 'live_preview': False}
+IMG2IMG = dict(COMMON, denoising_strength=50.0)
+INPAINTING = dict(IMG2IMG, autofit_inpainting=True, mask_blur=4, inpainting_fill=1, inpaint_full_res=True,
+                  inpaint_full_res_padding=0, apply_inpainting_mask=True, inpaint_regions_separately=False)
+XY_PLOT = dict(INPAINTING, mode=0, x_type=4, x_values='10-30 (+10)', y_type=5, y_values='5, 7.5', draw_legend=True,
+               no_fixed_seeds=False, grid_only=False)
+UPSCALE = {'img_target': 0, 'upscaling_resize': 2, 'upscaler_1': 1, 'upscaler_2': 0, 'extras_upscaler_2_visibility': 0.0,
+           'tiled': False, 'tile_size': 512, 'tile_overlap': 64}
+
+
+# Scenario name -> (command module, class name, procedure properties)
+def scenarios(batch):
+    return {
+        'txt2img': ('text_to_image', 'Txt2ImgCommand', dict(COMMON, num_images=batch)),
+        'txt2img-preview': ('text_to_image', 'Txt2ImgCommand', dict(COMMON, num_images=batch, live_preview=True)),
+        'txt2img-large': ('text_to_image', 'Txt2ImgCommand', dict(COMMON, num_images=batch * 16)),
+        'img2img': ('image_to_image', 'Img2ImgCommand', dict(IMG2IMG, num_images=batch)),
+        'inpainting': ('inpainting', 'InpaintingCommand', dict(INPAINTING, num_images=batch)),
+        'upscale': ('upscale', 'UpscaleCommand', UPSCALE),
+        'upscale-tiled': ('upscale', 'UpscaleCommand', dict(UPSCALE, tiled=True, tile_size=256)),
+        'xy-plot': ('scripts.xy_plot', 'XyPlotCommand', dict(XY_PLOT, num_images=batch)),
+    }
+
+
+def command_class(module_name, class_name):
+    module = __import__('gimp_stable_boy.commands.' + module_name, fromlist=[class_name])
+    return getattr(module, class_name)
+
+
+# Runs a command like StableBoyCommand.run does. The plugin's console output is discarded.
+def run_command(cmd_cls, properties):
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        command = cmd_cls(_gimp_stubs.Stub('image'), _gimp_stubs.ProcedureConfig(**properties))
+        command.start()
+        command.wait()
+    if command.status != 'DONE':
+        raise Exception(f"{cmd_cls.__name__} failed: {getattr(command, 'error_msg', command.status)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Runs the commands against a fake A1111 server and reports throughput, latency and memory.')
+    parser.add_argument('--scenarios', nargs='+', default=list(scenarios(1)))
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--size', type=int, default=512, help='width and height of the image')
+    parser.add_argument('--batch', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.05, help='fixed server delay per request, in seconds')
+    parser.add_argument('--per-step', type=float, default=0.002, help='server delay per step and image, in seconds')
+    parser.add_argument('--backends', type=int, default=1, help='number of fake WebUI instances')
+    parser.add_argument('--cache', action='store_true', help='enable the result and region caches')
+    args = parser.parse_args()
+
+    Config.CACHE_RESULTS = Config.CACHE_ENCODED_REGIONS = args.cache
+    servers = [FakeA1111(args.latency, args.per_step).start() for _ in range(args.backends)]
+    Config.API_BASE_URLS = [server.url for server in servers[1:]]
+    sink = _gimp_stubs.ResultSink()
+    _gimp_stubs.install_gimp_funcs(gimp_funcs, servers[0].url, args.size, args.size, sink)
+
+    print(f"{args.size}x{args.size}, batch {args.batch}, {args.backends} backend(s), "
+          f"server delay {args.latency * 1000:.0f} ms + {args.per_step * 1000:.1f} ms/step")
+    print(f"{'scenario':<16} {'images/s':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'peak MiB':>9}")
+    try:
+        for name in args.scenarios:
+            module_name, class_name, properties = scenarios(args.batch)[name]
+            cmd_cls = command_class(module_name, class_name)
+            run_command(cmd_cls, properties)  # warm-up: imports, connections, latency model
+
+            sink.images = 0
+            timings = []
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                command_start = time.perf_counter()
+                run_command(cmd_cls, properties)
+                timings.append((time.perf_counter() - command_start) * 1000)
+            throughput = sink.images / (time.perf_counter() - start)
+
+            tracemalloc.start()
+            run_command(cmd_cls, properties)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print(f"{name:<16} {throughput:>9.1f} {percentile(timings, 50):>9.1f} {percentile(timings, 90):>9.1f} "
+                  f"{percentile(timings, 99):>9.1f} {peak / 2 ** 20:>9.1f}")
+    finally:
+        for server in servers:
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
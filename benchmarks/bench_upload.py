@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#
+# Compares the formats init images can be sent in (Config.INPUT_FORMAT, see
+# codec.encode_image) over a slow upload link. For each format, the script
+# reports the size of the encoded image and its base64 data URL, the encoding
+# time, and the end-to-end latency of img2img and upscale commands run through
+# the real pipeline (see bench_pipeline.py) against a fake A1111 server whose
+# uplink is throttled (see fake_a1111.py).
+#
+# JPEG and WebP are encoded with GdkPixbuf; formats it can't write here are
+# skipped. The image is opaque, like a photo's layer: regions with transparency
+# are always sent as PNG.
+#
+# Usage: python benchmarks/bench_upload.py [--formats png:6 jpeg:90 webp:90] [--upload-mbit 10]
+#            [--size 1024] [--iterations 5] [--scenarios img2img upscale]
+
+import io
+import time
+import argparse
+from contextlib import redirect_stdout
+
+import _gimp_stubs
+from _common import synthetic_pixels, measure, median, percentile
+from bench_pipeline import Config, gimp_funcs, command_class, run_command, scenarios
+
+from gimp_stable_boy import codec
+from fake_a1111 import FakeA1111
+
+FORMATS = ['png:1', 'png:6', 'png:9', 'jpeg:95', 'jpeg:85', 'jpeg:75', 'webp:90', 'webp:75']
+
+
+def parse_format(text):
+    name, _, setting = text.partition(':')
+    if name not in codec.MIME_TYPES:
+        raise argparse.ArgumentTypeError(f"unknown format '{name}', expected one of {', '.join(codec.MIME_TYPES)}")
+    return name, int(setting or (6 if name == 'png' else 90))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compares init image formats over a throttled upload link.')
+    parser.add_argument('--formats', type=parse_format, nargs='+', default=[parse_format(f) for f in FORMATS],
+                        help='formats as name:setting, e.g. png:6 or jpeg:90')
+    parser.add_argument('--upload-mbit', type=float, default=10, help='upload bandwidth in Mbit/s')
+    parser.add_argument('--size', type=int, default=1024, help='width and height of the image')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--scenarios', nargs='+', default=['img2img', 'upscale'], choices=['img2img', 'upscale', 'upscale-tiled'])
+    parser.add_argument('--latency', type=float, default=0.05, help='fixed server delay per request, in seconds')
+    parser.add_argument('--per-step', type=float, default=0.002, help='server delay per step and image, in seconds')
+    args = parser.parse_args()
+
+    Config.CACHE_RESULTS = Config.CACHE_ENCODED_REGIONS = False
+    server = FakeA1111(args.latency, args.per_step, upload_bandwidth=args.upload_mbit * 125000).start()
+    sink = _gimp_stubs.ResultSink()
+    _gimp_stubs.install_gimp_funcs(gimp_funcs, server.url, args.size, args.size, sink, opaque=True)
+    pixels = synthetic_pixels(args.size, args.size, 4, opaque=True)
+
+    print(f"{args.size}x{args.size}, upload {args.upload_mbit:g} Mbit/s, server delay {args.latency * 1000:.0f} ms "
+          f"+ {args.per_step * 1000:.1f} ms/step, {args.iterations} iterations")
+    header = f"{'format':<10} {'KiB':>8} {'sent KiB':>9} {'encode ms':>10}"
+    for name in args.scenarios:
+        header += f" {name + ' p50':>17} {'p90':>7}"
+    print(header)
+    try:
+        for image_format in args.formats:
+            label = f"{image_format[0]}:{image_format[1]}"
+            with redirect_stdout(io.StringIO()):
+                available = codec.can_encode(image_format[0])
+            if not available:
+                print(f"{label:<10} (skipped: GdkPixbuf can't write {image_format[0]} images here)")
+                continue
+            encoded = codec.encode_image(pixels, args.size, args.size, 4, image_format)
+            encode_ms = median(measure(lambda: codec.encode_image(pixels, args.size, args.size, 4, image_format),
+                                       args.iterations))
+            row = f"{label:<10} {len(encoded.data) / 1024:>8.1f} {len(encoded) / 1024:>9.1f} {encode_ms:>10.1f}"
+
+            Config.INPUT_FORMAT = image_format
+            for name in args.scenarios:
+                module_name, class_name, properties = scenarios(1)[name]
+                cmd_cls = command_class(module_name, class_name)
+                run_command(cmd_cls, properties)  # warm-up: imports, connections, latency model
+                timings = []
+                for _ in range(args.iterations):
+                    start = time.perf_counter()
+                    run_command(cmd_cls, properties)
+                    timings.append((time.perf_counter() - start) * 1000)
+                row += f" {percentile(timings, 50):>17.1f} {percentile(timings, 90):>7.1f}"
+            print(row)
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
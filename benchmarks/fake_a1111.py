@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+#
+# A stand-in for AUTOMATIC1111's WebUI API, for benchmarking the plugin without
+# a GPU. It answers txt2img, img2img (including scripts), extra-single-image
+# and progress requests with synthetic images, after a configurable delay, and
+# lists the plugin's samplers, upscalers and scripts plus two models. Its settings
+# (/sdapi/v1/options) can be changed with a POST, like WebUI's:
+#
+#   latency + per_step * steps * batch size   (txt2img, img2img)
+#   latency + per_megapixel * output MP       (extra-single-image)
+#
+# A request overriding sd_model_checkpoint loads that model first, and the
+# previous one again afterwards unless override_settings_restore_afterwards is
+# false; each load takes load_time and is counted in model_loads.
+#
+# Requests are handled one at a time, like WebUI does; progress reports on the
+# request that is currently running, with a live preview at 1/8 of the size
+# unless skip_current_image is set. Interrupting (/sdapi/v1/interrupt) ends the
+# running request early; it returns the images that were started, like WebUI.
+# Requests with a force_task_id can be looked up with /internal/progress, which
+# tells whether they're queued, running (active) or completed.
+#
+# With an upload bandwidth, request bodies take as long to arrive as they would
+# over a link of that speed, shared by all connections (a slow uplink to a
+# remote GPU). Responses aren't slowed down.
+#
+# Usage as a standalone server:
+#   python benchmarks/fake_a1111.py [--port 7860] [--latency 0.05] [--per-step 0.002] [--size 512]
+#                                   [--upload-mbit 10]
+
+import re
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from _common import synthetic_pixels
+
+from gimp_stable_boy import codec, constants
+
+# Answers of the endpoints listing what the server has
+LISTS = {
+    '/sdapi/v1/samplers': [{'name': name, 'aliases': [], 'options': {}} for name in constants.SAMPLERS],
+    '/sdapi/v1/upscalers': [{'name': name, 'model_name': None, 'model_path': None, 'model_url': None, 'scale': 4}
+                            for name in constants.UPSCALERS],
+    '/sdapi/v1/sd-models': [{'title': name + '.safetensors [' + digest + ']', 'model_name': name, 'hash': digest,
+                             'sha256': None, 'filename': name + '.safetensors', 'config': None}
+                            for name, digest in (('fake', '0000000000'), ('Fake-XL', '1111111111'))],
+    '/sdapi/v1/scripts': {'txt2img': ['prompt matrix', 'prompts from file or textbox', 'x/y plot', 'x/y/z plot'],
+                          'img2img': ['img2img alternative test', 'loopback', 'outpainting mk2',
+                                      'poor man\'s outpainting', 'prompt matrix', 'prompts from file or textbox',
+                                      'sd upscale', 'x/y plot', 'x/y/z plot']},
+}
+
+
+# Settings reported by /sdapi/v1/options
+OPTIONS = {'sd_model_checkpoint': 'fake.safetensors [0000000000]', 'sd_vae': 'Automatic'}
+
+
+class FakeA1111:
+
+    def __init__(self, latency=0.05, per_step=0.002, per_megapixel=0.05, image_size=None, port=0,
+                 upload_bandwidth=None, load_time=0.0):
+        self.latency = latency
+        self.per_step = per_step
+        self.per_megapixel = per_megapixel
+        self.image_size = image_size  # (width, height) of generated images, default: as requested
+        self.upload_bandwidth = upload_bandwidth  # bytes per second, default: unlimited
+        self.bytes_received = 0
+        self._link_lock = threading.Lock()
+        self._link_free_at = 0.0  # when the simulated link is done with the uploads so far
+        self.requests = 0
+        self.load_time = load_time
+        self.model_loads = 0
+        self.options = dict(OPTIONS)
+        self._images = {}  # (width, height) -> data URL
+        self._images_lock = threading.Lock()
+        self._gpu = threading.Lock()  # one job at a time
+        self._job = None  # (started, duration, job_count, steps, (width, height) or None)
+        self._interrupted = threading.Event()
+        self.interrupts = 0
+        self._pending_tasks = set()  # force_task_id of requests waiting for the GPU
+        self._current_task = None
+        self._finished_tasks = set()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                endpoint = self.path.split('?')[0].rstrip('/')
+                if endpoint == '/sdapi/v1/progress':
+                    self._reply(fake.progress(include_image='skip_current_image=false' in self.path))
+                elif endpoint == '/sdapi/v1/options':
+                    self._reply(fake.options)
+                elif endpoint in LISTS:
+                    self._reply(LISTS[endpoint])
+                else:
+                    self._reply({'detail': 'Not Found'}, 404)
+
+            def do_POST(self):
+                started = time.monotonic()
+                body = self._read_body()
+                fake.upload(len(body), started)
+                endpoint = self.path.split('?')[0].rstrip('/')
+                if endpoint == '/sdapi/v1/interrupt':
+                    self._reply(fake.interrupt())
+                    return
+                if endpoint == '/internal/progress':
+                    self._reply(fake.task_progress(json.loads(body).get('id_task')))
+                    return
+                if endpoint == '/sdapi/v1/options':
+                    fake.options.update(json.loads(body))
+                    self._reply(None)
+                    return
+                handler = {'/sdapi/v1/txt2img': fake.generate, '/sdapi/v1/img2img': fake.generate,
+                           '/sdapi/v1/extra-single-image': fake.upscale}.get(endpoint)
+                if not handler:
+                    self._reply({'detail': 'Not Found'}, 404)
+                    return
+                fake.requests += 1
+                self._reply(handler(json.loads(body)))
+
+            # Reads the request body, sent with Content-Length or with chunked transfer encoding like the plugin does
+            def _read_body(self):
+                if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+                    return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().split(b';')[0], 16)
+                    if not size:
+                        while self.rfile.readline() not in (b'\r\n', b'\n', b''):  # trailers
+                            pass
+                        return b''.join(chunks)
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline()
+
+            def _reply(self, data, status=200):
+                payload = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                try:
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client went away, e.g. after cancelling
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Delays a request whose body of `size` bytes started to arrive at `started` (time.monotonic()) until it
+    # would have been uploaded at upload_bandwidth. Uploads queue up on the link.
+    def upload(self, size, started):
+        with self._link_lock:
+            self.bytes_received += size
+            if not self.upload_bandwidth:
+                return
+            self._link_free_at = max(started, self._link_free_at) + size / self.upload_bandwidth
+            done_at = self._link_free_at
+        time.sleep(max(0.0, done_at - time.monotonic()))
+
+    # Returns a synthetic PNG of the given size. Images are generated once per size, so that the
+    # server's own encoding time doesn't end up in the measurements.
+    def image(self, width, height):
+        with self._images_lock:
+            if (width, height) not in self._images:
+                pixels = synthetic_pixels(width, height, 3, seed=width * 31 + height)
+                self._images[width, height] = codec.data_url(codec.encode_png(pixels, width, height, 3))
+            return self._images[width, height]
+
+    # Returns the number of images of the job that were started, all of them unless it's interrupted
+    def _run_job(self, duration, job_count=1, steps=0, size=None, req=None):
+        task_id = (req or {}).get('force_task_id')
+        if task_id:
+            self._pending_tasks.add(task_id)
+        with self._gpu:
+            self._pending_tasks.discard(task_id)
+            self._current_task = task_id
+            override_settings = (req or {}).get('override_settings') or {}
+            previous = self.options['sd_model_checkpoint']
+            if override_settings.get('sd_model_checkpoint', previous) != previous:
+                self._load_model(override_settings['sd_model_checkpoint'])
+                if (req or {}).get('override_settings_restore_afterwards', True):
+                    duration += self.load_time
+                    self.model_loads += 1  # loading the previous one again
+                    req = dict(req, restore_checkpoint=previous)
+            self._interrupted.clear()
+            started = time.monotonic()
+            self._job = (started, duration, job_count, steps, size)
+            try:
+                if self._interrupted.wait(duration):
+                    return min(job_count, int((time.monotonic() - started) / max(duration, 1e-6) * job_count) + 1)
+                return job_count
+            finally:
+                self._job = None
+                self._current_task = None
+                if task_id:
+                    self._finished_tasks.add(task_id)
+                if (req or {}).get('restore_checkpoint'):
+                    self.options['sd_model_checkpoint'] = req['restore_checkpoint']
+
+    def _load_model(self, name):
+        time.sleep(self.load_time)
+        self.model_loads += 1
+        self.options['sd_model_checkpoint'] = name
+
+    # Interrupts the running job, if any
+    def interrupt(self):
+        if self._job:
+            self.interrupts += 1
+            self._interrupted.set()
+        return {}
+
+    def generate(self, req):
+        steps = int(req.get('steps', 20))
+        batch_size = int(req.get('batch_size', 1))
+        width, height = self.image_size or (int(req.get('width', 512)), int(req.get('height', 512)))
+        count = batch_size
+        if req.get('script_name'):
+            # X/Y plot: one image per cell plus the grid in front
+            args = req.get('script_args') or []
+            cells = [len(re.split(r'\s*,\s*', str(args[i]))) if len(args) > i and args[i] else 1 for i in (1, 3)]
+            count = cells[0] * cells[1] * batch_size + 1
+        count = self._run_job(self.latency + self.per_step * steps * count, count, steps, (width, height), req)
+        image = self.image(width, height)
+        return {'images': [image] * count, 'parameters': {key: value for key, value in req.items()
+                                                         if key not in ('init_images', 'mask')},
+                'info': json.dumps({'seed': req.get('seed', -1)})}
+
+    def upscale(self, req):
+        width, height = codec.image_size(req.get('image') or '') or (512, 512)
+        resize = int(req.get('upscaling_resize', 2))
+        width, height = width * resize, height * resize
+        self._run_job(self.latency + self.per_megapixel * width * height / 1e6, req=req)
+        return {'html_info': '', 'image': self.image(width, height)}
+
+    # Answers /internal/progress for a task id, like WebUI: whether the request is queued, running or done
+    def task_progress(self, task_id):
+        active = bool(task_id) and task_id == self._current_task
+        progress = self.progress() if active else {}
+        return {'active': active, 'queued': task_id in self._pending_tasks, 'completed': task_id in self._finished_tasks,
+                'progress': progress.get('progress'), 'eta': progress.get('eta_relative'), 'live_preview': None,
+                'id_live_preview': -1, 'textinfo': None if active else 'Waiting...'}
+
+    def progress(self, include_image=False):
+        job = self._job
+        if not job:
+            return {'progress': 0.0, 'eta_relative': 0.0, 'state': {'job_count': 0, 'job_no': 0},
+                    'current_image': None}
+        started, duration, job_count, steps, size = job
+        fraction = min(1.0, (time.monotonic() - started) / max(duration, 1e-6))
+        job_no = min(job_count - 1, int(fraction * job_count))
+        step = int((fraction * job_count - job_no) * steps)
+        return {'progress': fraction, 'eta_relative': max(0.0, duration * (1 - fraction)),
+                'state': {'job_count': job_count, 'job_no': job_no, 'sampling_step': step, 'sampling_steps': steps},
+                'current_image': self.image(max(8, size[0] // 8), max(8, size[1] // 8)).split(',', 1)[1]
+                if include_image and size else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="A stand-in for AUTOMATIC1111's WebUI API, for benchmarking without a GPU.")
+    parser.add_argument('--port', type=int, default=7860)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--per-step', type=float, default=0.002)
+    parser.add_argument('--size', type=int, help='width and height of generated images (default: as requested)')
+    parser.add_argument('--upload-mbit', type=float, help='upload bandwidth in Mbit/s (default: unlimited)')
+    args = parser.parse_args()
+    fake = FakeA1111(args.latency, args.per_step, image_size=(args.size, args.size) if args.size else None, port=args.port,
+                     upload_bandwidth=args.upload_mbit * 125000 if args.upload_mbit else None)
+    print('Serving on ' + fake.url)
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
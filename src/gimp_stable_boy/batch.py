@@ -0,0 +1,144 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Batch jobs for the batch command (commands/batch.py). A manifest lists one
+# job per line as a JSON object:
+#
+#   {"command": "img2img", "input": "in/cat.png", "prompt": "a tiger", "denoising_strength": 60}
+#   {"command": "inpainting", "input": "in/room.png", "mask": "in/room-mask.png", "prompt": "a sofa"}
+#   {"command": "txt2img", "prompt": "a lighthouse", "width": 768, "height": 512, "num_images": 50}
+#   {"command": "upscale", "input": "in/cat.png", "upscaler_1": "ESRGAN_4x"}
+#
+# Everything but "id", "command", "input", "mask", "width" and "height" is a
+# setting of the command's procedure, by argument name. Settings chosen from a
+# list (sampler, upscaler, ...) can be given by name. Relative paths are
+# relative to the manifest.
+#
+# Finished jobs are recorded in progress.jsonl in the output folder, so a batch
+# that was stopped picks up where it left off when it's run again. Jobs that
+# failed are tried again.
+
+import os
+import json
+import time
+from collections import namedtuple
+
+from gimp_stable_boy import constants
+
+Job = namedtuple('Job', 'id proc_name input mask width height settings')
+
+# Command in the manifest -> procedure
+COMMANDS = {
+    'txt2img': 'stable-boy-txt2img',
+    'img2img': 'stable-boy-img2img',
+    'inpainting': 'stable-boy-inpaint',
+    'upscale': 'stable-boy-upscale',
+}
+
+# Settings chosen from a list, which may be given by name
+CHOICES = {
+    'sampler_index': constants.SAMPLERS,
+    'inpainting_fill': constants.INPAINTING_FILL_MODE,
+    'upscaler_1': constants.UPSCALERS,
+    'upscaler_2': constants.UPSCALERS,
+}
+
+PROGRESS_FILE = 'progress.jsonl'
+
+
+# This function turns a job from the manifest into a Job. number is its line in the manifest.
+def parse_job(entry, number, base_dir):
+    entry = dict(entry)
+    command = entry.pop('command', 'txt2img')
+    if command not in COMMANDS:
+        raise Exception(f"Unknown command '{command}', expected one of {', '.join(COMMANDS)}")
+    input_path, mask_path = entry.pop('input', None), entry.pop('mask', None)
+    if command != 'txt2img' and not input_path:
+        raise Exception(f"{command} needs an input image")
+    if command == 'inpainting' and not mask_path:
+        raise Exception("inpainting needs a mask")
+    job_id = str(entry.pop('id', '') or '')
+    if not job_id:
+        name = os.path.splitext(os.path.basename(input_path))[0] if input_path else command
+        job_id = f"{number:05d}-{name}"
+    width, height = int(entry.pop('width', 512)), int(entry.pop('height', 512))
+    settings = {}
+    for key, value in entry.items():
+        choices = CHOICES.get(key)
+        if choices and isinstance(value, str):
+            names = {choice.lower(): index for index, choice in enumerate(choices)}
+            if value.lower() not in names:
+                raise Exception(f"Unknown {key} '{value}'")
+            value = names[value.lower()]
+        settings[key] = value
+    return Job(job_id, COMMANDS[command], _path(input_path, base_dir), _path(mask_path, base_dir),
+               width, height, settings)
+
+
+def _path(path, base_dir):
+    if not path:
+        return None
+    return os.path.join(base_dir, os.path.expanduser(path))
+
+
+# This function reads a manifest: a JSON lines file, or a JSON file with a list of jobs. Returns the
+# jobs and the errors of entries that couldn't be read, as (number, message) pairs.
+def read_manifest(path):
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, 'r', encoding='utf-8') as manifest_file:
+        text = manifest_file.read()
+    if text.lstrip().startswith('['):
+        entries = list(enumerate(json.loads(text), 1))
+    else:
+        entries = []
+        for number, line in enumerate(text.splitlines(), 1):
+            if line.strip() and not line.lstrip().startswith('#'):
+                entries.append((number, line))
+    jobs, errors = [], []
+    for number, entry in entries:
+        try:
+            jobs.append(parse_job(json.loads(entry) if isinstance(entry, str) else entry, number, base_dir))
+        except Exception as e:
+            errors.append((number, str(e)))
+    return jobs, errors
+
+
+# The record of finished jobs in an output folder
+class BatchProgress:
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, PROGRESS_FILE)
+        self.done = set()  # ids of jobs that were done
+        try:
+            with open(self.path, 'r', encoding='utf-8') as progress_file:
+                for line in progress_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # cut short when the batch was stopped
+                    if record.get('status') == 'done':
+                        self.done.add(record['id'])
+                    else:
+                        self.done.discard(record['id'])
+        except OSError:
+            pass
+
+    # Appends a job's outcome, e.g. record('00001-cat', 'done', images=4).
+    def record(self, job_id, status, **info):
+        if status == 'done':
+            self.done.add(job_id)
+        with open(self.path, 'a', encoding='utf-8') as progress_file:
+            progress_file.write(json.dumps(dict(id=job_id, status=status, time=time.time(), **info)) + '\n')
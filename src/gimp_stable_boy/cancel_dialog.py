@@ -0,0 +1,93 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A small window with the command's progress and a Cancel button, shown while
+# an interactive command runs. Cancelling GIMP's own progress in the status bar
+# ends the plug-in's process, so the backend would go on generating images
+# nobody gets to see; this dialog cancels the command properly instead (see
+# StableDiffusionCommand.cancel).
+#
+# The plug-in has no GTK main loop of its own: between its other work, the
+# command's wait() sleeps in sleep(), which handles UI events as they come in,
+# and is woken up by wake_up() when there's work for the main thread again.
+
+import gi
+gi.require_version('GimpUi', '3.0')
+gi.require_version('Gtk', '3.0')
+from gi.repository import GimpUi, Gtk, GLib
+
+
+class CancelDialog:
+
+    def __init__(self, title, on_cancel):
+        self.on_cancel = on_cancel
+        self.cancelled = False
+        self._dialog = GimpUi.Dialog(title=title, role='stable-boy-progress')
+        self._dialog.add_button('_Cancel', Gtk.ResponseType.CANCEL)
+        self._dialog.connect('response', self._on_response)
+        content = self._dialog.get_content_area()
+        content.set_border_width(12)
+        content.set_spacing(6)
+        self._label = Gtk.Label(label=title, xalign=0.0)
+        self._bar = Gtk.ProgressBar()
+        content.pack_start(self._label, False, False, 0)
+        content.pack_start(self._bar, False, False, 0)
+        self._dialog.set_default_size(360, -1)
+        self._dialog.show_all()
+        self.process_events()
+
+    # Cancel button, Escape and closing the window all end up here
+    def _on_response(self, dialog, response_id):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        self._label.set_text("Cancelling...")
+        dialog.set_response_sensitive(Gtk.ResponseType.CANCEL, False)
+        self.on_cancel()
+
+    def update(self, fraction, text):
+        self._bar.set_fraction(fraction)
+        if text and not self.cancelled:
+            self._label.set_text(text)
+
+    def process_events(self):
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+
+    # Handles UI events until wake_up() is called or timeout seconds (None: no limit) have passed. In
+    # between, the thread sleeps in GLib's main loop, which only wakes up when there's something to do.
+    def sleep(self, timeout=None):
+        context = GLib.MainContext.default()
+        timer = None
+        if timeout is not None:
+            timer = GLib.timeout_source_new(max(1, int(timeout * 1000)))
+            timer.set_callback(lambda *args: False)
+            timer.attach(context)
+        try:
+            context.iteration(True)
+            self.process_events()
+        finally:
+            if timer is not None:
+                timer.destroy()
+
+    # Ends sleep(), or the next one if there's none going on. Can be called from any thread.
+    @staticmethod
+    def wake_up():
+        GLib.MainContext.default().wakeup()
+
+    def destroy(self):
+        self._dialog.destroy()
+        self.process_events()
@@ -0,0 +1,261 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# What each backend has to offer: samplers, upscalers, models and scripts, as
+# reported by the WebUI API. Requests are checked against this before they're
+# sent, so that a sampler or upscaler a backend doesn't have fails right away
+# (or the request goes to a backend that has it) instead of after a round trip.
+#
+# Lookups never wait for the network. Capabilities are kept in memory and in
+# CACHE_DIR/capabilities.json; missing or expired entries (Config.CAPABILITIES_TTL)
+# are fetched in a background thread, and until they arrive nothing is checked.
+#
+# The backends' settings (loaded checkpoint, VAE, ...) change far more often, so
+# they're kept apart (ServerOptions): only in memory, for a few seconds, and
+# fetched when they're needed.
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from urllib.parse import urljoin
+
+from gimp_stable_boy import http_pool
+from gimp_stable_boy.config import Config as config
+
+CAPABILITIES_VERSION = 2
+CAPABILITIES_PATH = os.path.join(config.CACHE_DIR, 'capabilities.json')
+FETCH_TIMEOUT = 5  # seconds per endpoint
+
+ENDPOINTS = {
+    'samplers': 'sdapi/v1/samplers',
+    'upscalers': 'sdapi/v1/upscalers',
+    'models': 'sdapi/v1/sd-models',
+    'scripts': 'sdapi/v1/scripts',
+}
+
+
+OPTIONS_URI = 'sdapi/v1/options'
+
+
+# Raised for requests that a backend can't handle
+class UnsupportedRequest(Exception):
+    pass
+
+
+# These functions turn an endpoint's response into the names that requests may use (lower case, except
+# for models: WebUI only finds a checkpoint by its exact name).
+def _sampler_names(samplers):
+    return sorted({name.lower() for sampler in samplers for name in [sampler['name']] + (sampler.get('aliases') or [])})
+
+
+def _upscaler_names(upscalers):
+    return sorted({upscaler['name'].lower() for upscaler in upscalers})
+
+
+def _model_names(models):
+    return sorted({name for model in models for name in (model.get('title'), model.get('model_name')) if name})
+
+
+def _script_names(scripts):
+    return {mode: sorted(name.lower() for name in names or []) for mode, names in scripts.items()}
+
+
+_PARSERS = {'samplers': _sampler_names, 'upscalers': _upscaler_names, 'models': _model_names,
+            'scripts': _script_names}
+
+
+class CapabilityCache:
+
+    def __init__(self, path=None, ttl=None):
+        self.path = path
+        self.ttl = config.CAPABILITIES_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._entries = None  # backend URL -> {'fetched_at': ..., 'samplers': [...], ...}
+        self._fetching = set()
+
+    def _load(self):
+        if self._entries is not None:
+            return self._entries
+        self._entries = {}
+        if self.path:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as capabilities_file:
+                    capabilities = json.load(capabilities_file)
+                if capabilities.get('version') == CAPABILITIES_VERSION:
+                    self._entries = capabilities.get('backends', {})
+            except (OSError, ValueError):
+                pass
+        return self._entries
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            directory = os.path.dirname(self.path)
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+            with os.fdopen(fd, 'w', encoding='utf-8') as capabilities_file:
+                json.dump({'version': CAPABILITIES_VERSION, 'backends': self._entries}, capabilities_file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Couldn't save backend capabilities: {e}")
+
+    # Returns what's known about a backend (possibly expired), or None. Never waits for the network:
+    # if the entry is missing or expired, it's fetched in the background.
+    def get(self, backend_url):
+        with self._lock:
+            entry = self._load().get(backend_url)
+            if entry is None or time.time() - entry['fetched_at'] > self.ttl:
+                self._fetch_in_background(backend_url)
+        return entry
+
+    # Fetches missing or expired entries in the background, e.g. when a command starts.
+    def prefetch(self, backend_urls):
+        for backend_url in backend_urls:
+            self.get(backend_url)
+
+    # Marks a backend's entry as expired, so that the next lookup fetches it again.
+    def expire(self, backend_url):
+        with self._lock:
+            entry = self._load().get(backend_url)
+            if entry:
+                entry['fetched_at'] = 0
+
+    # Must be called with the lock held.
+    def _fetch_in_background(self, backend_url):
+        if backend_url in self._fetching:
+            return
+        self._fetching.add(backend_url)
+        threading.Thread(target=self._fetch, args=(backend_url,), name='capabilities', daemon=True).start()
+
+    def _fetch(self, backend_url):
+        try:
+            entry = {'fetched_at': time.time()}
+            for kind, uri in ENDPOINTS.items():
+                try:
+                    with http_pool.pool.request('GET', urljoin(backend_url, uri), timeout=FETCH_TIMEOUT) as resp:
+                        entry[kind] = _PARSERS[kind](json.loads(resp.read()))
+                except OSError:
+                    raise
+                except Exception as e:
+                    # Endpoint missing (older WebUI versions) or unexpected response: not checked
+                    print(f"Couldn't get {kind} of {backend_url}: {e}")
+                    entry[kind] = None
+            with self._lock:
+                self._load()[backend_url] = entry
+                self._save()
+        except OSError as e:
+            print(f"Couldn't get capabilities of {backend_url}: {e}")
+        finally:
+            with self._lock:
+                self._fetching.discard(backend_url)
+
+    # Raises UnsupportedRequest if a request asks for a sampler, upscaler, model or script that the
+    # backend doesn't have, as far as is known. If the known capabilities are out of date, the
+    # request is let through and the capabilities are fetched again.
+    def validate(self, backend_url, endpoint, req_data):
+        entry = self.get(backend_url)
+        if entry is None:
+            return
+        override_settings = req_data.get('override_settings') or {}
+        checks = [
+            ('samplers', 'Sampler', req_data.get('sampler_index') or req_data.get('sampler_name')),
+            ('upscalers', 'Upscaler', req_data.get('upscaler_1')),
+            ('upscalers', 'Upscaler', req_data.get('upscaler_2')),
+            ('models', 'Model', override_settings.get('sd_model_checkpoint')),
+        ]
+        scripts = entry.get('scripts')
+        if scripts and req_data.get('script_name'):
+            mode = 'img2img' if 'img2img' in endpoint else 'txt2img'
+            checks.append(('scripts', 'Script', req_data['script_name']))
+            entry = dict(entry, scripts=scripts.get(mode))
+        for kind, label, value in checks:
+            available = entry.get(kind)
+            if value and available is not None and str(value).lower() not in {name.lower() for name in available}:
+                if time.time() - entry['fetched_at'] > self.ttl:
+                    return
+                self.expire(backend_url)  # maybe it was added since, check again next time
+                raise UnsupportedRequest(f"{label} '{value}' isn't available on {backend_url}")
+
+    # Returns the names of the models (checkpoints) that any of the backends has, or None if that isn't known.
+    # Unlike the lookups above, this waits for the capabilities of backends that haven't been fetched yet.
+    def models(self, backend_urls):
+        names = None
+        for backend_url in backend_urls:
+            with self._lock:
+                entry = self._load().get(backend_url)
+            if entry is None:
+                self._fetch(backend_url)
+                with self._lock:
+                    entry = self._load().get(backend_url)
+            if entry and entry.get('models') is not None:
+                names = (names or set()) | set(entry['models'])
+        return sorted(names) if names is not None else None
+
+    # Forgets all capabilities.
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            if self.path:
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+
+
+# The current settings of each backend, as digests: the same digest means the same checkpoint, VAE and
+# other settings, and thus the same images for the same request. Used for result cache keys.
+# Unlike capabilities, these are waited for, as an outdated digest could replay another model's images.
+class ServerOptions:
+
+    def __init__(self, ttl=None):
+        self.ttl = config.SERVER_OPTIONS_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._digests = {}  # backend URL -> (digest or None, fetched at)
+
+    # Returns {backend URL: digest} for the given backends, fetching the ones that have expired
+    # concurrently. Backends whose settings couldn't be fetched have None.
+    def digests(self, backend_urls):
+        now = time.monotonic()
+        with self._lock:
+            missing = [url for url in backend_urls
+                       if url not in self._digests or now - self._digests[url][1] > self.ttl]
+        threads = [threading.Thread(target=self._fetch, args=(url,), name='options', daemon=True) for url in missing]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(FETCH_TIMEOUT + 1)
+        with self._lock:
+            return {url: self._digests.get(url, (None, 0))[0] for url in backend_urls}
+
+    def _fetch(self, backend_url):
+        try:
+            with http_pool.pool.request('GET', urljoin(backend_url, OPTIONS_URI), timeout=FETCH_TIMEOUT) as resp:
+                options = json.loads(resp.read())
+            digest = hashlib.sha256(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()
+        except Exception as e:
+            print(f"Couldn't get the settings of {backend_url}: {e}")
+            digest = None
+        with self._lock:
+            self._digests[backend_url] = (digest, time.monotonic())
+
+
+# The caches shared by all commands
+cache = CapabilityCache(CAPABILITIES_PATH)
+options = ServerOptions()
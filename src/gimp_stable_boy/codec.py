@@ -0,0 +1,423 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# In-memory image encoding and decoding. Nothing in here depends on GIMP, so this
+# module can be used (and benchmarked) outside of the plugin process. PNGs are
+# decoded with GdkPixbuf if it's available, otherwise in pure Python. JPEG and
+# WebP encoding needs GdkPixbuf (and, for WebP, its WebP loader).
+
+import sys
+import base64
+import hashlib
+import struct
+import zlib
+from array import array
+from collections import namedtuple
+from concurrent.futures import Future
+
+try:
+    import gi
+    gi.require_version('GdkPixbuf', '2.0')
+    from gi.repository import GdkPixbuf, GLib
+except (ImportError, ValueError):
+    GdkPixbuf = None
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Number of channels -> PNG color type (gray, gray + alpha, RGB, RGBA)
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+# Formats images can be encoded in (see encode_image) -> mime type
+MIME_TYPES = {'png': 'image/png', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+# Decoded 8-bit pixels (row-major, no padding). channels is 3 (RGB) or 4 (RGBA).
+DecodedImage = namedtuple('DecodedImage', 'pixels width height channels')
+
+# PNG color type -> number of channels of the stored pixels
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# Bytes of image data base64-encoded at a time by EncodedImage.iter_base64 (a multiple of 3, so chunks
+# can be concatenated)
+BASE64_CHUNK_SIZE = 48 * 1024
+
+# Rows handed to zlib per call. Large enough to keep call overhead low, small
+# enough to avoid a second full-size copy of the pixel data.
+_ROWS_PER_CHUNK = 64
+
+
+# Formats GdkPixbuf can write, found on first use
+_writable_formats = None
+_warned_formats = set()
+
+# Lookup table for compositing 16-bit gray + alpha pixels over white, indexed by
+# the native-endian value of each pixel. Built on first use.
+_over_white_table = None
+
+
+def _png_chunk(tag, data):
+    crc = zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', crc)
+
+
+# This function encodes raw 8-bit pixels (row-major, no padding) to PNG bytes without touching the disk.
+def encode_png(pixels, width, height, channels=4, compress_level=6):
+    if channels not in PNG_COLOR_TYPES:
+        raise ValueError('Unsupported number of channels: ' + str(channels))
+    stride = width * channels
+    if len(pixels) != stride * height:
+        raise ValueError('Expected ' + str(stride * height) + ' bytes of pixel data, got ' + str(len(pixels)))
+
+    view = memoryview(pixels)
+    compressor = zlib.compressobj(compress_level)
+    idat = []
+    for first_row in range(0, height, _ROWS_PER_CHUNK):
+        rows = bytearray()
+        for row in range(first_row, min(first_row + _ROWS_PER_CHUNK, height)):
+            rows.append(0)  # filter type: None
+            rows += view[row * stride:(row + 1) * stride]
+        idat.append(compressor.compress(rows))
+    idat.append(compressor.flush())
+
+    header = struct.pack('>IIBBBBB', width, height, 8, PNG_COLOR_TYPES[channels], 0, 0, 0)
+    return b''.join([PNG_SIGNATURE,
+                     _png_chunk(b'IHDR', header),
+                     _png_chunk(b'IDAT', b''.join(idat)),
+                     _png_chunk(b'IEND', b'')])
+
+
+# This function encodes raw 8-bit pixels in a format given as (name, setting): ('png', compression level 0-9),
+# ('jpeg', quality 0-100) or ('webp', quality 0-100). Returns an EncodedImage. JPEG and WebP have no alpha
+# channel here, so pixels that aren't fully opaque are encoded as PNG instead, as are all pixels if
+# GdkPixbuf can't write the format.
+def encode_image(pixels, width, height, channels=4, image_format=('png', 6)):
+    name, setting = image_format
+    if name not in MIME_TYPES:
+        raise ValueError('Unsupported image format: ' + str(name))
+    if name == 'png':
+        return EncodedImage(encode_png(pixels, width, height, channels, int(setting)))
+    if channels in (3, 4) and can_encode(name) and _is_opaque(pixels, channels):
+        return EncodedImage(_encode_pixbuf(pixels, width, height, channels, name, int(setting)), MIME_TYPES[name])
+    return EncodedImage(encode_png(pixels, width, height, channels))
+
+
+# This function tells whether encode_image can write the format, rather than falling back to PNG.
+def can_encode(name):
+    global _writable_formats
+    if name == 'png':
+        return True
+    if GdkPixbuf is None:
+        writable = False
+    else:
+        if _writable_formats is None:
+            _writable_formats = {fmt.get_name() for fmt in GdkPixbuf.Pixbuf.get_formats() if fmt.is_writable()}
+        writable = name in _writable_formats
+    if not writable and name not in _warned_formats:
+        _warned_formats.add(name)
+        print(f"Can't encode {name} images (GdkPixbuf or its {name} loader is missing), using PNG instead.")
+    return writable
+
+
+def _is_opaque(pixels, channels):
+    if channels == 3:
+        return True
+    return not bytes(pixels[channels - 1::channels]).strip(b'\xff')
+
+
+def _encode_pixbuf(pixels, width, height, channels, name, quality):
+    if channels == 4:
+        rgb = bytearray(width * height * 3)
+        for channel in range(3):
+            rgb[channel::3] = pixels[channel::4]
+        pixels = rgb
+    pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(bytes(pixels)), GdkPixbuf.Colorspace.RGB, False, 8,
+                                             width, height, width * 3)
+    _, data = pixbuf.save_to_bufferv(name, ['quality'], [str(max(0, min(100, quality)))])
+    return bytes(data)
+
+
+# This function wraps encoded image bytes in the base64 data URL format expected by the A1111 API.
+def data_url(img_bytes, mime='image/png'):
+    return 'data:' + mime + ';base64,' + base64.b64encode(img_bytes).decode('ascii')
+
+
+# An encoded image (e.g. PNG bytes) that's sent to the API as a base64 data URL. Requests hold these
+# instead of data URL strings: the data URL is produced chunk by chunk while the request body is
+# written (see json_stream.iter_json), so the complete string never has to exist in memory.
+# str() returns the data URL, len() its length.
+# data may also be a concurrent.futures.Future of the data, or of an EncodedImage whose mime type then
+# applies, for images that are still being encoded in the background; it's waited for when the data or
+# the mime type is needed.
+class EncodedImage:
+
+    def __init__(self, data, mime='image/png'):
+        self._data = data
+        self._mime = mime
+        self._sha256 = None
+
+    @property
+    def data(self):
+        self._resolve()
+        return self._data
+
+    @property
+    def mime(self):
+        self._resolve()
+        return self._mime
+
+    def _resolve(self):
+        if isinstance(self._data, Future):
+            result = self._data.result()
+            if isinstance(result, EncodedImage):
+                self._mime = result.mime
+                result = result.data
+            self._data = result
+
+    @property
+    def prefix(self):
+        return 'data:' + self.mime + ';base64,'
+
+    def __len__(self):
+        return len(self.prefix) + (len(self.data) + 2) // 3 * 4
+
+    def __str__(self):
+        return data_url(self.data, self.mime)
+
+    def __repr__(self):
+        return f"<EncodedImage {self.mime}, {len(self.data)} bytes>"
+
+    # This generator yields the data URL in pieces: the prefix, then the base64 data in chunks.
+    def iter_base64(self, chunk_size=BASE64_CHUNK_SIZE):
+        yield self.prefix
+        view = memoryview(self.data)
+        for start in range(0, len(view), chunk_size):
+            yield base64.b64encode(view[start:start + chunk_size]).decode('ascii')
+
+    # Returns the SHA-256 hex digest of the data URL, the same as for the equivalent string.
+    def sha256(self):
+        if self._sha256 is None:
+            digest = hashlib.sha256()
+            for chunk in self.iter_base64():
+                digest.update(chunk.encode('ascii'))
+            self._sha256 = digest.hexdigest()
+        return self._sha256
+
+
+# This function composites 8-bit gray + alpha pixels over a white background and returns 8-bit gray pixels.
+# It gives the same result as flattening a mask layer in GIMP, without a per-pixel Python loop.
+def flatten_gray_alpha(pixels):
+    global _over_white_table
+    if _over_white_table is None:
+        table = bytearray(65536)
+        for alpha in range(256):
+            for gray in range(256):
+                value = (gray * alpha + 255 * (255 - alpha) + 127) // 255
+                if sys.byteorder == 'little':
+                    table[alpha << 8 | gray] = value
+                else:
+                    table[gray << 8 | alpha] = value
+        _over_white_table = bytes(table)
+    return bytes(map(_over_white_table.__getitem__, array('H', pixels)))
+
+
+# This function returns the bytes of a base64 image, with or without data URL prefix.
+def decode_base64(encoded):
+    if ',' in encoded[:64]:
+        encoded = encoded.split(',', 1)[1]
+    return base64.b64decode(encoded)
+
+
+# Bytes read by image_size. JPEG headers hold quantization tables (and maybe more) before the size.
+_HEADER_BYTES = 4096
+
+# JPEG start of frame markers, which are followed by the image size
+_JPEG_SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+
+# This function returns (width, height) of a base64-encoded PNG, JPEG or WebP image (or an EncodedImage)
+# from its header, or None if it's none of these.
+def image_size(encoded):
+    if isinstance(encoded, EncodedImage):
+        header = bytes(encoded.data[:_HEADER_BYTES])
+    else:
+        if ',' in encoded[:64]:
+            encoded = encoded.split(',', 1)[1]
+        try:
+            header = base64.b64decode(encoded[:_HEADER_BYTES // 3 * 4])
+        except ValueError:
+            return None
+    try:
+        if header.startswith(PNG_SIGNATURE) and header[12:16] == b'IHDR':
+            return struct.unpack('>II', header[16:24])
+        if header.startswith(b'\xff\xd8'):
+            return _jpeg_size(header)
+        if header.startswith(b'RIFF') and header[8:12] == b'WEBP':
+            return _webp_size(header)
+    except struct.error:
+        pass  # header cut short
+    return None
+
+
+def _jpeg_size(header):
+    pos = 2
+    while pos + 4 <= len(header):
+        if header[pos] != 0xff:
+            return None
+        marker = header[pos + 1]
+        if marker == 0xff:  # fill byte
+            pos += 1
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>HH', header[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + struct.unpack('>H', header[pos + 2:pos + 4])[0]
+    return None
+
+
+def _webp_size(header):
+    chunk = header[12:16]
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', header[26:30])
+        return width & 0x3fff, height & 0x3fff
+    if chunk == b'VP8L':
+        bits = struct.unpack('<I', header[21:25])[0]
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    if chunk == b'VP8X':
+        return (int.from_bytes(header[24:27], 'little') + 1, int.from_bytes(header[27:30], 'little') + 1)
+    return None
+
+
+# This function decodes PNG bytes to RGB or RGBA pixels.
+def decode_png(png):
+    if GdkPixbuf is not None:
+        try:
+            return _decode_pixbuf(png)
+        except Exception as e:
+            print(f"GdkPixbuf couldn't decode the image ({e}), decoding it in Python.")
+    return _decode_png_python(png)
+
+
+def _decode_pixbuf(png):
+    loader = GdkPixbuf.PixbufLoader.new_with_type('png')
+    loader.write(png)
+    loader.close()
+    pixbuf = loader.get_pixbuf()
+    width, height, channels = pixbuf.get_width(), pixbuf.get_height(), pixbuf.get_n_channels()
+    stride, row_size = pixbuf.get_rowstride(), width * channels
+    data = pixbuf.get_pixels()
+    if stride != row_size:
+        # Rows are padded (except for the last one)
+        data = b''.join(data[row * stride:row * stride + row_size] for row in range(height))
+    return DecodedImage(bytes(data), width, height, channels)
+
+
+# This function is the fallback for decode_png. It handles 8-bit, non-interlaced PNGs, which is what
+# the A1111 API returns.
+def _decode_png_python(png):
+    if not png.startswith(PNG_SIGNATURE):
+        raise ValueError('Not a PNG image')
+    header = None
+    palette = transparency = None
+    idat = []
+    pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(png):
+        length, tag = struct.unpack('>I4s', png[pos:pos + 8])
+        data = png[pos + 8:pos + 8 + length]
+        pos += length + 12
+        if tag == b'IHDR':
+            header = struct.unpack('>IIBBBBB', data)
+        elif tag == b'PLTE':
+            palette = data
+        elif tag == b'tRNS':
+            transparency = data
+        elif tag == b'IDAT':
+            idat.append(data)
+        elif tag == b'IEND':
+            break
+    if header is None:
+        raise ValueError('PNG image has no header')
+    width, height, depth, color_type, _, _, interlace = header
+    if depth != 8 or interlace or color_type not in _PNG_CHANNELS:
+        raise ValueError(f"Unsupported PNG image (bit depth {depth}, color type {color_type}, interlace {interlace})")
+
+    stored_channels = _PNG_CHANNELS[color_type]
+    pixels = _unfilter(zlib.decompress(b''.join(idat)), width, height, stored_channels)
+    if color_type in (2, 6):
+        return DecodedImage(bytes(pixels), width, height, stored_channels)
+
+    # Gray and palette images are expanded to RGB(A) with slice assignments and lookup tables
+    count = width * height
+    channels = 4 if color_type == 4 or (color_type == 3 and transparency) else 3
+    out = bytearray(count * channels)
+    if color_type == 0:
+        out[0::3] = out[1::3] = out[2::3] = pixels
+    elif color_type == 4:
+        gray = pixels[0::2]
+        out[0::4] = out[1::4] = out[2::4] = gray
+        out[3::4] = pixels[1::2]
+    else:
+        palette = (palette or b'').ljust(768, b'\0')
+        for channel in range(3):
+            out[channel::channels] = pixels.translate(palette[channel::3])
+        if channels == 4:
+            out[3::4] = pixels.translate(transparency.ljust(256, b'\xff')[:256])
+    return DecodedImage(bytes(out), width, height, channels)
+
+
+# This function reverses the PNG row filters. The Up filter is applied to whole rows at once,
+# using big integers for carry-free bytewise addition.
+def _unfilter(raw, width, height, bpp):
+    stride = width * bpp
+    if len(raw) < (stride + 1) * height:
+        raise ValueError('PNG image data is truncated')
+    low_bits = int.from_bytes(b'\x7f' * stride, 'big')
+    high_bits = int.from_bytes(b'\x80' * stride, 'big')
+    out = bytearray(stride * height)
+    prev = bytes(stride)
+    pos = 0
+    for row in range(height):
+        filter_type = raw[pos]
+        line = bytearray(raw[pos + 1:pos + 1 + stride])
+        pos += stride + 1
+        if filter_type == 1:  # Sub
+            for i in range(bpp, stride):
+                line[i] = (line[i] + line[i - bpp]) & 0xff
+        elif filter_type == 2:  # Up
+            a, b = int.from_bytes(line, 'big'), int.from_bytes(prev, 'big')
+            line = bytearray((((a & low_bits) + (b & low_bits)) ^ ((a ^ b) & high_bits)).to_bytes(stride, 'big'))
+        elif filter_type == 3:  # Average
+            for i in range(bpp):
+                line[i] = (line[i] + (prev[i] >> 1)) & 0xff
+            for i in range(bpp, stride):
+                line[i] = (line[i] + ((line[i - bpp] + prev[i]) >> 1)) & 0xff
+        elif filter_type == 4:  # Paeth
+            for i in range(stride):
+                left = line[i - bpp] if i >= bpp else 0
+                up = prev[i]
+                up_left = prev[i - bpp] if i >= bpp else 0
+                p = left + up - up_left
+                pa, pb, pc = abs(p - left), abs(p - up), abs(p - up_left)
+                if pa <= pb and pa <= pc:
+                    predictor = left
+                elif pb <= pc:
+                    predictor = up
+                else:
+                    predictor = up_left
+                line[i] = (line[i] + predictor) & 0xff
+        elif filter_type != 0:
+            raise ValueError('Invalid PNG filter type: ' + str(filter_type))
+        out[row * stride:(row + 1) * stride] = line
+        prev = line
+    return out
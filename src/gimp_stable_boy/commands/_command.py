@@ -14,23 +14,50 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import time
 import json
 import socket
 import hashlib
-import tempfile
-from threading import Thread
+import queue
+import uuid
+from time import monotonic
+from threading import Thread, Lock, Event, Semaphore
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from urllib.parse import urljoin
-from urllib.request import Request, urlopen
 from collections import namedtuple
 
 import gi
 gi.require_version('Gimp', '3.0')
-from gi.repository import Gimp
+gi.require_version('GimpUi', '3.0')
+from gi.repository import Gimp, GimpUi, GLib
 
-from gimp_stable_boy.command_runner import config
+from gimp_stable_boy.config import Config as config
 import gimp_stable_boy as sb
+from gimp_stable_boy import capabilities, codec, http_pool, json_stream, result_cache, tracing
+from gimp_stable_boy.cancel_dialog import CancelDialog
+from gimp_stable_boy.request_log import log as request_log
+from gimp_stable_boy.latency_model import model as latency_model
+from gimp_stable_boy.progress import ProgressPoller
+from gimp_stable_boy.scheduler import scheduler
 from gimp_stable_boy.constants import PREFERENCES_SHELF_GROUP as PREFS
 
+# WebUI stops the job it's working on and returns the images generated so far
+INTERRUPT_URI = 'sdapi/v1/interrupt'
+INTERRUPT_TIMEOUT = 5
+# Tells whether a request, by the task id it was sent with (force_task_id), is queued, running or done
+TASK_PROGRESS_URI = 'internal/progress'
+# Seconds between checks on requests of a cancelled command that are queued behind another one of
+# its requests. They're interrupted once they start.
+INTERRUPT_INTERVAL = 0.5
+
+# Results waiting to be inserted by the main thread, at most. When there are more, the requests'
+# responses aren't read any further until the main thread has caught up, so memory use stays the
+# same no matter how many images a command generates.
+MAX_PENDING_RESULTS = 8
+
 
 class StableBoyCommand:
     LayerResult = namedtuple('LayerResult', 'name img children')
@@ -68,17 +95,24 @@ class StableBoyCommand:
         # Save preferences
         # sb.gimp.save_prefs(cls.proc_name, **config.get_properties())
 
-        command = cls(image, config)
-        command.start()
-        Gimp.progress_init(f"Running {cls.menu_label}...")
-
-        while command.is_alive():
-            Gimp.progress_update(0.5)
-            Gimp.context_pop()
-            GLib.usleep(100000)
-            Gimp.context_push()
+        with tracing.span(cls.proc_name):
+            command = cls(image, config)
+            dialog = None
+            if run_mode == Gimp.RunMode.INTERACTIVE:
+                dialog = CancelDialog(f"Running {cls.menu_label}...", command.cancel)
+            command.start()
+            Gimp.progress_init(f"Running {cls.menu_label}...")
+            command.wait(dialog)
+            Gimp.progress_end()
+            if dialog:
+                dialog.destroy()
+        request_log.flush()  # the plug-in process ends when run returns
+        trace_path = tracing.export()
+        if trace_path:
+            print('trace: ' + trace_path)
 
-        Gimp.progress_end()
+        if command.status == 'CANCELLED':
+            return procedure.new_return_values(Gimp.PDBStatusType.CANCEL, GLib.Error())
 
         if command.status == 'ERROR':
             error = GLib.Error.new_literal(Gimp.PlugIn.error_quark(), command.error_msg, 0)
@@ -89,19 +123,46 @@ class StableBoyCommand:
 
 class StableDiffusionCommand(StableBoyCommand, Thread):
     uri = ''
+    # Results are handed to _process_response one image at a time while the response
+    # is still arriving. Commands that need all images at once set this to False.
+    stream_results = True
+    # Commands with a "live_preview" argument set this to True
+    live_preview_supported = False
 
-    def __init__(self, image, config):
+    def __init__(self, image, procedure_config):
         Thread.__init__(self)
         self.img = image
-        self.config = config
+        self.config = procedure_config
         self.status = 'INITIALIZED'
-        self.url = urljoin(sb.gimp.pref_value(PREFS, 'api_base_url', sb.constants.DEFAULT_API_URL), self.uri)
+        self.api_base_url = sb.gimp.pref_value(PREFS, 'api_base_url', sb.constants.DEFAULT_API_URL)
+        self.url = urljoin(self.api_base_url, self.uri)
+        self.progress_base_url = self.api_base_url  # backend whose progress is reported
+        self.progress_fraction = 0.0  # progress tracked by the command itself, e.g. finished tiles
+        self._results_lock = Lock()
+        self._main_thread_tasks = queue.Queue()  # see _run_in_main_thread
+        self.wake_up = None  # called when there's a task for the main thread, see _put_task
+        self._pending_results = Semaphore(MAX_PENDING_RESULTS)  # see _insert_in_main_thread
+        self.cancelled = Event()  # see cancel()
+        self._requests = {}  # task id -> (backend URL, AbortHandle) of the requests being sent, for cancel()
+        self._requests_lock = Lock()
+        self.started_at = None
+        self.expected_end = None  # predicted by the latency model, see wait()
         self.images = None
         self.layers = None
+        self.images_done = 0  # see _process_batch_response
+        self.result_group = None  # layer group for the results of large batches
+        self.output_dir = None  # for results saved as files, see _save_images
+        self.files_saved = 0
+        self.clip_masks = {}  # (x, y) -> gimp_funcs.ClipMask, see _clip_mask
+        self.live_preview = self.live_preview_supported and self.config.get_property('live_preview')
+        self.preview_layer = None
+        self.preview_done = False  # set when the results arrive, see _insert_results
         self.x, self.y, self.width, self.height = self._determine_active_area()
         print('x, y, w, h: ' + str(self.x) + ', ' + str(self.y) + ', ' + str(self.width) + ', ' + str(self.height))
         self.img_target = sb.constants.IMAGE_TARGETS[self.config.get_property('img_target')]  # layers are the default img_target
-        self.req_data = self._make_request_data()
+        self.input_format = config.INPUT_FORMATS.get(self.proc_name, config.INPUT_FORMAT)  # for encode_img
+        with tracing.span('request.build'):
+            self.req_data = self._make_request_data()
         if config.TIMEOUT_REQUESTS:
             self.timeout = self._estimate_timeout(self.req_data)
         else:
@@ -110,31 +171,466 @@ class StableDiffusionCommand(StableBoyCommand, Thread):
     def run(self):
         self.status = 'RUNNING'
         try:
-            if config.LOG_REQUESTS:
-                req_path = tempfile.mktemp(prefix='req_', suffix='.json')
-                with open(req_path, 'w') as req_file:
-                    print('request: ' + req_path)
-                    req_file.write(json.dumps(self.req_data))
-            sd_request = Request(url=self.url,
-                                 headers={'Content-Type': 'application/json'},
-                                 data=json.dumps(self.req_data).encode('utf-8'))
-            # print(self.req_data)
-            self.sd_resp = urlopen(sd_request, timeout=self.timeout)
-            if self.sd_resp:
-                self.response = json.loads(self.sd_resp.read())
-                if config.LOG_REQUESTS:
-                    resp_path = tempfile.mktemp(prefix='resp_', suffix='.json')
-                    with open(resp_path, 'w') as resp_file:
-                        print('response: ' + resp_path)
-                        resp_file.write(json.dumps(self.response))
-                self._process_response(self.response)
-            self.status = 'DONE'
+            scheduler.set_backends(self._backend_urls())
+            capabilities.cache.prefetch(backend.url for backend in scheduler.backends)
+            self._send_requests(stream=self.stream_results)
+            self.status = 'CANCELLED' if self.cancelled.is_set() else 'DONE'
         except Exception as e:
-            self.status = 'ERROR'
-            self.error_msg = str(e)
+            if self.cancelled.is_set():
+                # Most likely caused by cancelling, e.g. an aborted connection
+                self.status = 'CANCELLED'
+            else:
+                self.status = 'ERROR'
+                self.error_msg = str(e)
             print(e)
             # Re-raising the exception is not necessary here as it's handled in the main thread
             # raise e
+        finally:
+            if self.live_preview:
+                self._run_in_main_thread(self._remove_preview)
+            self._put_task(None)  # wakes up wait()
+
+    # Cancels the command. Requests that haven't been sent yet aren't sent at all. Requests a backend
+    # is working on are interrupted (WebUI's interrupt), and the images they return are inserted like
+    # any others; so are the results of requests that have finished already. WebUI's interrupt stops
+    # whatever job is running, so it's only sent once the backend reports that the job is ours: the
+    # connections of requests waiting behind other clients' work, or whose state the backend doesn't
+    # report, are closed instead. Connections of requests that still haven't returned after
+    # Config.CANCEL_GRACE_PERIOD are closed too. Can be called from any thread, returns right away.
+    def cancel(self):
+        if self.cancelled.is_set() or self.status in ('DONE', 'ERROR'):
+            return
+        self.cancelled.set()
+        print('Cancelling...')
+        Thread(target=self._interrupt, name='cancel', daemon=True).start()
+
+    def _interrupt(self):
+        deadline = monotonic() + config.CANCEL_GRACE_PERIOD
+        interrupted, closed = set(), set()
+        while self.is_alive() and monotonic() < deadline:
+            waiting = self._stop_requests(interrupted, closed)
+            until = min(monotonic() + INTERRUPT_INTERVAL, deadline) if waiting else deadline
+            self.join(max(0.0, until - monotonic()))
+        if self.is_alive():
+            print('Closing connections of cancelled requests')
+            with self._requests_lock:
+                aborts = [abort for _, abort in self._requests.values()]
+            for abort in aborts:
+                abort.abort()
+
+    # Interrupts the requests that backends are working on, and closes the connections of those that
+    # are waiting behind other clients' work or whose state is unknown. Requests in interrupted or
+    # closed are skipped, the others are added. Returns whether any requests are queued behind one of
+    # our own; they start next, and get interrupted on a later call.
+    def _stop_requests(self, interrupted, closed):
+        with self._requests_lock:
+            requests = dict(self._requests)
+        states = {task_id: self._task_state(backend_url, task_id) for task_id, (backend_url, _) in requests.items()
+                  if task_id not in interrupted and task_id not in closed}
+        running = {requests[task_id][0] for task_id in requests
+                   if task_id in interrupted or states.get(task_id) == 'active'}
+        waiting = False
+        for task_id, state in states.items():
+            backend_url, abort = requests[task_id]
+            if state == 'active':
+                self._interrupt_backend(backend_url)
+                interrupted.add(task_id)
+            elif state == 'queued' and backend_url in running:
+                waiting = True
+            elif state != 'completed':
+                abort.abort()
+                closed.add(task_id)
+        return waiting
+
+    # Returns the state of one of our requests on a backend: 'active' (the job it's working on),
+    # 'queued' or 'completed'. None if the backend can't tell, e.g. WebUI versions that ignore
+    # force_task_id, and requests without tasks like upscaling.
+    def _task_state(self, backend_url, task_id):
+        try:
+            with http_pool.pool.request('POST', urljoin(backend_url, TASK_PROGRESS_URI),
+                                        body=json.dumps({'id_task': task_id, 'live_preview': False}).encode('utf-8'),
+                                        headers={'Content-Type': 'application/json'},
+                                        timeout=INTERRUPT_TIMEOUT) as resp:
+                progress = json.loads(resp.read())
+        except Exception as e:
+            print(f"Couldn't check on {task_id} at {backend_url}: {e}")
+            return None
+        return next((state for state in ('active', 'queued', 'completed') if progress.get(state)), None)
+
+    def _interrupt_backend(self, backend_url):
+        try:
+            with http_pool.pool.request('POST', urljoin(backend_url, INTERRUPT_URI), body=b'',
+                                        timeout=INTERRUPT_TIMEOUT) as resp:
+                resp.read()
+        except Exception as e:
+            print(f"Couldn't interrupt {backend_url}: {e}")
+
+    # Registers a request with the backend it's sent to while it runs, for cancel()
+    @contextmanager
+    def _sending_to(self, backend, task_id, abort):
+        with self._requests_lock:
+            self._requests[task_id] = (backend.url, abort)
+        try:
+            yield
+        finally:
+            with self._requests_lock:
+                del self._requests[task_id]
+
+    # The WebUI instances requests can be sent to: the one from the preferences plus Config.API_BASE_URLS.
+    def _backend_urls(self):
+        return [self.api_base_url] + [url for url in config.API_BASE_URLS if url != self.api_base_url]
+
+    # Sends the command's request(s). Batches are split into chunks (see _split_request), which are
+    # sent two per backend: while the images of one chunk are received and decoded, the backend is
+    # already working on the next. The results of batches larger than a chunk go to a layer group.
+    def _send_requests(self, stream):
+        sub_requests = self._split_request(self.req_data) if stream else [self.req_data]
+        if int(self.req_data.get('batch_size', 1)) > config.MAX_IMAGES_PER_REQUEST and self.img_target == 'Layers':
+            self._run_in_main_thread(self._new_result_group)
+        self._send_all([(req_data, self._process_batch_response) for req_data in sub_requests], stream,
+                       max_workers=min(len(sub_requests), 2 * len(scheduler.backends)))
+
+    def _new_result_group(self):
+        name = f"{self.menu_label} ({self.req_data['batch_size']} images): {self.req_data.get('prompt') or ''}"
+        self.result_group = sb.gimp.new_layer_group(self.img, name[:100].strip(': '))
+
+    def _process_batch_response(self, resp):
+        self._process_response(resp)
+        self.images_done += len(resp.get('images') or [])
+        self.progress_fraction = self.images_done / max(1, int(self.req_data.get('batch_size', 1)))
+
+    # Sends (request data, process function) pairs concurrently, see _send.
+    def _send_all(self, requests, stream, max_workers):
+        if len(requests) == 1:
+            self._send(*requests[0], stream=stream)
+            return
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = [executor.submit(self._send, req_data, process, stream) for req_data, process in requests]
+            for future in futures:
+                future.result()
+
+    # Splits a batch into chunks of at most Config.MAX_IMAGES_PER_REQUEST images, and into at least one
+    # per backend, so that the images are generated in parallel.
+    # Image i of a batch with a fixed seed uses seed + i, so the results are the same as for the whole batch.
+    def _split_request(self, req_data):
+        batch_size = int(req_data.get('batch_size', 1))
+        num_chunks = min(batch_size, max(len(scheduler.backends), -(-batch_size // config.MAX_IMAGES_PER_REQUEST)))
+        if num_chunks < 2 or 'script_name' in req_data:
+            return [req_data]
+        try:
+            seed = int(req_data.get('seed', -1))
+        except ValueError:
+            seed = -1
+        sub_requests = []
+        offset = 0
+        for chunk in range(num_chunks):
+            chunk_size = batch_size // num_chunks + (1 if chunk < batch_size % num_chunks else 0)
+            sub_request = dict(req_data, batch_size=chunk_size)
+            if seed != -1:
+                sub_request['seed'] = seed + offset
+            sub_requests.append(sub_request)
+            offset += chunk_size
+        return sub_requests
+
+    # Sends one request to the least loaded backend (or replays it from the result cache) and
+    # processes the response with `process` (default: _process_response). If a backend can't be
+    # reached, or doesn't have the sampler, upscaler, etc. the request asks for, the request goes to the next one.
+    # Once the command has been cancelled, requests aren't sent anymore. With prefer, the request goes to
+    # that backend while it's healthy. Returns the backend that generated the result, if any.
+    def _send(self, req_data, process=None, stream=True, prefer=None):
+        if self.cancelled.is_set():
+            return
+        cache_keys = self._cache_keys(req_data)
+        for cache_key in set(cache_keys.values()) - {None}:
+            members = result_cache.cache.read(cache_key)
+            if members is not None:
+                record_id = self._log_request(req_data, 'cache')
+                if record_id:
+                    members = request_log.tee_response(record_id, members)
+                with tracing.span('cache.replay'):
+                    self._process_members(members, stream, process)
+                return
+
+        tried = []
+        while True:
+            connected = False
+            # WebUI reports on the request by this id, see cancel()
+            task_id = f"task({uuid.uuid4().hex})"
+            abort = http_pool.AbortHandle()
+            try:
+                with scheduler.dispatch(exclude=tried, cost=partial(self._predict_duration, req_data),
+                                        prefer=prefer) as backend, \
+                        self._sending_to(backend, task_id, abort):
+                    tried.append(backend)
+                    if self.cancelled.is_set():
+                        return
+                    capabilities.cache.validate(backend.url, self.uri, req_data)
+                    cache_key = cache_keys.get(backend.url)
+                    self.progress_base_url = backend.url
+                    sent_at = self._expect(backend, req_data)
+                    busy_elsewhere = backend.busy  # with work from other clients, which we can't time
+                    record_id = self._log_request(req_data, backend.url)
+                    # The body is written while it's sent, images are base64-encoded chunk by chunk.
+                    # Connections are kept alive and shared between all commands.
+                    with tracing.span('request.send', backend=backend.url):
+                        sd_resp = http_pool.pool.request('POST', urljoin(backend.url, self.uri),
+                                                         body=partial(json_stream.iter_json_body,
+                                                                      dict(req_data, force_task_id=task_id)),
+                                                         headers={'Content-Type': 'application/json'},
+                                                         timeout=self._request_timeout(backend, req_data),
+                                                         abort=abort)
+                    connected = True
+                    started_at, finished_at = scheduler.response_arrived(backend, sent_at)
+                    # Also if a probe sent along with the request found it busy (see Scheduler.acquire)
+                    busy_elsewhere = busy_elsewhere or backend.busy
+                    with tracing.span('response.receive', backend=backend.url) as span:
+                        members = json_stream.iter_members(sd_resp, unpack_keys=['images'])
+                        if cache_key:
+                            members = result_cache.cache.write_through(cache_key, members)
+                        if record_id:
+                            members = request_log.tee_response(record_id, members)
+                        self._process_members(members, stream, process)
+                        span.set(bytes_in=sd_resp.bytes_read)
+                    if self.cancelled.is_set():
+                        # Possibly interrupted: neither a result to replay nor a typical duration
+                        if cache_key:
+                            result_cache.cache.discard(cache_key)
+                    elif not busy_elsewhere:
+                        # From when the backend got to the request until it answered: neither the wait
+                        # behind other requests nor receiving and inserting the images count
+                        latency_model.observe(backend.url, self.uri, req_data, finished_at - started_at)
+                return backend
+            except capabilities.UnsupportedRequest as e:
+                if len(tried) >= len(scheduler.backends):
+                    raise
+                print(f"{e}, trying the next backend.")
+            except OSError as e:
+                if connected or isinstance(e, TimeoutError) or self.cancelled.is_set() \
+                        or len(tried) >= len(scheduler.backends):
+                    raise
+                print(f"Backend {backend.url} failed ({e}), trying the next one.")
+
+    # Returns the result cache keys of a request, {backend URL: key}, with Config.CACHE_RESULTS. Results
+    # depend on the backend's settings (checkpoint, VAE, ...) as much as on the request, so these are
+    # part of the keys: backends with different settings don't share results. Backends whose settings
+    # are unknown, and requests without a fixed seed, have no key.
+    def _cache_keys(self, req_data):
+        if not config.CACHE_RESULTS or not result_cache.deterministic(req_data):
+            return {}
+        digests = capabilities.options.digests([backend.url for backend in scheduler.backends])
+        return {url: result_cache.request_key(scheduler.scope + ' ' + self.uri + ' ' + digest, req_data)
+                for url, digest in digests.items() if digest}
+
+    # With Config.LOG_REQUESTS, logs a request about to be sent to a backend (or replayed from the
+    # cache) and returns its record id, for logging the response with request_log.tee_response.
+    def _log_request(self, req_data, backend_url):
+        if not config.LOG_REQUESTS:
+            return None
+        record_id = uuid.uuid4().hex
+        request_log.log_request(record_id, self.proc_name, self.uri, backend_url, req_data)
+        print('logged request ' + record_id)
+        return record_id
+
+    # Returns the predicted duration of a request on a backend, or None if the latency model can't tell yet.
+    def _predict_duration(self, req_data, backend):
+        prediction = latency_model.predict(backend.url, self.uri, req_data)
+        return prediction[0] if prediction else None
+
+    # Returns the timeout for a request: from the latency model, or from _estimate_timeout until
+    # the model has seen enough requests. The model's predictions don't include waiting for other
+    # requests, so the timeout grows with the requests the backend has to work through first.
+    def _request_timeout(self, backend, req_data):
+        if not config.TIMEOUT_REQUESTS:
+            return self.timeout
+        timeout = latency_model.timeout(backend.url, self.uri, req_data) or self._estimate_timeout(req_data)
+        return timeout * max(1, backend.in_flight)
+
+    # Takes note of when a request is expected to finish, for estimating progress. Returns the start time.
+    def _expect(self, backend, req_data):
+        duration = self._predict_duration(req_data, backend)
+        now = monotonic()
+        with self._results_lock:
+            if self.started_at is None:
+                self.started_at = now
+            if duration is not None:
+                self.expected_end = max(self.expected_end or 0.0, now + duration)
+        return now
+
+    # Waits in the main thread until the request has finished, reporting the backend's progress and
+    # running the tasks scheduled with _run_in_main_thread. Between tasks, the thread sleeps until the
+    # next progress update is due, at an interval depending on the ETA. A CancelDialog shows the
+    # progress too; with one, the thread sleeps in its event loop instead, which also wakes up for
+    # UI events and new tasks.
+    def wait(self, dialog=None):
+        poller = ProgressPoller(self.progress_base_url,
+                                preview_interval=config.LIVE_PREVIEW_INTERVAL if self.live_preview else None)
+        poller.start()
+        shown_fraction = 0.0
+        shown_preview = 0
+        self.wake_up = dialog.wake_up if dialog else None
+        try:
+            while True:
+                try:
+                    task = self._main_thread_tasks.get(block=not dialog, timeout=poller.interval)
+                except queue.Empty:
+                    task = False
+                    if dialog:
+                        dialog.sleep(poller.interval)
+                if task is None:  # run() has finished
+                    break
+                if task:
+                    self._run_main_thread_task(task)
+                poller.api_base_url = self.progress_base_url
+                fraction, text = max(poller.fraction, self.progress_fraction), poller.text
+                if poller.eta is None and self.expected_end:
+                    # WebUI isn't reporting progress (yet), estimate it from the predicted duration
+                    now = monotonic()
+                    fraction = max(fraction, min(0.95, (now - self.started_at) / max(1e-3, self.expected_end - self.started_at)))
+                    text = text or f"About {max(0, int(round(self.expected_end - now)))} s left"
+                shown_fraction = max(shown_fraction, fraction)
+                Gimp.progress_update(shown_fraction)
+                if text:
+                    Gimp.progress_set_text(text)
+                if dialog:
+                    dialog.update(shown_fraction, text)
+                    dialog.process_events()
+                if poller.preview_serial != shown_preview and not self.preview_done:
+                    shown_preview = poller.preview_serial
+                    self._show_preview(poller.preview)
+        finally:
+            poller.stop()
+            self.wake_up = None
+        self.join()
+
+    # Runs the tasks scheduled with _run_in_main_thread so far, without waiting, for callers that run
+    # several commands at once instead of calling wait(). Returns False once run() has finished.
+    def run_main_thread_tasks(self):
+        while True:
+            try:
+                task = self._main_thread_tasks.get_nowait()
+            except queue.Empty:
+                return True
+            if task is None:
+                return False
+            self._run_main_thread_task(task)
+
+    # Shows a live preview in the preview layer at the active area, creating the layer if needed.
+    def _show_preview(self, decoded):
+        try:
+            self.preview_layer = sb.gimp.update_preview_layer(self.img, self.preview_layer, decoded,
+                                                              self.x, self.y, self.width, self.height)
+        except Exception as e:
+            print(f"Couldn't show live preview: {e}")
+            self.preview_done = True
+
+    def _remove_preview(self):
+        if self.preview_layer is not None:
+            sb.gimp.remove_preview_layer(self.img, self.preview_layer)
+            self.preview_layer = None
+
+    # Schedules func(*args) to be called in the main thread, which owns the image. Tasks run in the
+    # order they were scheduled.
+    def _run_in_main_thread(self, func, *args):
+        self._put_task(partial(func, *args))
+
+    # Queues a task for the main thread (None: run() has finished) and wakes it up with wake_up, if set
+    def _put_task(self, task):
+        self._main_thread_tasks.put(task)
+        wake_up = self.wake_up
+        if wake_up is not None:
+            wake_up()
+
+    def _run_main_thread_task(self, task):
+        try:
+            with tracing.span('main_thread.' + getattr(task.func, '__name__', 'task')):
+                task()
+        except Exception as e:
+            self.status = 'ERROR'
+            self.error_msg = str(e)
+            print(e)
+        finally:
+            if getattr(task, 'pending_result', False):
+                self._pending_results.release()
+
+    # Like _run_in_main_thread, for tasks inserting results. Waits while MAX_PENDING_RESULTS of them
+    # haven't run yet. Must not be called in the main thread.
+    def _insert_in_main_thread(self, func, *args):
+        self._pending_results.acquire()
+        task = partial(func, *args)
+        task.pending_result = True
+        self._put_task(task)
+
+    # Inserts self.images or self.layers (at x, y, by default the active area), or saves them if
+    # the results go to files. The images are decoded in worker threads, the main thread only
+    # creates the layers.
+    def _insert_results(self, apply_inpainting_mask=False, x=None, y=None):
+        if self.live_preview and not self.preview_done:
+            # The preview layer makes way for the results
+            self.preview_done = True
+            self._run_in_main_thread(self._remove_preview)
+        if self.img_target == 'Files':
+            self._save_images(self.images or [])
+        elif self.images:
+            self._insert_in_main_thread(sb.gimp.open_images, [sb.gimp.decode_async(img) for img in self.images])
+        elif self.layers:
+            self._insert_in_main_thread(self._create_layers, sb.gimp.decode_layers(self.layers),
+                                        self.x if x is None else x, self.y if y is None else y, apply_inpainting_mask)
+
+    # In the result group, if there is one
+    def _create_layers(self, layers, x, y, apply_inpainting_mask):
+        sb.gimp.create_layers(self.img, layers, x, y, self._clip_mask(x, y) if apply_inpainting_mask else None,
+                              parent=self.result_group)
+
+    # The inpainting mask at x, y for the layer masks of results (a gimp_funcs.ClipMask). It's read when
+    # the first result is inserted and kept for all others. Main thread only.
+    def _clip_mask(self, x, y):
+        if (x, y) not in self.clip_masks:
+            self.clip_masks[x, y] = sb.gimp.ClipMask(self.img, x, y)
+        return self.clip_masks[x, y]
+
+    # Saves base64-encoded PNGs as numbered files in a new folder in Config.OUTPUT_DIR. The PNGs are
+    # written as they are, without being decoded.
+    def _save_images(self, images):
+        if self.output_dir is None:
+            name = os.path.join(config.OUTPUT_DIR, time.strftime('%Y%m%d-%H%M%S-') + self.proc_name)
+            self.output_dir, number = name, 1
+            while os.path.exists(self.output_dir):  # another run in the same second
+                number += 1
+                self.output_dir = f"{name}-{number}"
+            os.makedirs(self.output_dir)
+            print('saving results to ' + self.output_dir)
+        for image in images:
+            self.files_saved += 1
+            with open(os.path.join(self.output_dir, f"{self.files_saved:05d}.png"), 'wb') as image_file:
+                image_file.write(codec.decode_base64(image))
+
+    # Hands the (key, value) members of a response to _process_response. Members come from the
+    # network while the response is still arriving, or from the result cache.
+    # When streaming, each image is processed as soon as it has been read and isn't kept around
+    # afterwards, so peak memory is about one image regardless of batch size. Otherwise the
+    # complete response is collected and processed at once.
+    # Responses of concurrent requests are processed one at a time.
+    def _process_members(self, members, stream=True, process=None):
+        process = process or self._process_response
+        response = {}
+        streamed = False
+        for key, value in members:
+            if key == 'images' and stream:
+                with self._results_lock, tracing.span('response.process'):
+                    process({'images': [value]})
+                    self.layers = self.images = None
+                streamed = True
+            elif key == 'images':
+                response.setdefault('images', []).append(value)
+            else:
+                response[key] = value
+            del value
+        self.response = response
+        if not streamed:
+            # Also covers responses without a list of images (e.g. upscaling)
+            response.setdefault('images', [])
+            with self._results_lock, tracing.span('response.process'):
+                process(response)
 
     def _process_response(self, resp):
 
@@ -144,7 +640,7 @@ class StableDiffusionCommand(StableBoyCommand, Thread):
         all_imgs = resp['images']
         if self.img_target == 'Layers':
             self.layers = [StableDiffusionCommand.LayerResult(_mk_short_hash(img), img, None) for img in all_imgs]
-        elif self.img_target == 'Images':
+        elif self.img_target in ('Images', 'Files'):
             self.images = all_imgs
 
     def _determine_active_area(self):
@@ -164,6 +660,7 @@ class StableDiffusionCommand(StableBoyCommand, Thread):
             'height': self.height,
         }
 
+    # Fallback for _request_timeout
     def _estimate_timeout(self, req_data):
         timeout = int(int(req_data['steps']) * int(req_data['batch_size']) * config.TIMEOUT_FACTOR)
         if req_data['restore_faces']:
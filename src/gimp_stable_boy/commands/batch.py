@@ -0,0 +1,201 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import queue
+from time import monotonic
+from functools import partial
+
+import gi
+gi.require_version('Gimp', '3.0')
+gi.require_version('GimpUi', '3.0')
+from gi.repository import Gimp, GimpUi, GLib
+
+import gimp_stable_boy as sb
+from gimp_stable_boy import batch, tracing
+from gimp_stable_boy.config import Config as config
+from gimp_stable_boy.cancel_dialog import CancelDialog
+from gimp_stable_boy.registry import registry
+from gimp_stable_boy.request_log import log as request_log
+from ._command import StableBoyCommand
+
+# Runs the jobs of a manifest (see batch.py) with the Text to Image, Image to Image, Inpainting and
+# Upscale commands, without any dialogs, e.g. from gimp-console. Several jobs run at once: while the
+# main thread loads the next input file, earlier jobs' images are encoded in the background and their
+# requests are being processed. Results are saved as files in a folder per job.
+class BatchCommand(StableBoyCommand):
+    proc_name = "stable-boy-batch"
+    blurb = "Stable Boy " + sb.__version__ + " - Batch"
+    help_text = "Runs the jobs listed in a manifest file and saves the results in a folder"
+    menu_label = "Batch"
+    sensitivity_mask = Gimp.ProcedureSensitivityMask.ALWAYS
+
+    @classmethod
+    def add_arguments(cls, procedure):
+        procedure.add_string_argument("manifest", "Manifest (JSON lines)", "", "")
+        procedure.add_string_argument("output_dir", "Output folder", "", "")
+        procedure.add_int_argument("max_jobs", "Concurrent jobs (0: two per WebUI instance)", 0, 0, 64)
+
+    @classmethod
+    def run(cls, procedure, run_mode, image, n_drawables, drawables, args, data):
+        dialog = None
+        if run_mode == Gimp.RunMode.INTERACTIVE:
+            GimpUi.init(cls.proc_name)
+            dialog = GimpUi.ProcedureDialog(procedure)
+            if not dialog.run():
+                dialog.destroy()
+                return procedure.new_return_values(Gimp.PDBStatusType.CANCEL, GLib.Error())
+
+            config = dialog.get_config()
+            dialog.destroy()
+        else:
+            config = procedure.create_config()
+            config.set_values(args)
+
+        command = cls(config)
+        with tracing.span(cls.proc_name):
+            if run_mode == Gimp.RunMode.INTERACTIVE:
+                dialog = CancelDialog(f"Running {cls.menu_label}...", command.cancel)
+            Gimp.progress_init(f"Running {cls.menu_label}...")
+            try:
+                command.run_jobs(dialog)
+            except Exception as e:
+                command.error_msg = str(e)
+            Gimp.progress_end()
+            if dialog:
+                dialog.destroy()
+        request_log.flush()
+        tracing.export()
+        print(f"Batch: {command.done} done, {command.failed} failed, {command.skipped} done before")
+
+        if command.cancelled:
+            return procedure.new_return_values(Gimp.PDBStatusType.CANCEL, GLib.Error())
+        if command.error_msg or command.failed:
+            message = command.error_msg or f"{command.failed} job(s) failed, see {batch.PROGRESS_FILE}"
+            error = GLib.Error.new_literal(Gimp.PlugIn.error_quark(), message, 0)
+            return procedure.new_return_values(Gimp.PDBStatusType.EXECUTION_ERROR, error)
+        return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, GLib.Error())
+
+    def __init__(self, procedure_config):
+        self.manifest = procedure_config.get_property('manifest')
+        self.output_dir = procedure_config.get_property('output_dir')
+        self.max_jobs = procedure_config.get_property('max_jobs') or 2 * (1 + len(config.API_BASE_URLS))
+        self.running = []  # (job, command, image, start time)
+        self._signals = queue.Queue()  # commands with tasks for the main thread, or that have finished
+        self._dialog = None
+        self.cancelled = False
+        self.error_msg = None
+        self.done = self.failed = self.skipped = 0
+
+    # Runs the jobs that aren't done yet, max_jobs at a time, and records each outcome.
+    def run_jobs(self, dialog=None):
+        if not self.manifest or not self.output_dir:
+            raise Exception("A manifest and an output folder are needed")
+        jobs, errors = batch.read_manifest(self.manifest)
+        for number, message in errors:
+            print(f"{self.manifest}, line {number}: {message}")
+        self.failed += len(errors)
+        os.makedirs(self.output_dir, exist_ok=True)
+        progress = batch.BatchProgress(self.output_dir)
+        pending = [job for job in jobs if job.id not in progress.done]
+        self.skipped = len(jobs) - len(pending)
+        self._dialog = dialog
+
+        while (pending and not self.cancelled) or self.running:
+            while pending and not self.cancelled and len(self.running) < self.max_jobs:
+                job = pending.pop(0)
+                try:
+                    self.running.append(self._start_job(job))
+                except Exception as e:
+                    print(f"{job.id}: {e}")
+                    progress.record(job.id, 'error', error=str(e))
+                    self.failed += 1
+            signalled = self._wait_for_commands() if self.running else set()
+            for entry in list(self.running):
+                job, command, img, started = entry
+                if command not in signalled or command.run_main_thread_tasks():
+                    continue
+                command.join()
+                img.delete()
+                self.running.remove(entry)
+                if command.status == 'DONE':
+                    progress.record(job.id, 'done', images=command.files_saved, seconds=round(monotonic() - started, 2))
+                    self.done += 1
+                elif command.status == 'ERROR':
+                    print(f"{job.id}: {command.error_msg}")
+                    progress.record(job.id, 'error', error=command.error_msg)
+                    self.failed += 1
+                # Cancelled jobs aren't recorded, they run again next time
+            fraction = (self.skipped + self.done + self.failed) / max(1, len(jobs) + len(errors))
+            Gimp.progress_update(fraction)
+            if dialog:
+                dialog.update(fraction, f"{self.done + self.skipped} of {len(jobs)} jobs done")
+                dialog.process_events()
+
+    # Waits until running commands have tasks for the main thread or have finished, and returns them.
+    # With a dialog, its events are handled in the meantime.
+    def _wait_for_commands(self):
+        signalled = set()
+        while not signalled:
+            try:
+                signalled.add(self._signals.get(block=self._dialog is None))
+            except queue.Empty:
+                self._dialog.sleep()
+        while True:
+            try:
+                signalled.add(self._signals.get_nowait())
+            except queue.Empty:
+                return signalled
+
+    # Called by commands from any thread, see StableDiffusionCommand._put_task
+    def _signal(self, command):
+        self._signals.put(command)
+        if self._dialog:
+            self._dialog.wake_up()
+
+    # Loads a job's input (in the main thread, which owns GIMP) and starts its command. The command's
+    # results go to a folder of the job's own.
+    def _start_job(self, job):
+        cmd_cls = registry.command_class(job.proc_name)
+        img = sb.gimp.load_image(job.input, job.mask) if job.input else sb.gimp.new_image(job.width, job.height)
+        try:
+            procedure_config = sb.gimp.procedure_config(job.proc_name)
+            for key, value in job.settings.items():
+                procedure_config.set_property(key, value)
+            procedure_config.set_property('img_target', sb.constants.IMAGE_TARGETS.index('Files'))
+            command = cmd_cls(img, procedure_config)
+            command.output_dir = self._job_dir(job)
+            command.wake_up = partial(self._signal, command)
+        except Exception:
+            img.delete()
+            raise
+        command.start()
+        return job, command, img, monotonic()
+
+    # The job's folder, emptied of results from an earlier run that didn't finish
+    def _job_dir(self, job):
+        job_dir = os.path.join(self.output_dir, job.id)
+        os.makedirs(job_dir, exist_ok=True)
+        for name in os.listdir(job_dir):
+            if name.endswith('.png'):
+                os.remove(os.path.join(job_dir, name))
+        return job_dir
+
+    # Stops starting jobs and cancels the running ones
+    def cancel(self):
+        self.cancelled = True
+        for _, command, _, _ in self.running:
+            command.cancel()
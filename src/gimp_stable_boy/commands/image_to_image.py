@@ -26,6 +26,7 @@ from ._command import StableDiffusionCommand
 
 class Img2ImgCommand(StableDiffusionCommand):
     uri = 'sdapi/v1/img2img'
+    live_preview_supported = True
 
     proc_name = "stable-boy-img2img"
     blurb = "Stable Boy " + sb.__version__ + " - Image to Image"
@@ -44,18 +45,17 @@ class Img2ImgCommand(StableDiffusionCommand):
         procedure.add_boolean_argument("restore_faces", "Restore faces", False)
         procedure.add_double_argument("cfg_scale", "CFG", 7.5, 0, 20)
         procedure.add_double_argument("denoising_strength", "Denoising strength %", 50.0, 0, 100)
-        procedure.add_int_argument("num_images", "Number of images", 1, 1, 4)
+        procedure.add_int_argument("num_images", "Number of images", 1, 1, 1000)
         procedure.add_enum_argument("img_target", "Results as", 0, sb.constants.IMAGE_TARGETS)
+        procedure.add_boolean_argument("live_preview", "Live preview", False)
 
     def _make_request_data(self):
         req_data = super()._make_request_data()
         req_data['denoising_strength'] = float(self.config.get_property('denoising_strength')) / 100
-        req_data['init_images'] = [sb.gimp.encode_img(self.img, self.x, self.y, self.width, self.height)]
+        req_data['init_images'] = [sb.gimp.encode_img(self.img, self.x, self.y, self.width, self.height,
+                                                      self.input_format)]
         return req_data
 
     def _process_response(self, resp):
         super()._process_response(resp)
-        if self.images:
-            sb.gimp.open_images(self.images)
-        elif self.layers:
-            sb.gimp.create_layers(self.img, self.layers, self.x, self.y)
\ No newline at end of file
+        self._insert_results()
\ No newline at end of file
@@ -20,9 +20,13 @@ import gi
 gi.require_version('Gimp', '3.0')
 from gi.repository import Gimp, GObject
 
+from functools import partial
+
 import gimp_stable_boy as sb
+from gimp_stable_boy.config import Config as config
+from gimp_stable_boy.scheduler import scheduler
 from .image_to_image import Img2ImgCommand
-from ._command import StableDiffusionCommand
+from ._command import StableBoyCommand, StableDiffusionCommand
 
 
 class InpaintingCommand(Img2ImgCommand):
@@ -50,24 +54,46 @@ class InpaintingCommand(Img2ImgCommand):
         procedure.add_enum_argument("inpainting_fill", "Inpainting fill", 1, sb.constants.INPAINTING_FILL_MODE)
         procedure.add_boolean_argument("inpaint_full_res", "Inpaint at full resolution", True)
         procedure.add_int_argument("inpaint_full_res_padding", "Full res. inpainting padding", 0, 0, 256)
-        procedure.add_int_argument("num_images", "Number of images", 1, 1, 4)
+        procedure.add_int_argument("num_images", "Number of images", 1, 1, 1000)
         procedure.add_enum_argument("img_target", "Results as", 0, sb.constants.IMAGE_TARGETS)
         procedure.add_boolean_argument("apply_inpainting_mask", "Apply inpainting mask", True)
+        procedure.add_boolean_argument("inpaint_regions_separately", "Inpaint mask regions separately", False)
+        procedure.add_boolean_argument("live_preview", "Live preview", False)
 
     def __init__(self, image, config):
+        # Needed by _determine_active_area, which runs in super().__init__
+        self.autofit_inpainting = config.get_property('autofit_inpainting')
+        self.apply_inpainting_mask = config.get_property('apply_inpainting_mask')
         super().__init__(image, config)
-        self.autofit_inpainting = self.config.get_property('autofit_inpainting')
-        self.apply_inpainting_mask = self.config.get_property('apply_inpainting_mask')
-
+        if self.region_requests:
+            self.live_preview = False  # previews of several regions would take turns at the wrong place
 
     def _make_request_data(self):
-        req_data = super()._make_request_data()
+        # Separate parts of the mask are inpainted in their own, smaller windows, in parallel
+        regions = []
+        if self.config.get_property('inpaint_regions_separately'):
+            regions = sb.gimp.inpainting_regions(self.img, config.INPAINTING_REGION_MIN_SIZE)
+        if len(regions) > 1:
+            # Skips Img2ImgCommand, which would encode the whole area
+            req_data = StableDiffusionCommand._make_request_data(self)
+            req_data['denoising_strength'] = float(self.config.get_property('denoising_strength')) / 100
+        else:
+            req_data = super()._make_request_data()
         req_data['inpainting_mask_invert'] = 1
         req_data['inpainting_fill'] = self.config.get_property('inpainting_fill')
         req_data['mask_blur'] = self.config.get_property('mask_blur')
         req_data['inpaint_full_res'] = self.config.get_property('inpaint_full_res')
         req_data['inpaint_full_res_padding'] = self.config.get_property('inpaint_full_res_padding')
-        req_data['mask'] = sb.gimp.encode_mask(self.img, self.x, self.y, self.width, self.height)
+        self.region_requests = []
+        if len(regions) > 1:
+            for region in regions:
+                self.region_requests.append((region, dict(
+                    req_data, width=region.width, height=region.height,
+                    init_images=[sb.gimp.encode_img(self.img, region.x, region.y, region.width, region.height,
+                                                     self.input_format)],
+                    mask=sb.gimp.encode_mask(self.img, region.x, region.y, region.width, region.height))))
+        else:
+            req_data['mask'] = sb.gimp.encode_mask(self.img, self.x, self.y, self.width, self.height)
         return req_data
 
     def _determine_active_area(self):
@@ -77,9 +103,26 @@ class InpaintingCommand(Img2ImgCommand):
             # Need to call the grandparent's method directly
             return StableDiffusionCommand._determine_active_area(self)
 
+    # Regions are sent to all backends at once, two per backend, large batches in chunks (see
+    # _split_request). The results of each region (chunk) are added in a layer group at the region's
+    # position as soon as they arrive.
+    def _send_requests(self, stream):
+        if not self.region_requests:
+            return super()._send_requests(stream)
+        self.regions_done = 0
+        requests = [(chunk, partial(self._process_region_response, region))
+                    for region, req_data in self.region_requests for chunk in self._split_request(req_data)]
+        self.region_chunks = len(requests)
+        self._send_all(requests, stream=False, max_workers=2 * len(scheduler.backends))
+
+    def _process_region_response(self, region, resp):
+        StableDiffusionCommand._process_response(self, resp)
+        if self.layers:
+            self.layers = [StableBoyCommand.LayerResult(f"Inpainting at {region.x}, {region.y}", None, self.layers)]
+        self._insert_results(self.apply_inpainting_mask, region.x, region.y)
+        self.regions_done += 1
+        self.progress_fraction = self.regions_done / self.region_chunks
+
     def _process_response(self, resp):
-        super()._process_response(resp) # Calls Img2ImgCommand._process_response
-        if self.images:
-            sb.gimp.open_images(self.images)
-        elif self.layers:
-            sb.gimp.create_layers(self.img, self.layers, self.x, self.y, self.apply_inpainting_mask)
+        StableDiffusionCommand._process_response(self, resp) # Skips Img2ImgCommand, which would insert without the mask
+        self._insert_results(self.apply_inpainting_mask)
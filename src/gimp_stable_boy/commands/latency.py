@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gi
+gi.require_version('Gimp', '3.0')
+gi.require_version('GimpUi', '3.0')
+from gi.repository import Gimp, GimpUi, GLib
+
+import gimp_stable_boy as sb
+from gimp_stable_boy.latency_model import model as latency_model
+from ._command import StableBoyCommand
+
+
+class LatencyModelCommand(StableBoyCommand):
+    proc_name = "stable-boy-latency-model"
+    blurb = "Stable Boy " + sb.__version__ + " - Latency model"
+    help_text = "Shows how long requests are expected to take, as learned from previous requests"
+    menu_label = "Latency Model"
+    sensitivity_mask = Gimp.ProcedureSensitivityMask.ALWAYS
+
+    @classmethod
+    def add_arguments(cls, procedure):
+        procedure.add_boolean_argument("reset", "Forget all measured durations", False)
+
+    @classmethod
+    def run(cls, procedure, run_mode, image, n_drawables, drawables, args, data):
+        if run_mode == Gimp.RunMode.INTERACTIVE:
+            GimpUi.init(cls.proc_name)
+            dialog = GimpUi.ProcedureDialog(procedure)
+            if not dialog.run():
+                dialog.destroy()
+                return procedure.new_return_values(Gimp.PDBStatusType.CANCEL, GLib.Error())
+
+            config = dialog.get_config()
+            dialog.destroy()
+        else:
+            config = procedure.create_config()
+
+        if config.get_property('reset'):
+            latency_model.reset()
+        Gimp.message(latency_model.summary())
+
+        return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, GLib.Error())
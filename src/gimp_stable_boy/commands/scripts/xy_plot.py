@@ -16,51 +16,68 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import re
-import gimpfu
-from urlparse import urljoin
+import gi
+gi.require_version('Gimp', '3.0')
+from gi.repository import Gimp, GObject
+
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
 import gimp_stable_boy as sb
-from gimp_stable_boy.constants import PREFERENCES_SHELF_GROUP as PREFS
+from gimp_stable_boy import xy_grid, capabilities
+from gimp_stable_boy.scheduler import scheduler
 from .._command import StableBoyCommand, StableDiffusionCommand
-from ..text_to_image import Txt2ImgCommand
-from ..image_to_image import Img2ImgCommand
-from ..inpainting import InpaintingCommand
 
 
 class XyPlotCommand(StableDiffusionCommand):
-    uri = ''
-    metadata = StableDiffusionCommand.CommandMetadata(
-                    "stable-boy-xyplot", "Stable Boy " + sb.__version__ + " - X/Y plot",
-                    "Stable Diffusion plugin for AUTOMATIC1111's WebUI API", "Torben Giesselmann",
-                    "Torben Giesselmann", "2022", "<Image>/Stable Boy/Scripts/XY plot", "*",
-                    [
-                        (gimpfu.PF_OPTION, 'mode', 'Mode', 0, sb.constants.MODES),
-                        (gimpfu.PF_OPTION, 'x_type', 'X', 0, sb.constants.SCRIPT_XY_PLOT_AXIS_OPTIONS),
-                        (gimpfu.PF_STRING, 'x_values', 'X values', ''),
-                        (gimpfu.PF_OPTION, 'y_type', 'Y', 0, sb.constants.SCRIPT_XY_PLOT_AXIS_OPTIONS),
-                        (gimpfu.PF_STRING, 'y_values', 'Y values', ''),
-                        (gimpfu.PF_BOOL, 'draw_legend', 'Draw legend', True),
-                        (gimpfu.PF_BOOL, 'no_fixed_seeds', 'No fixed seeds', False),
-                        (gimpfu.PF_BOOL, 'grid_only', 'Grid only', True),
-                    ],
-                    [],)
-    mode_cmds = {'Text to Image': Txt2ImgCommand,
-                 'Image to Image': Img2ImgCommand,
-                 'Inpainting': InpaintingCommand,}
-
-    def __init__(self, **kwargs):
-        self.mode = sb.constants.MODES[kwargs['mode']]
-        # Update kwargs with values from mode's previously saved prefs
-        _mode_meta = self.mode_cmds[self.mode].metadata
-        prefs_keys = [param[1] for param in _mode_meta.params if param[1] not in ['image', 'drawable']]
-        for prefs_key in prefs_keys:
-            kwargs[prefs_key] = sb.gimp.pref_value(_mode_meta.proc_name, prefs_key)
-        
-        self.autofit_inpainting = kwargs.get('autofit_inpainting', False)
-        self.apply_inpainting_mask = kwargs.get('apply_inpainting_mask', False)
-        StableDiffusionCommand.__init__(self, **kwargs)
-        self.uri = 'sdapi/v1/txt2img/script' if self.mode == 'Text to Image' else 'sdapi/v1/img2img/script'
-        self.url = urljoin(sb.gimp.pref_value(PREFS, 'api_base_url', sb.constants.DEFAULT_API_URL), self.uri)
+    uri = 'sdapi/v1/txt2img'
+
+    proc_name = "stable-boy-xyplot"
+    blurb = "Stable Boy " + sb.__version__ + " - X/Y plot"
+    help_text = "Stable Diffusion plugin for AUTOMATIC1111's WebUI API"
+    menu_label = "X/Y plot"
+    menu_path = ["<Image>/Stable Boy/Scripts"]
+
+    mode_uris = {'Text to Image': 'sdapi/v1/txt2img',
+                 'Image to Image': 'sdapi/v1/img2img',
+                 'Inpainting': 'sdapi/v1/img2img',}
+
+    @classmethod
+    def add_arguments(cls, procedure):
+        procedure.add_argument_from_pdb("image", "pdb-gimp-image", "Input Image", "")
+        procedure.add_argument_from_pdb("drawable", "pdb-gimp-drawable", "Input Drawable", "")
+        procedure.add_enum_argument("mode", "Mode", 0, sb.constants.MODES)
+        procedure.add_string_argument("prompt", "Prompt", "", "")
+        procedure.add_string_argument("negative_prompt", "Negative prompt", "", "")
+        procedure.add_string_argument("seed", "Seed", "-1", "")
+        procedure.add_int_argument("steps", "Steps", 25, 1, 150)
+        procedure.add_enum_argument("sampler_index", "Sampler", 0, sb.constants.SAMPLERS)
+        procedure.add_boolean_argument("restore_faces", "Restore faces", False)
+        procedure.add_double_argument("cfg_scale", "CFG", 7.5, 0, 20)
+        procedure.add_double_argument("denoising_strength", "Denoising strength %", 50.0, 0, 100)
+        procedure.add_boolean_argument("autofit_inpainting", "Autofit inpainting region", True)
+        procedure.add_int_argument("mask_blur", "Mask blur", 4, 0, 32)
+        procedure.add_enum_argument("inpainting_fill", "Inpainting fill", 1, sb.constants.INPAINTING_FILL_MODE)
+        procedure.add_boolean_argument("inpaint_full_res", "Inpaint at full resolution", True)
+        procedure.add_int_argument("inpaint_full_res_padding", "Full res. inpainting padding", 0, 0, 256)
+        procedure.add_boolean_argument("apply_inpainting_mask", "Apply inpainting mask", True)
+        procedure.add_int_argument("num_images", "Images per cell", 1, 1, 4)
+        procedure.add_enum_argument("img_target", "Results as", 0, sb.constants.IMAGE_TARGETS)
+        procedure.add_enum_argument("x_type", "X", 0, sb.constants.SCRIPT_XY_PLOT_AXIS_OPTIONS)
+        procedure.add_string_argument("x_values", "X values", "", "")
+        procedure.add_enum_argument("y_type", "Y", 0, sb.constants.SCRIPT_XY_PLOT_AXIS_OPTIONS)
+        procedure.add_string_argument("y_values", "Y values", "", "")
+        procedure.add_boolean_argument("draw_legend", "Draw legend", True)
+        procedure.add_boolean_argument("no_fixed_seeds", "No fixed seeds", False)
+        procedure.add_boolean_argument("grid_only", "Grid only", True)
+
+    def __init__(self, image, config):
+        # Needed by _determine_active_area and _make_request_data, which run in super().__init__
+        self.mode = sb.constants.MODES[config.get_property('mode')]
+        self.uri = self.mode_uris[self.mode]
+        self.autofit_inpainting = self.mode == 'Inpainting' and config.get_property('autofit_inpainting')
+        self.apply_inpainting_mask = self.mode == 'Inpainting' and config.get_property('apply_inpainting_mask')
+        super().__init__(image, config)
 
     def _determine_active_area(self):
         if self.autofit_inpainting:
@@ -68,41 +85,106 @@ class XyPlotCommand(StableDiffusionCommand):
         else:
             return StableDiffusionCommand._determine_active_area(self)
 
-    def _make_request_data(self, **kwargs):
-        req_data = StableDiffusionCommand._make_request_data(self, **kwargs)
-        req_data['script_name'] = 'X/Y plot'
-        req_data['script_args'] = [
-            kwargs['x_type'], kwargs['x_values'], kwargs['y_type'], kwargs['y_values'], kwargs['draw_legend'],
-            not kwargs['grid_only'], kwargs['no_fixed_seeds']
-        ]
+    # Builds the request of the mode and expands it into one request per cell (see xy_grid.py).
+    def _make_request_data(self):
+        req_data = super()._make_request_data()
         if self.mode in ['Image to Image', 'Inpainting']:
-            req_data['denoising_strength'] = float(kwargs['denoising_strength']) / 100
-            req_data['init_images'] = [sb.gimp.encode_img(self.img, self.x, self.y, self.width, self.height)]
+            req_data['denoising_strength'] = float(self.config.get_property('denoising_strength')) / 100
+            req_data['init_images'] = [sb.gimp.encode_img(self.img, self.x, self.y, self.width, self.height,
+                                                          self.input_format)]
             if self.mode == 'Inpainting':
                 req_data['inpainting_mask_invert'] = 1
-                req_data['inpainting_fill'] = kwargs['inpainting_fill']
-                req_data['mask_blur'] = kwargs['mask_blur']
-                req_data['inpaint_full_res'] = kwargs['inpaint_full_res']
-                req_data['inpaint_full_res_padding'] = kwargs['inpaint_full_res_padding']
+                req_data['inpainting_fill'] = self.config.get_property('inpainting_fill')
+                req_data['mask_blur'] = self.config.get_property('mask_blur')
+                req_data['inpaint_full_res'] = self.config.get_property('inpaint_full_res')
+                req_data['inpaint_full_res_padding'] = self.config.get_property('inpaint_full_res_padding')
                 req_data['mask'] = sb.gimp.encode_mask(self.img, self.x, self.y, self.width, self.height)
+        self.x_axis = sb.constants.SCRIPT_XY_PLOT_AXIS_OPTIONS[self.config.get_property('x_type')]
+        self.y_axis = sb.constants.SCRIPT_XY_PLOT_AXIS_OPTIONS[self.config.get_property('y_type')]
+        self.x_labels, self.y_labels, self.cells = xy_grid.plan_cells(
+            req_data, self.x_axis, self.config.get_property('x_values'),
+            self.y_axis, self.config.get_property('y_values'), self.config.get_property('no_fixed_seeds'))
         return req_data
 
-    def _process_response(self, resp):
-        all_imgs = resp['images']
-        self.images = [all_imgs.pop(0)]  # grid is always a separate image
-        if self.req_data['script_args'][5] == False:  # grid only?
-            return
-        # Create layer structure with layer names based on X/Y values
-        x_label = sb.constants.SCRIPT_XY_PLOT_AXIS_OPTIONS[self.req_data['script_args'][0]]
-        y_label = sb.constants.SCRIPT_XY_PLOT_AXIS_OPTIONS[self.req_data['script_args'][2]]
-        LayerResult = StableBoyCommand.LayerResult
-        parent_layer_group = LayerResult("X/Y plot: " + x_label + " / " + y_label, None, [])
-        for y in re.split(r'\s*,\s*', self.req_data['script_args'][3]):
-            y_layer_group = LayerResult(y_label + ': ' + str(y), None, [])
-            for x in re.split(r'\s*,\s*', self.req_data['script_args'][1]):
-                y_layer_group.children.insert(0, LayerResult(x_label + ': ' + str(x) + ' / ' + y_label + ': ' + str(y), all_imgs.pop(0), None))
-            parent_layer_group.children.insert(0, y_layer_group)
-        self.layers = [parent_layer_group]
-
-    def _estimate_timeout(self, req_data):
-        return 300
\ No newline at end of file
+    # Cells are sent to all backends at once, two per backend. Each image is added to the grid (the
+    # first one of each cell) and as a layer as soon as it arrives. Cells that are done stay in the
+    # grid and the image, even if other cells fail.
+    # Switching checkpoints takes long, so with a checkpoint axis the cells are grouped by checkpoint
+    # instead (see xy_grid.checkpoint_groups): each group is sent one cell after the other, to the
+    # same backend, and the groups are sent to all backends at once.
+    def _send_requests(self, stream):
+        self.grid_only = self.config.get_property('grid_only')
+        self.layout = xy_grid.grid_layout(self.width, self.height, len(self.x_labels), len(self.y_labels),
+                                          self.config.get_property('draw_legend'), self.x_labels, self.y_labels)
+        self.cell_images = {}  # cell index -> number of images received
+        self.images_done = 0
+        self.row_layers = {}  # row -> (column, image number) of the layers in the row's group
+        self._run_in_main_thread(self._new_grid)
+        if not self.grid_only and self.img_target == 'Layers':
+            self._run_in_main_thread(self._new_layer_groups)
+        try:
+            if 'Checkpoint name' in (self.x_axis, self.y_axis):
+                models = capabilities.cache.models(backend.url for backend in scheduler.backends)
+                if models:
+                    xy_grid.resolve_checkpoints(self.cells, models)
+                groups = xy_grid.checkpoint_groups(self.cells)
+                with ThreadPoolExecutor(max_workers=max(1, min(len(groups), len(scheduler.backends)))) as executor:
+                    for future in [executor.submit(self._send_group, group, stream) for group in groups]:
+                        future.result()
+            else:
+                requests = [(cell.req_data, partial(self._add_cell, cell)) for cell in self.cells]
+                self._send_all(requests, stream, max_workers=2 * len(scheduler.backends))
+        finally:
+            self._run_in_main_thread(self._merge_grid)
+
+    def _send_group(self, cells, stream):
+        backend = None
+        for cell in cells:
+            backend = self._send(cell.req_data, partial(self._add_cell, cell), stream, prefer=backend) or backend
+
+    def _new_grid(self):
+        self.grid, self.grid_group = sb.gimp.new_grid_canvas(self.layout, self.width, self.height,
+                                                              self.x_labels, self.y_labels)
+
+    def _merge_grid(self):
+        sb.gimp.merge_tiles(self.grid, self.grid_group, "Grid")
+
+    # Layer groups: one for the plot, in it one per row, first row at the top
+    def _new_layer_groups(self):
+        plot_group = sb.gimp.new_layer_group(self.img, "X/Y plot: " + self.x_axis + " / " + self.y_axis)
+        self.row_groups = [sb.gimp.new_layer_group(self.img, label or "Cells", plot_group, row)
+                           for row, label in enumerate(self.y_labels)]
+
+    # Called with each image of a cell (or all of them, if not streaming). The images are decoded right
+    # away and added in the main thread.
+    def _add_cell(self, cell, resp):
+        for image in resp['images']:
+            number = self.cell_images.get(cell.index, 0)
+            self.cell_images[cell.index] = number + 1
+            if not self.grid_only and self.img_target == 'Files':
+                self._save_images([image])
+            decoded = sb.gimp.decode_async(image)
+            if number == 0:
+                self._insert_in_main_thread(self._insert_grid_cell, cell, decoded)
+            if not self.grid_only and self.img_target == 'Layers':
+                self._insert_in_main_thread(self._insert_cell_layer, cell, number, decoded)
+            elif not self.grid_only and self.img_target == 'Images':
+                self._insert_in_main_thread(sb.gimp.open_images, [decoded])
+            self.images_done += 1
+            self.progress_fraction = self.images_done / (len(self.cells) * int(self.req_data['batch_size']))
+
+    def _insert_grid_cell(self, cell, image):
+        sb.gimp.add_tile(self.grid, self.grid_group, image, self.layout.left + cell.col * self.width,
+                         self.layout.top + cell.row * self.height, 0, 0)
+
+    # Layers are kept in the order of the columns, no matter in which order they arrive
+    def _insert_cell_layer(self, cell, number, image):
+        name = ' / '.join(label for label in (cell.x_label, cell.y_label) if label) or 'Cell'
+        if number:
+            name += ' #' + str(number + 1)
+        row_layers = self.row_layers.setdefault(cell.row, [])
+        position = sum(1 for key in row_layers if key < (cell.col, number))
+        row_layers.append((cell.col, number))
+        sb.gimp.create_layers(self.img, [StableBoyCommand.LayerResult(name, image, None)], self.x, self.y,
+                              self._clip_mask(self.x, self.y) if self.apply_inpainting_mask else None,
+                              parent=self.row_groups[cell.row], position=position)
@@ -26,6 +26,7 @@ from ._command import StableDiffusionCommand
 
 class Txt2ImgCommand(StableDiffusionCommand):
     uri = 'sdapi/v1/txt2img'
+    live_preview_supported = True
 
     proc_name = "stable-boy-txt2img"
     blurb = "Stable Boy " + sb.__version__ + " - Text to Image"
@@ -44,8 +45,9 @@ class Txt2ImgCommand(StableDiffusionCommand):
         procedure.add_enum_argument("sampler_index", "Sampler", 0, sb.constants.SAMPLERS)
         procedure.add_boolean_argument("restore_faces", "Restore faces", False)
         procedure.add_double_argument("cfg_scale", "CFG", 7.5, 0, 20) # Min, Max
-        procedure.add_int_argument("num_images", "Number of images", 1, 1, 4) # Min, Max
+        procedure.add_int_argument("num_images", "Number of images", 1, 1, 1000) # Min, Max
         procedure.add_enum_argument("img_target", "Results as", 0, sb.constants.IMAGE_TARGETS)
+        procedure.add_boolean_argument("live_preview", "Live preview", False)
 
     def _make_request_data(self):
         data = super()._make_request_data()
@@ -54,7 +56,4 @@ class Txt2ImgCommand(StableDiffusionCommand):
 
     def _process_response(self, resp):
         super()._process_response(resp)
-        if self.images:
-            sb.gimp.open_images(self.images)
-        elif self.layers:
-            sb.gimp.create_layers(self.img, self.layers, self.x, self.y)
+        self._insert_results()
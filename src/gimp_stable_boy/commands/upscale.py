@@ -20,7 +20,11 @@ import gi
 gi.require_version('Gimp', '3.0')
 from gi.repository import Gimp, GObject
 
+from functools import partial
+
 import gimp_stable_boy as sb
+from gimp_stable_boy.tiling import plan_tiles
+from gimp_stable_boy.scheduler import scheduler
 from ._command import StableDiffusionCommand
 
 
@@ -40,20 +44,67 @@ class UpscaleCommand(StableDiffusionCommand):
         procedure.add_enum_argument("upscaler_1", "Upscaler 1", 0, sb.constants.UPSCALERS)
         procedure.add_enum_argument("upscaler_2", "Upscaler 2", 0, sb.constants.UPSCALERS)
         procedure.add_double_argument("extras_upscaler_2_visibility", "Upscaler 2 visibility", 0, 0, 1)
+        procedure.add_boolean_argument("tiled", "Upscale in tiles", False)
+        procedure.add_int_argument("tile_size", "Tile size", 512, 128, 2048)
+        procedure.add_int_argument("tile_overlap", "Tile overlap", 64, 0, 256)
 
     def _make_request_data(self):
-        return {
+        req_data = {
             'upscaling_resize': int(self.config.get_property('upscaling_resize')),
             'upscaler_1': sb.constants.UPSCALERS[self.config.get_property('upscaler_1')],
             'upscaler_2': sb.constants.UPSCALERS[self.config.get_property('upscaler_2')],
             'extras_upscaler_2_visibility': self.config.get_property('extras_upscaler_2_visibility'),
-            'image': sb.gimp.encode_img(self.img, self.x, self.y, self.width, self.height),
         }
+        # Large regions are split into overlapping tiles that are upscaled in parallel. The tiles
+        # are encoded here, in the main thread, like the whole region would be.
+        self.tile_requests = []
+        if self.config.get_property('tiled'):
+            tiles = plan_tiles(self.width, self.height,
+                               int(self.config.get_property('tile_size')),
+                               int(self.config.get_property('tile_overlap')))
+            if len(tiles) > 1:
+                for tile in tiles:
+                    tile_image = sb.gimp.encode_img(self.img, self.x + tile.x, self.y + tile.y, tile.width, tile.height,
+                                                     self.input_format)
+                    self.tile_requests.append((tile, dict(req_data, image=tile_image)))
+                return req_data
+        req_data['image'] = sb.gimp.encode_img(self.img, self.x, self.y, self.width, self.height, self.input_format)
+        return req_data
+
+    # Tiles are sent to all backends at once, two per backend so that each backend has the next
+    # tile queued while it's working on the current one. Finished tiles are added to the result
+    # right away, the seams are blended with layer masks.
+    def _send_requests(self, stream):
+        if not self.tile_requests:
+            return super()._send_requests(stream)
+        scale = int(self.req_data['upscaling_resize'])
+        self.tiles_done = []
+        self._run_in_main_thread(self._new_tile_canvas, self.width * scale, self.height * scale)
+        requests = [(req_data, partial(self._add_tile, tile, scale)) for tile, req_data in self.tile_requests]
+        self._send_all(requests, stream, max_workers=2 * len(scheduler.backends))
+        self._run_in_main_thread(self._merge_tiles)
+
+    def _new_tile_canvas(self, width, height):
+        self.canvas, self.tile_group = sb.gimp.new_tile_canvas(width, height)
+
+    def _merge_tiles(self):
+        sb.gimp.merge_tiles(self.canvas, self.tile_group)
+
+    # Called with the response for one tile. The tile is decoded right away and added in the main thread.
+    def _add_tile(self, tile, scale, resp):
+        self._insert_in_main_thread(self._insert_tile, tile, scale, sb.gimp.decode_async(resp['image']))
+
+    def _insert_tile(self, tile, scale, image):
+        position = sum(1 for index in self.tiles_done if index > tile.index)
+        sb.gimp.add_tile(self.canvas, self.tile_group, image, tile.x * scale, tile.y * scale,
+                         tile.fade_left * scale, tile.fade_top * scale, position)
+        self.tiles_done.append(tile.index)
+        self.progress_fraction = len(self.tiles_done) / len(self.tile_requests)
 
+    # Fallback for _request_timeout
     def _estimate_timeout(self, req_data):
-        return (60 if float(req_data['extras_upscaler_2_visibility']) > 0 else 30) * sb.config.TIMEOUT_FACTOR
+        return (60 if float(req_data['extras_upscaler_2_visibility']) > 0 else 30) * sb.config.Config.TIMEOUT_FACTOR
 
     def _process_response(self, resp):
         self.images = [resp['image']]
-        if self.images:
-            sb.gimp.open_images(self.images)
\ No newline at end of file
+        self._insert_results()
\ No newline at end of file
@@ -1,5 +1,60 @@
+import os
+
+
 class Config:
     LOG_REQUESTS = False
+    # Limits of the request log (see request_log.py): records waiting to be written (logging waits
+    # while the queue is full), and the size and age in days of the log files and images on disk
+    REQUEST_LOG_QUEUE_SIZE = 32
+    REQUEST_LOG_MAX_BYTES = 1024 * 1024 * 1024
+    REQUEST_LOG_MAX_DAYS = 30
     TIMEOUT_REQUESTS = False
     TIMEOUT_FACTOR = 1
-    ENABLE_SCRIPTS = True
\ No newline at end of file
+    ENABLE_SCRIPTS = True
+    # Additional WebUI instances. Requests (and the images of a batch) are spread
+    # across these and the API URL from the preferences (see scheduler.py).
+    API_BASE_URLS = []
+    # Keep-alive connections to the API (see http_pool.py)
+    MAX_IDLE_CONNECTIONS = 4  # per backend
+    CONNECTION_IDLE_TIMEOUT = 30  # seconds
+    # Location of the plugin's on-disk caches
+    CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gimp_stable_boy')
+    # Replay results of requests with a fixed seed from disk (see result_cache.py).
+    # Set to False to always send requests to the API.
+    CACHE_RESULTS = True
+    RESULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+    # Results are only replayed for backends with the same settings (checkpoint, VAE, ...) as when they
+    # were made. Seconds until a backend's settings are fetched again.
+    SERVER_OPTIONS_TTL = 10
+    # Reuse encodings of unchanged init image and mask regions (see region_cache.py)
+    CACHE_ENCODED_REGIONS = True
+    REGION_CACHE_MAX_BYTES = 128 * 1024 * 1024
+    # Remember which module defines which command (see registry.py), so that the plugin
+    # doesn't have to import all commands whenever GIMP starts it
+    CACHE_COMMAND_MANIFEST = True
+    # Minimum width and height of the windows around separately inpainted mask regions
+    INPAINTING_REGION_MIN_SIZE = 512
+    # Record how long each phase of a command takes and write a Chrome trace file to
+    # CACHE_DIR/traces after each command (see tracing.py)
+    TRACE = False
+    # Seconds until the samplers, upscalers, models and scripts reported by a backend are fetched
+    # again. Requests asking for ones a backend doesn't have aren't sent to it (see capabilities.py).
+    CAPABILITIES_TTL = 60 * 60
+    # Seconds between updates of the live preview layer, for commands run with "Live preview".
+    # WebUI's "Show live previews" setting must be on.
+    LIVE_PREVIEW_INTERVAL = 1.0
+    # Seconds that requests of a cancelled command get to return what the backends have made so far
+    # (WebUI's interrupt) before their connections are closed
+    CANCEL_GRACE_PERIOD = 5.0
+    # Images generated per request, at most. Larger batches are split into requests of this size,
+    # which are pipelined (see StableDiffusionCommand._send_requests).
+    MAX_IMAGES_PER_REQUEST = 4
+    # Where results are saved when "Results as" is "Files", in a new folder for each run
+    OUTPUT_DIR = os.path.join(os.path.expanduser('~'), 'Pictures', 'Stable Boy')
+    # How init images are sent to the API (see codec.encode_image): ('png', compression level 0-9),
+    # ('jpeg', quality 0-100) or ('webp', quality 0-100). Lossy formats are several times smaller, which
+    # speeds up requests over slow links, and matter little when most pixels get repainted (high
+    # denoising strengths) or upscaled. INPUT_FORMATS overrides INPUT_FORMAT per command, e.g.
+    # {'stable-boy-upscale': ('jpeg', 90)}. Masks are always PNG, and so are regions with transparency.
+    INPUT_FORMAT = ('png', 6)
+    INPUT_FORMATS = {}
@@ -2,7 +2,7 @@ DEFAULT_API_URL = 'http://localhost:7860'
 
 MASK_LAYER_NAME = 'Inpainting Mask'
 
-IMAGE_TARGETS = ['Layers', 'Images']
+IMAGE_TARGETS = ['Layers', 'Images', 'Files']
 
 MODES = ['Text to Image', 'Image to Image', 'Inpainting']
 
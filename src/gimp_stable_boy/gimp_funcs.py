@@ -2,6 +2,7 @@ import os
 import tempfile
 import base64
 import math
+from concurrent.futures import ThreadPoolExecutor, Future
 
 import gi
 gi.require_version('Gimp', '3.0')
@@ -9,6 +10,12 @@ gi.require_version('Gegl', '0.4')
 from gi.repository import Gimp, Gio, GLib, Gegl
 
 import gimp_stable_boy.constants as constants
+import gimp_stable_boy.codec as codec
+import gimp_stable_boy.tiling as tiling
+import gimp_stable_boy.regions as regions
+import gimp_stable_boy.tracing as tracing
+from gimp_stable_boy.config import Config as config
+from gimp_stable_boy.region_cache import cache as region_cache
 # from gimpshelf import shelf # gimp-python gimpshelf is not available for GIMP 3
 
 # TODO: Replace gimpshelf with Gimp.Parasite or GApplicationSettings
@@ -27,13 +34,147 @@ def pref_value(group_name, key_name, default=None):
 
 def encode_png(img_path):
     with open(img_path, "rb") as img:
-        return 'data:image/png;base64,' + str(base64.b64encode(img.read()))
+        return codec.EncodedImage(img.read())
+
+# This function reads the raw pixels of a region straight from a drawable's pixel buffer.
+def read_pixels(drawable, x, y, width, height, pixel_format="R'G'B'A u8"):
+    buffer = drawable.get_buffer()
+    rect = Gegl.Rectangle.new(x, y, width, height)
+    return buffer.get(rect, 1.0, pixel_format, Gegl.AbyssPolicy.NONE)
+
+# This function encodes a drawable in memory, without a temp file, in the image_format given as for
+# codec.encode_image.
+def encode_drawable(drawable, pixel_format="R'G'B'A u8", channels=4, image_format=('png', 6)):
+    width, height = drawable.get_width(), drawable.get_height()
+    pixels = read_pixels(drawable, 0, 0, width, height, pixel_format)
+    return codec.encode_image(pixels, width, height, channels, image_format)
+
+# This function saves an image to a temporary PNG file and returns the base64-encoded string.
+# It's only used as a fallback if the in-memory encoding path fails.
+@tracing.traced('gimp.encode_via_file')
+def _encode_via_file(image):
+    img_path = os.path.join(tempfile.gettempdir(), tempfile.mktemp(suffix='.png'))
+
+    file_obj = Gio.File.new_for_path(img_path)
+    save_proc = Gimp.get_pdb().lookup_procedure("file-png-save")
+    if not save_proc:
+        print("Error: Could not find 'file-png-save' procedure.")
+        return None
+    config = save_proc.create_config()
+    config.set_property("image", image)
+    config.set_property("drawable", image.get_active_layer())
+    config.set_property("filename", img_path)
+    save_proc.run(config)
+
+    encoded_img = encode_png(img_path)
+    os.remove(img_path)
+    return encoded_img
 
-# This function encodes an image to a base64 string.
+# This function encodes the (single layer) image, preferring the in-memory path. The temp file is always PNG.
+def _encode_image(image, pixel_format="R'G'B'A u8", channels=4, image_format=('png', 6)):
+    try:
+        return encode_drawable(image.get_layers()[0], pixel_format, channels, image_format)
+    except Exception as e:
+        print(f"In-memory encoding failed ({e}), falling back to temp file.")
+        return _encode_via_file(image)
+
+# This function reads the visible composite of a region, leaving out the inpainting mask layer.
+# Only the region itself is read or copied; the image is never duplicated, so cost
+# depends on the region size rather than the size of the document.
+@tracing.traced('gimp.extract_region')
+def extract_region(img, x, y, width, height):
+    visible_layers = [layer for layer in img.get_layers()
+                      if layer.get_visible() and layer.get_name() != constants.MASK_LAYER_NAME]
+    if len(visible_layers) == 1 and _is_plain_layer(visible_layers[0]):
+        return _read_layer_region(visible_layers[0], x, y, width, height)
+    return _copy_visible_region(img, x, y, width, height)
+
+# A layer is "plain" if its pixels are what ends up in the composite.
+def _is_plain_layer(layer):
+    return not layer.is_group() and not layer.get_mask() and layer.get_opacity() >= 100.0 \
+        and layer.get_mode() == Gimp.LayerMode.NORMAL
+
+# This function reads a region given in image coordinates from a layer. Pixels outside the layer are transparent.
+def _read_layer_region(layer, x, y, width, height, pixel_format="R'G'B'A u8"):
+    _, off_x, off_y = layer.get_offsets()
+    return read_pixels(layer, x - off_x, y - off_y, width, height, pixel_format)
+
+# This function copies the visible region into a named buffer (leaving the clipboard alone) and reads its pixels.
+# The mask layer is hidden and the user's selection is restored afterwards, without leaving undo steps behind.
+def _copy_visible_region(img, x, y, width, height):
+    mask_layer = img.get_layer_by_name(constants.MASK_LAYER_NAME)
+    hide_mask = mask_layer is not None and mask_layer.get_visible()
+    img.undo_freeze()
+    saved_selection = Gimp.Selection.save(img)
+    try:
+        if hide_mask:
+            mask_layer.set_visible(False)
+        img.select_rectangle(Gimp.ChannelOps.REPLACE, x, y, width, height)
+        buffer_name = Gimp.edit_named_copy_visible(img, "stable-boy-region")
+        if not buffer_name:
+            raise Exception("Couldn't copy the visible region")
+        region_img = Gimp.edit_named_paste_as_new_image(buffer_name)
+        try:
+            return read_pixels(region_img.get_layers()[0], 0, 0, width, height)
+        finally:
+            region_img.delete()
+            Gimp.buffer_delete(buffer_name)
+    finally:
+        if hide_mask:
+            mask_layer.set_visible(True)
+        img.select_item(Gimp.ChannelOps.REPLACE, saved_selection)
+        img.remove_channel(saved_selection)
+        img.undo_thaw()
+
+# This function reads the inpainting mask's region as 8-bit grayscale, flattened over white like in GIMP.
+@tracing.traced('gimp.extract_mask_region')
+def extract_mask_region(img, x, y, width, height):
+    mask_layer = img.get_layer_by_name(constants.MASK_LAYER_NAME)
+    if not mask_layer:
+        raise Exception("Couldn't find layer named '" + constants.MASK_LAYER_NAME + "'")
+    if not mask_layer.has_alpha():
+        return _read_layer_region(mask_layer, x, y, width, height, "Y' u8")
+    return codec.flatten_gray_alpha(_read_layer_region(mask_layer, x, y, width, height, "Y'A u8"))
+
+# This function encodes the visible region (without the inpainting mask) as a codec.EncodedImage, in the
+# image_format given as for codec.encode_image (default: Config.INPUT_FORMAT).
+def encode_img(img, x, y, width, height, image_format=None):
+    try:
+        pixels = extract_region(img, x, y, width, height)
+    except Exception as e:
+        print(f"Region extraction failed ({e}), falling back to copying the image.")
+        return _encode_img_from_copy(img, x, y, width, height, image_format or config.INPUT_FORMAT)
+    return _encode_region(pixels, width, height, 4, image_format or config.INPUT_FORMAT)
+
+# Init images and masks are encoded in these threads, so that the main thread only has to read the pixels
+ENCODE_THREADS = min(4, os.cpu_count() or 1)
+_encode_pool = None
+
+# This function encodes region pixels in a worker thread. It returns a codec.EncodedImage right away,
+# whose data is there once the encoding is done. Regions of a command (tiles, X/Y plot cells, batch
+# jobs) are thus encoded in parallel, and while other requests are already being sent.
+def _encode_region(pixels, width, height, channels, image_format=('png', 6)):
+    global _encode_pool
+    if _encode_pool is None:
+        _encode_pool = ThreadPoolExecutor(max_workers=ENCODE_THREADS, thread_name_prefix='encode')
+    return codec.EncodedImage(_encode_pool.submit(_encode_region_now, pixels, width, height, channels, image_format))
+
+# Unchanged regions are served from the region cache
+def _encode_region_now(pixels, width, height, channels, image_format):
+    with tracing.span('encode.' + image_format[0], width=width, height=height, bytes_in=len(pixels)) as span:
+        if config.CACHE_ENCODED_REGIONS:
+            encoded = region_cache.encode(pixels, width, height, channels, image_format)
+        else:
+            encoded = codec.encode_image(pixels, width, height, channels, image_format)
+        span.set(bytes_out=len(encoded))
+    return encoded
+
+# This function is the fallback for encode_img.
 # It first duplicates the image, removes the mask layer, and selects the active area.
 # Then, it copies the visible layers and pastes them as a new image.
-# Finally, it saves the new image as a PNG file and returns the base64-encoded string.
-def encode_img(img, x, y, width, height):
+# Finally, it encodes the new image in memory, in the given image_format, and returns the base64-encoded string.
+@tracing.traced('gimp.encode_img_from_copy')
+def _encode_img_from_copy(img, x, y, width, height, image_format=('png', 6)):
     img_cpy = img.duplicate()
     inp_layer = img_cpy.get_layer_by_name(constants.MASK_LAYER_NAME)
     if inp_layer:
@@ -51,24 +192,7 @@ def encode_img(img, x, y, width, height):
         img_cpy.delete()
         return None
 
-    img_flat_path = os.path.join(tempfile.gettempdir(), tempfile.mktemp(suffix='.png'))
-
-    file_obj = Gio.File.new_for_path(img_flat_path)
-    save_proc = Gimp.get_pdb().lookup_procedure("file-png-save")
-    if save_proc:
-        config = save_proc.create_config()
-        config.set_property("image", temp_image)
-        config.set_property("drawable", temp_image.get_active_layer())
-        config.set_property("filename", img_flat_path)
-        save_proc.run(config)
-    else:
-        print("Error: Could not find 'file-png-save' procedure.")
-        temp_image.delete()
-        img_cpy.delete()
-        return None
-
-    encoded_img = encode_png(img_flat_path)
-    os.remove(img_flat_path)
+    encoded_img = _encode_image(temp_image, image_format=image_format)
     temp_image.delete()
     img_cpy.delete()
     return encoded_img
@@ -117,8 +241,35 @@ def autofit_inpainting_area(img):
         y = 0
     return int(x), int(y), int(target_width), int(target_height)
 
-# This function encodes the inpainting mask to a base64 string.
+# This function finds the separate regions of the inpainting mask and returns a window (64-aligned,
+# at least min_size pixels per side) around each, in image coordinates, or none if the mask can't be
+# split up (see regions.find_regions).
+@tracing.traced('gimp.inpainting_regions')
+def inpainting_regions(img, min_size=512):
+    mask_layer = img.get_layer_by_name(constants.MASK_LAYER_NAME)
+    if not mask_layer:
+        raise Exception("Couldn't find layer named '" + constants.MASK_LAYER_NAME + "'")
+    non_empty, mask_x1, mask_y1, mask_x2, mask_y2 = mask_layer.mask_bounds()
+    if not non_empty:
+        raise Exception("Inpainting mask is empty.")
+    width, height = mask_x2 - mask_x1, mask_y2 - mask_y1
+    mask = extract_mask_region(img, mask_x1, mask_y1, width, height)
+    return regions.find_regions(mask, width, height, min_size=min_size, origin=(mask_x1, mask_y1),
+                                bounds=(img.get_width(), img.get_height()))
+
+# This function encodes the inpainting mask as a codec.EncodedImage. Masks are always PNG: lossy
+# compression would blur their edges.
 def encode_mask(img, x, y, width, height):
+    try:
+        pixels = extract_mask_region(img, x, y, width, height)
+    except Exception as e:
+        print(f"Mask extraction failed ({e}), falling back to copying the image.")
+        return _encode_mask_from_copy(img, x, y, width, height)
+    return _encode_region(pixels, width, height, 1)
+
+# This function is the fallback for encode_mask. It duplicates the image and copies the visible mask layer.
+@tracing.traced('gimp.encode_mask_from_copy')
+def _encode_mask_from_copy(img, x, y, width, height):
     mask_layer = img.get_layer_by_name(constants.MASK_LAYER_NAME)
     if not mask_layer:
         raise Exception("Couldn't find layer named '" + constants.MASK_LAYER_NAME + "'")
@@ -147,24 +298,8 @@ def encode_mask(img, x, y, width, height):
         mask_img.delete()
         return None
 
-    mask_img_path = os.path.join(tempfile.gettempdir(), tempfile.mktemp(suffix='.png'))
-
-    file_obj = Gio.File.new_for_path(mask_img_path)
-    save_proc = Gimp.get_pdb().lookup_procedure("file-png-save")
-    if save_proc:
-        config = save_proc.create_config()
-        config.set_property("image", mask_img)
-        config.set_property("drawable", mask_img.get_active_layer())
-        config.set_property("filename", mask_img_path)
-        save_proc.run(config)
-    else:
-        print("Error: Could not find 'file-png-save' procedure.")
-        img_cpy.delete()
-        mask_img.delete()
-        return None
-
-    encoded_mask = encode_png(mask_img_path)
-    os.remove(mask_img_path)
+    # The flattened mask is encoded as single channel grayscale PNG
+    encoded_mask = _encode_image(mask_img, "Y' u8", 1)
     img_cpy.delete()
     mask_img.delete()
     return encoded_mask
@@ -180,74 +315,316 @@ def decode_png(encoded_png):
         png_img_file.write(base64.b64decode(base64_data))
     return png_img_path
 
-# This function opens a list of base64-encoded images in GIMP.
+# Results are decoded in these threads, so that the main thread only has to insert them
+DECODE_THREADS = min(4, os.cpu_count() or 1)
+_decode_pool = None
+
+# This function decodes a base64-encoded PNG in a worker thread. The future's result is a
+# codec.DecodedImage, or the encoded image itself if it couldn't be decoded, so that it can still
+# be loaded through a file.
+def decode_async(encoded_png):
+    global _decode_pool
+    if _decode_pool is None:
+        _decode_pool = ThreadPoolExecutor(max_workers=DECODE_THREADS, thread_name_prefix='decode')
+    return _decode_pool.submit(_decode_or_keep, encoded_png)
+
+def _decode_or_keep(encoded_png):
+    try:
+        with tracing.span('decode.png', bytes_in=len(encoded_png)) as span:
+            decoded = codec.decode_png(codec.decode_base64(encoded_png))
+            span.set(bytes_out=len(decoded.pixels), width=decoded.width, height=decoded.height)
+        return decoded
+    except Exception as e:
+        print(f"Couldn't decode image in memory ({e}), loading it from a file instead.")
+        return encoded_png
+
+# This function starts decoding all images of a (nested) list of layer results. The images of the
+# returned layer results are futures.
+def decode_layers(layers_data):
+    return [layer_item._replace(img=decode_async(layer_item.img) if layer_item.img else None,
+                                children=decode_layers(layer_item.children) if layer_item.children else layer_item.children)
+            for layer_item in layers_data]
+
+# Images passed to the functions below are base64-encoded PNGs, codec.DecodedImages or futures of either.
+def _resolve(image_data):
+    if isinstance(image_data, Future):
+        image_data = image_data.result()
+    if isinstance(image_data, str):
+        image_data = _decode_or_keep(image_data)
+    return image_data
+
+# This function creates a layer from decoded pixels by writing them straight into the layer's buffer.
+@tracing.traced('gimp.new_layer')
+def _new_layer(img, name, decoded):
+    if decoded.channels == 4:
+        image_type, pixel_format = Gimp.ImageType.RGBA_IMAGE, "R'G'B'A u8"
+    else:
+        image_type, pixel_format = Gimp.ImageType.RGB_IMAGE, "R'G'B' u8"
+    layer = Gimp.Layer.new(img, name, decoded.width, decoded.height, image_type, 100.0, Gimp.LayerMode.NORMAL)
+    buffer = layer.get_buffer()
+    buffer.set(Gegl.Rectangle.new(0, 0, decoded.width, decoded.height), pixel_format, decoded.pixels)
+    buffer.flush()
+    return layer
+
+# This function opens a list of images in GIMP.
+@tracing.traced('gimp.open_images')
 def open_images(images_data):
     if not images_data:
         return
-    for encoded_img in images_data:
-        tmp_png_path = decode_png(encoded_img)
-
-        file_obj = Gio.File.new_for_path(tmp_png_path)
-        load_proc = Gimp.get_pdb().lookup_procedure("gimp-file-load")
-        if load_proc:
-            config = load_proc.create_config()
-            config.set_property("uri", file_obj.get_uri())
-            loaded_image_collection = load_proc.run(config)
-            if loaded_image_collection.length() > 0:
-                 loaded_image = loaded_image_collection.index(0).get_object()
-                 Gimp.Display.new(loaded_image)
-            else:
-                print(f"Error loading image from {tmp_png_path}")
+    for image_data in images_data:
+        decoded = _resolve(image_data)
+        if isinstance(decoded, str):
+            _open_image_file(decoded)
+            continue
+        image = Gimp.Image.new(decoded.width, decoded.height, Gimp.ImageBaseType.RGB)
+        image.insert_layer(_new_layer(image, "Background", decoded), None, 0)
+        Gimp.Display.new(image)
+
+# This function is the fallback for open_images. It opens a base64-encoded image through a temporary file.
+@tracing.traced('gimp.open_image_file')
+def _open_image_file(encoded_img):
+    tmp_png_path = decode_png(encoded_img)
+
+    file_obj = Gio.File.new_for_path(tmp_png_path)
+    load_proc = Gimp.get_pdb().lookup_procedure("gimp-file-load")
+    if load_proc:
+        config = load_proc.create_config()
+        config.set_property("uri", file_obj.get_uri())
+        loaded_image_collection = load_proc.run(config)
+        if loaded_image_collection.length() > 0:
+             loaded_image = loaded_image_collection.index(0).get_object()
+             Gimp.Display.new(loaded_image)
         else:
-            print("Error: Could not find 'gimp-file-load' procedure.")
-
+            print(f"Error loading image from {tmp_png_path}")
+    else:
+        print("Error: Could not find 'gimp-file-load' procedure.")
+
+    os.remove(tmp_png_path)
+
+# This function creates a new layer of img from an image. The layer isn't inserted yet.
+def _load_layer(img, image_data):
+    decoded = _resolve(image_data)
+    if isinstance(decoded, str):
+        return _load_layer_file(img, decoded)
+    return _new_layer(img, "", decoded)
+
+# This function is the fallback for _load_layer. It loads a base64-encoded image through a temporary file.
+@tracing.traced('gimp.load_layer_file')
+def _load_layer_file(img, encoded_png):
+    tmp_png_path = decode_png(encoded_png)
+    try:
+        file_obj = Gio.File.new_for_path(tmp_png_path)
+        load_layer_proc = Gimp.get_pdb().lookup_procedure("gimp-file-load-layer")
+        if not load_layer_proc:
+            print("Error: Could not find 'gimp-file-load-layer' procedure.")
+            return None
+        config = load_layer_proc.create_config()
+        config.set_property("image", img)
+        config.set_property("uri", file_obj.get_uri())
+        loaded_layers_collection = load_layer_proc.run(config)
+        if loaded_layers_collection.length() == 0:
+            print(f"Error loading layer from {tmp_png_path}")
+            return None
+        return loaded_layers_collection.index(0).get_object()
+    finally:
         os.remove(tmp_png_path)
 
-# This function creates new layers in the image from a list of base64-encoded images.
-def create_layers(img, layers_data, x, y, apply_inpainting_mask=False):
+# This function returns the area covered by the inpainting mask as 8-bit gray pixels for a region,
+# i.e. the alpha channel of the mask layer. A mask layer without alpha covers everything.
+def inpainting_clip_mask(img, x, y, width, height):
+    mask_layer = img.get_layer_by_name(constants.MASK_LAYER_NAME)
+    if not mask_layer:
+        raise Exception("Couldn't find layer named '" + constants.MASK_LAYER_NAME + "'")
+    if not mask_layer.has_alpha():
+        return b'\xff' * (width * height)
+    return bytes(_read_layer_region(mask_layer, x, y, width, height, "Y'A u8")[1::2])
+
+# This function adds a layer mask to a layer and fills it with 8-bit gray pixels.
+def _set_layer_mask(layer, pixels):
+    width, height = layer.get_width(), layer.get_height()
+    mask = layer.create_mask(Gimp.AddMaskType.WHITE)
+    layer.add_mask(mask)
+    buffer = mask.get_buffer()
+    buffer.set(Gegl.Rectangle.new(0, 0, width, height), "Y u8", pixels)
+    buffer.flush()
+    mask.update(0, 0, width, height)
+
+# The inpainting mask at x, y as layer mask pixels, for the results of a command. Each size is read
+# once (see inpainting_clip_mask), on first use, and reused for every later result: commands keep one
+# of these for all batches. Must be used in the main thread.
+class ClipMask:
+
+    def __init__(self, img, x, y):
+        self.img, self.x, self.y = img, x, y
+        self._pixels = {}  # (width, height) -> mask pixels
+
+    def pixels(self, width, height):
+        if (width, height) not in self._pixels:
+            self._pixels[width, height] = inpainting_clip_mask(self.img, self.x, self.y, width, height)
+        return self._pixels[width, height]
+
+# This function creates new layers in the image from a list of layer results, at the top of the image
+# or at position in a layer group (parent).
+# With a clip_mask (a ClipMask), each layer only shows the inpainted area: it's added to every layer
+# as a layer mask.
+@tracing.traced('gimp.create_layers')
+def create_layers(img, layers_data, x, y, clip_mask=None, parent=None, position=0):
     if not layers_data:
         return
 
     inp_mask_layer = img.get_layer_by_name(constants.MASK_LAYER_NAME)
 
-    def _create_nested_layers(parent_layer_group, current_layers_data):
+    def _create_nested_layers(parent_layer_group, current_layers_data, position=0):
         for layer_item in current_layers_data:
             if layer_item.children:
-                gimp_layer_group = Gimp.Layer.new_group(img)
-                gimp_layer_group.set_name(layer_item.name)
-                img.insert_layer(gimp_layer_group, parent_layer_group, 0)
+                gimp_layer_group = new_layer_group(img, layer_item.name, parent_layer_group, position)
                 _create_nested_layers(gimp_layer_group, layer_item.children)
             elif layer_item.img:
-                tmp_png_path = decode_png(layer_item.img)
-
-                file_obj = Gio.File.new_for_path(tmp_png_path)
-                load_layer_proc = Gimp.get_pdb().lookup_procedure("gimp-file-load-layer")
-                if load_layer_proc:
-                    config = load_layer_proc.create_config()
-                    config.set_property("image", img)
-                    config.set_property("uri", file_obj.get_uri())
-                    loaded_layers_collection = load_layer_proc.run(config)
-                    if loaded_layers_collection.length() > 0:
-                        gimp_layer = loaded_layers_collection.index(0).get_object()
-                        gimp_layer.set_name(layer_item.name)
-                        gimp_layer.set_offsets(x, y)
-                        img.insert_layer(gimp_layer, parent_layer_group, 0)
-                        gimp_layer.add_alpha()
-
-                        if inp_mask_layer and apply_inpainting_mask:
-                            img.set_active_layer(gimp_layer)
-                            img.select_item(Gimp.ChannelOps.REPLACE, inp_mask_layer)
-                            img.selection_invert()
-                            Gimp.edit_clear(gimp_layer)
-                    else:
-                        print(f"Error loading layer from {tmp_png_path}")
-                else:
-                    print("Error: Could not find 'gimp-file-load-layer' procedure.")
-
-                os.remove(tmp_png_path)
-
-    _create_nested_layers(parent_layer_group=None, current_layers_data=layers_data)
-    img.selection_none()
+                gimp_layer = _load_layer(img, layer_item.img)
+                if gimp_layer:
+                    gimp_layer.set_name(layer_item.name)
+                    gimp_layer.set_offsets(x, y)
+                    img.insert_layer(gimp_layer, parent_layer_group, position)
+                    gimp_layer.add_alpha()
+
+                    if inp_mask_layer and clip_mask:
+                        _set_layer_mask(gimp_layer, clip_mask.pixels(gimp_layer.get_width(), gimp_layer.get_height()))
+
+    _create_nested_layers(parent, layers_data, position)
     if inp_mask_layer:
         img.raise_item_to_top(inp_mask_layer)
-        inp_mask_layer.set_visible(False)
\ No newline at end of file
+        inp_mask_layer.set_visible(False)
+
+# This function creates an empty layer group at position in parent (or at the top of the image).
+def new_layer_group(img, name, parent=None, position=0):
+    group = Gimp.Layer.new_group(img)
+    group.set_name(name)
+    img.insert_layer(group, parent, position)
+    return group
+
+# This function shows a live preview (a codec.DecodedImage) in a layer at x, y, scaled to width x height.
+# The layer is created on the first call and reused for all later ones; pass the returned layer back in.
+# Previews don't leave undo steps behind.
+@tracing.traced('gimp.update_preview_layer')
+def update_preview_layer(img, layer, decoded, x, y, width, height):
+    img.undo_freeze()
+    try:
+        if layer is None:
+            layer = _new_layer(img, "Live preview", decoded)
+            img.insert_layer(layer, None, 0)
+        else:
+            if (layer.get_width(), layer.get_height()) != (decoded.width, decoded.height):
+                layer.scale(decoded.width, decoded.height, False)
+            pixel_format = "R'G'B'A u8" if decoded.channels == 4 else "R'G'B' u8"  # GEGL converts to the layer's format
+            buffer = layer.get_buffer()
+            buffer.set(Gegl.Rectangle.new(0, 0, decoded.width, decoded.height), pixel_format, decoded.pixels)
+            buffer.flush()
+        if (decoded.width, decoded.height) != (width, height):
+            layer.scale(width, height, False)
+        layer.set_offsets(x, y)
+        layer.update(0, 0, layer.get_width(), layer.get_height())
+    finally:
+        img.undo_thaw()
+    Gimp.displays_flush()
+    return layer
+
+# This function removes the layer created by update_preview_layer.
+def remove_preview_layer(img, layer):
+    img.undo_freeze()
+    try:
+        img.remove_layer(layer)
+    finally:
+        img.undo_thaw()
+    Gimp.displays_flush()
+
+# This function opens a new, empty image for stitching tiles together. Tiles are collected in a layer group.
+def new_tile_canvas(width, height):
+    canvas = Gimp.Image.new(width, height, Gimp.ImageBaseType.RGB)
+    group = Gimp.Layer.new_group(canvas)
+    group.set_name("Tiles")
+    canvas.insert_layer(group, None, 0)
+    Gimp.Display.new(canvas)
+    return canvas, group
+
+# This function adds a tile to the group created by new_tile_canvas. Tiles are stacked by their index,
+# no matter in which order they arrive: position is the number of tiles with a higher index that are
+# already in the group. The edges shared with the tiles to the left and above fade in through a layer
+# mask, so the seams are blended by GIMP.
+@tracing.traced('gimp.add_tile')
+def add_tile(canvas, group, image_data, x, y, fade_left, fade_top, position=0):
+    layer = _load_layer(canvas, image_data)
+    if not layer:
+        return None
+    layer.set_offsets(x, y)
+    canvas.insert_layer(layer, group, position)
+    if fade_left or fade_top:
+        _set_layer_mask(layer, tiling.feather_mask(layer.get_width(), layer.get_height(), fade_left, fade_top))
+    Gimp.displays_flush()
+    return layer
+
+# This function merges the stitched tiles into a single layer.
+def merge_tiles(canvas, group, name="Upscaled"):
+    layer = canvas.merge_layer_group(group)
+    layer.set_name(name)
+    Gimp.displays_flush()
+    return layer
+
+# This function opens a new image for an X/Y plot grid (see xy_grid.grid_layout): a white background,
+# the X labels above the columns and the Y labels left of the rows, and an empty layer group that the
+# cells are added to with add_tile.
+def new_grid_canvas(layout, cell_width, cell_height, x_labels, y_labels):
+    canvas = Gimp.Image.new(layout.width, layout.height, Gimp.ImageBaseType.RGB)
+    background = Gimp.Layer.new(canvas, "Background", layout.width, layout.height, Gimp.ImageType.RGB_IMAGE,
+                                100.0, Gimp.LayerMode.NORMAL)
+    canvas.insert_layer(background, None, 0)
+    background.fill(Gimp.FillType.WHITE)
+    if layout.top:
+        for col, label in enumerate(x_labels):
+            _add_label(canvas, label, layout.font_size, layout.left + col * cell_width, 0, cell_width, layout.top)
+    if layout.left:
+        for row, label in enumerate(y_labels):
+            _add_label(canvas, label, layout.font_size, 0, layout.top + row * cell_height, layout.left, cell_height)
+    group = new_layer_group(canvas, "Cells")
+    Gimp.Display.new(canvas)
+    return canvas, group
+
+# This function adds a centered text label in a box. Labels are text layers, so they can still be edited.
+def _add_label(canvas, text, font_size, x, y, width, height):
+    if not text:
+        return
+    layer = Gimp.TextLayer.new(canvas, text, Gimp.context_get_font(), font_size, Gimp.Unit.pixel())
+    canvas.insert_layer(layer, None, 0)
+    layer.set_color(Gegl.Color.new("black"))
+    layer.set_justification(Gimp.TextJustification.CENTER)
+    layer.resize(width, layer.get_height())
+    layer.set_offsets(x, y + max(0, (height - layer.get_height()) // 2))
+
+# The functions below are used by the batch command, which works on images that aren't displayed.
+
+# This function loads an image file. Masks (mask_path) are loaded into the inpainting mask layer.
+def load_image(path, mask_path=None):
+    img = Gimp.file_load(Gimp.RunMode.NONINTERACTIVE, Gio.File.new_for_path(path))
+    if not img:
+        raise Exception(f"Couldn't load {path}")
+    if mask_path:
+        mask_layer = Gimp.file_load_layer(Gimp.RunMode.NONINTERACTIVE, img, Gio.File.new_for_path(mask_path))
+        if not mask_layer:
+            img.delete()
+            raise Exception(f"Couldn't load {mask_path}")
+        mask_layer.set_name(constants.MASK_LAYER_NAME)
+        img.insert_layer(mask_layer, None, 0)
+    return img
+
+# This function creates an empty image, e.g. as the canvas for text to image.
+def new_image(width, height):
+    img = Gimp.Image.new(width, height, Gimp.ImageBaseType.RGB)
+    layer = Gimp.Layer.new(img, "Background", width, height, Gimp.ImageType.RGBA_IMAGE, 100.0, Gimp.LayerMode.NORMAL)
+    img.insert_layer(layer, None, 0)
+    return img
+
+# This function returns a config for running a procedure, with its default settings.
+def procedure_config(proc_name):
+    procedure = Gimp.get_pdb().lookup_procedure(proc_name)
+    if not procedure:
+        raise Exception(f"Couldn't find procedure '{proc_name}'")
+    return procedure.create_config()
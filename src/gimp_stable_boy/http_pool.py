@@ -0,0 +1,272 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Keep-alive HTTP connections shared by all commands. Connections are pooled per
+# backend (scheme, host, port), checked before reuse and dropped after sitting
+# idle for too long, so back-to-back requests skip TCP and TLS setup.
+#
+# Requests can be aborted from another thread with an AbortHandle, which shuts
+# down their sockets; a thread blocked waiting for the response wakes up with
+# RequestAborted.
+
+import socket
+import select
+import threading
+import http.client
+from time import monotonic
+from urllib.parse import urlsplit
+
+from gimp_stable_boy.config import Config as config
+
+# Errors that mean a reused connection was closed by the server while idle.
+# The request never got processed, so it's safe to send it again on a fresh connection.
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError,
+                            ConnectionAbortedError)
+
+
+# Raised by requests that were aborted with their AbortHandle
+class RequestAborted(ConnectionAbortedError):
+    pass
+
+
+# Aborts the requests sent with it, e.g. when the user cancels a command. Requests in progress fail
+# with RequestAborted as soon as their connection has been shut down, later ones right away.
+class AbortHandle:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conns = set()
+        self.aborted = False
+
+    def abort(self):
+        with self._lock:
+            self.aborted = True
+            conns = list(self._conns)
+        for conn in conns:
+            sock = conn.sock
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def _add(self, conn):
+        with self._lock:
+            if self.aborted:
+                raise RequestAborted('Request aborted')
+            self._conns.add(conn)
+
+    def _remove(self, conn):
+        with self._lock:
+            self._conns.discard(conn)
+
+
+# Wraps an http.client.HTTPResponse and hands the connection back to the pool
+# once the body has been read completely.
+class PooledResponse:
+
+    def __init__(self, pool, key, conn, response, abort=None):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._abort = abort
+        self.status = response.status
+        self.reason = response.reason
+        self.bytes_read = 0
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        try:
+            data = self._response.read(amt)
+        except Exception as e:
+            self._check_aborted(e)
+            raise
+        self.bytes_read += len(data)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def readinto(self, buffer):
+        try:
+            n = self._response.readinto(buffer)
+        except Exception as e:
+            self._check_aborted(e)
+            raise
+        self.bytes_read += n
+        if self._response.isclosed():
+            self._release()
+        return n
+
+    # An aborted connection looks like the server closed it in the middle of the body
+    def _check_aborted(self, error=None):
+        if self._abort is not None and self._abort.aborted:
+            raise RequestAborted('Request aborted') from error
+
+    # Closing a response that hasn't been read to the end discards its connection.
+    def close(self):
+        if self._conn is not None:
+            self._forget_conn()
+            self._conn.close()
+            self._conn = None
+        self._response.close()
+
+    def _release(self):
+        if self._conn is not None:
+            self._forget_conn()
+            self._pool._release(self._key, self._conn)
+            self._conn = None
+
+    def _forget_conn(self):
+        if self._abort is not None:
+            self._abort._remove(self._conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ConnectionPool:
+
+    def __init__(self, max_idle_per_backend=None, idle_timeout=None):
+        self.max_idle_per_backend = max_idle_per_backend or config.MAX_IDLE_CONNECTIONS
+        self.idle_timeout = idle_timeout or config.CONNECTION_IDLE_TIMEOUT
+        self._lock = threading.Lock()
+        self._idle = {}  # backend key -> list of (connection, time it was returned)
+
+    # Sends a request and returns a PooledResponse. Raises an exception for HTTP error statuses.
+    # body is bytes, or a function returning an iterable of bytes, which is sent with chunked
+    # transfer encoding. The function is called again if the request has to be resent.
+    # With an AbortHandle, the request can be aborted from another thread.
+    def request(self, method, url, body=None, headers=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, abort=None):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        while True:
+            conn, reused = self._acquire(key, timeout)
+            try:
+                if abort is not None:
+                    abort._add(conn)
+                conn.request(method, path, body=body() if callable(body) else body, headers=headers or {})
+                if abort is not None and abort.aborted:
+                    # Aborted while connecting, before there was a socket to shut down
+                    raise RequestAborted('Request aborted')
+                response = conn.getresponse()
+                break
+            except _STALE_CONNECTION_ERRORS as e:
+                self._discard(conn, abort)
+                if abort is not None and abort.aborted:
+                    if isinstance(e, RequestAborted):
+                        raise
+                    raise RequestAborted('Request aborted') from e
+                if not reused:
+                    raise
+            except BaseException as e:
+                self._discard(conn, abort)
+                if abort is not None and abort.aborted and isinstance(e, Exception):
+                    raise RequestAborted('Request aborted') from e
+                raise
+
+        pooled_response = PooledResponse(self, key, conn, response, abort)
+        if response.status >= 400:
+            body = pooled_response.read()
+            raise Exception('HTTP Error ' + str(response.status) + ': ' + response.reason
+                            + (' - ' + body[:500].decode('utf-8', 'replace') if body else ''))
+        return pooled_response
+
+    @staticmethod
+    def _discard(conn, abort):
+        if abort is not None:
+            abort._remove(conn)
+        conn.close()
+
+    # Closes all idle connections.
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def _acquire(self, key, timeout):
+        stale = []
+        conn = None
+        with self._lock:
+            self._evict_idle(stale)
+            conns = self._idle.get(key, [])
+            while conns and conn is None:
+                candidate, _ = conns.pop()
+                if self._is_healthy(candidate):
+                    conn = candidate
+                else:
+                    stale.append(candidate)
+        for stale_conn in stale:
+            stale_conn.close()
+
+        if conn is not None:
+            conn.timeout = timeout
+            conn.sock.settimeout(socket.getdefaulttimeout() if timeout is socket._GLOBAL_DEFAULT_TIMEOUT else timeout)
+            return conn, True
+
+        scheme, host, port = key
+        conn_cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return conn_cls(host, port, timeout=timeout), False
+
+    def _release(self, key, conn):
+        if conn.sock is None:
+            # Server asked to close the connection
+            return
+        surplus = None
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            conns.append((conn, monotonic()))
+            if len(conns) > self.max_idle_per_backend:
+                surplus, _ = conns.pop(0)
+        if surplus is not None:
+            surplus.close()
+
+    # Must be called with the lock held. Collects connections idle for too long in `stale`.
+    def _evict_idle(self, stale):
+        oldest_allowed = monotonic() - self.idle_timeout
+        for key in list(self._idle):
+            conns = self._idle[key]
+            stale.extend(conn for conn, returned_at in conns if returned_at < oldest_allowed)
+            conns[:] = [(conn, returned_at) for conn, returned_at in conns if returned_at >= oldest_allowed]
+            if not conns:
+                del self._idle[key]
+
+    # An idle keep-alive socket must not be readable: if it is, the server either
+    # closed it or sent something unexpected. Either way it can't be reused.
+    @staticmethod
+    def _is_healthy(conn):
+        if conn.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+
+# The pool shared by all commands
+pool = ConnectionPool()
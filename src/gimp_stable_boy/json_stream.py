@@ -0,0 +1,230 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Incremental parsing of API responses. A1111 returns all generated images as
+# base64 strings in one JSON object; instead of reading and parsing the whole
+# body at once, the members of the top-level object are parsed one at a time
+# while they arrive, and arrays can be unpacked element by element.
+#
+# Request bodies are written incrementally the same way (iter_json_body): images
+# are base64-encoded in chunks while the body is being sent.
+
+import json
+
+from gimp_stable_boy.codec import EncodedImage
+
+READ_SIZE = 64 * 1024
+WRITE_SIZE = 64 * 1024
+
+_WHITESPACE = b' \t\r\n'
+
+
+class _Reader:
+
+    def __init__(self, fp, read_size):
+        self.fp = fp
+        self.read_size = read_size
+        self.buf = bytearray()
+        self.pos = 0
+
+    # Reads more data from the stream. Returns False at the end of the stream.
+    def fill(self):
+        if self.pos > self.read_size:
+            del self.buf[:self.pos]
+            self.pos = 0
+        data = self.fp.read(self.read_size)
+        if not data:
+            return False
+        self.buf += data
+        return True
+
+    # Returns the next non-whitespace character (as a one-byte bytes object) without consuming it.
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos:self.pos + 1]
+            if not self.fill():
+                raise ValueError('Unexpected end of JSON data')
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError('Expected ' + repr(char) + ' but found ' + repr(found) + ' in JSON data')
+        self.pos += 1
+
+    # Reads a JSON string. Large strings are collected chunk by chunk, without rescanning.
+    def read_string(self):
+        self.expect(b'"')
+        parts = []
+        while True:
+            end = self.buf.find(b'"', self.pos)
+            while end != -1 and _is_escaped(self.buf, self.pos, end):
+                end = self.buf.find(b'"', end + 1)
+            if end != -1:
+                parts.append(bytes(self.buf[self.pos:end]))
+                self.pos = end + 1
+                break
+            # An unpaired trailing backslash stays in the buffer, it escapes the next character
+            keep = 1 if _is_escaped(self.buf, self.pos, len(self.buf)) else 0
+            parts.append(bytes(self.buf[self.pos:len(self.buf) - keep]))
+            self.pos = len(self.buf) - keep
+            if not self.fill():
+                raise ValueError('Unterminated string in JSON data')
+        raw = b''.join(parts)
+        del parts
+        return json.loads(b'"' + raw + b'"') if b'\\' in raw else raw.decode('utf-8')
+
+    # Reads any JSON value. Strings are read with read_string, everything else is
+    # scanned to its end and handed to the json module.
+    def read_value(self):
+        if self.peek() == b'"':
+            return self.read_string()
+        start = self.pos
+        depth = 0
+        i = start
+        scanned = start  # strings are searched for their end from here on
+        while True:
+            if i >= len(self.buf):
+                if not self._fill_keeping(start):
+                    if depth == 0 and i > start:
+                        break
+                    raise ValueError('Unexpected end of JSON data')
+                i, scanned, start = i - start + self.pos, scanned - start + self.pos, self.pos
+                continue
+            c = self.buf[i]
+            if c == 0x22:  # skip over strings nested in the value, which can be large
+                end = self.buf.find(b'"', max(i + 1, scanned))
+                while end != -1 and _is_escaped(self.buf, i + 1, end):
+                    end = self.buf.find(b'"', end + 1)
+                if end == -1:
+                    scanned = len(self.buf)
+                    if not self._fill_keeping(start):
+                        raise ValueError('Unterminated string in JSON data')
+                    i, scanned, start = i - start + self.pos, scanned - start + self.pos, self.pos
+                    continue
+                i = end + 1
+                continue
+            if c in b'[{':
+                depth += 1
+            elif c in b']}':
+                if depth == 0:
+                    break
+                depth -= 1
+                if depth == 0:
+                    i += 1
+                    break
+            elif depth == 0 and c in b', \t\r\n':
+                break
+            i += 1
+        value = json.loads(bytes(self.buf[start:i]))
+        self.pos = i
+        return value
+
+    # Reads more data while keeping everything from `start` in the buffer. Afterwards
+    # self.pos points to where `start` was.
+    def _fill_keeping(self, start):
+        self.pos = start
+        return self.fill()
+
+    # Consumes the rest of the stream, so that pooled connections can be reused.
+    def drain(self):
+        while self.fp.read(self.read_size):
+            pass
+
+
+def _is_escaped(buf, start, quote_pos):
+    backslashes = 0
+    i = quote_pos - 1
+    while i >= start and buf[i] == 0x5c:
+        backslashes += 1
+        i -= 1
+    return backslashes % 2 == 1
+
+
+# This generator parses a JSON object from a file-like object and yields (key, value) for each member.
+# Members listed in unpack_keys that hold an array are yielded as one (key, element) pair per element,
+# so that only one element has to be held in memory at a time.
+def iter_members(fp, unpack_keys=(), read_size=READ_SIZE):
+    reader = _Reader(fp, read_size)
+    reader.expect(b'{')
+    if reader.peek() == b'}':
+        reader.pos += 1
+    else:
+        while True:
+            key = reader.read_string()
+            reader.expect(b':')
+            if key in unpack_keys and reader.peek() == b'[':
+                reader.pos += 1
+                if reader.peek() == b']':
+                    reader.pos += 1
+                else:
+                    while True:
+                        yield key, reader.read_value()
+                        if reader.peek() == b',':
+                            reader.pos += 1
+                            continue
+                        reader.expect(b']')
+                        break
+            else:
+                yield key, reader.read_value()
+            if reader.peek() == b',':
+                reader.pos += 1
+                continue
+            reader.expect(b'}')
+            break
+    reader.drain()
+
+
+# This generator yields `value` as JSON text in pieces. The text is the same as json.dumps(value)
+# with EncodedImage values replaced by their data URLs.
+def iter_json(value):
+    if isinstance(value, EncodedImage):
+        yield '"'
+        yield from value.iter_base64()  # base64 has no characters that need escaping
+        yield '"'
+    elif isinstance(value, dict):
+        yield '{'
+        for i, (key, item) in enumerate(value.items()):
+            yield (', ' if i else '') + json.dumps(str(key)) + ': '
+            yield from iter_json(item)
+        yield '}'
+    elif isinstance(value, (list, tuple)):
+        yield '['
+        for i, item in enumerate(value):
+            if i:
+                yield ', '
+            yield from iter_json(item)
+        yield ']'
+    else:
+        yield json.dumps(value)
+
+
+# This generator yields a JSON request body as UTF-8 bytes in chunks of about write_size bytes, for
+# sending with chunked transfer encoding. Memory use doesn't depend on the size of the images.
+def iter_json_body(value, write_size=WRITE_SIZE):
+    buffered = []
+    size = 0
+    for piece in iter_json(value):
+        buffered.append(piece)
+        size += len(piece)
+        if size >= write_size:
+            yield ''.join(buffered).encode('utf-8')
+            buffered = []
+            size = 0
+    if buffered:
+        yield ''.join(buffered).encode('utf-8')
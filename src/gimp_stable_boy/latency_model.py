@@ -0,0 +1,206 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Predicts how long requests take, based on how long earlier requests took.
+# The amount of work of a request is expressed in "work units" (for image
+# generation: steps x batch size x megapixels, relative to 512x512). For each
+# backend, endpoint and sampler, request durations are fitted as a linear
+# function of the work units (fixed overhead + time per unit), with older runs
+# weighing less over time. Predictions are used for timeouts, for progress
+# estimates while WebUI doesn't report any, and for picking backends.
+#
+# The model is stored as JSON in the cache directory, so it carries over to
+# future sessions.
+
+import os
+import json
+import math
+import tempfile
+import threading
+
+from gimp_stable_boy import codec
+from gimp_stable_boy.config import Config as config
+
+MODEL_VERSION = 1
+MODEL_PATH = os.path.join(config.CACHE_DIR, 'latency.json')
+
+# Weight of the existing observations when a new one is added
+DECAY = 0.95
+# Timeouts are at least this long, and at least TIMEOUT_MARGIN x the prediction
+MIN_TIMEOUT = 15  # seconds
+TIMEOUT_MARGIN = 2.0
+# Observations needed before a fit is used to predict anything
+MIN_SAMPLES = 2
+
+_REFERENCE_PIXELS = 512 * 512
+
+
+# This function returns the work units of a request. Upscaling has no width, height and steps; its work
+# units are the output megapixels, with the input size read from the header of the image.
+def work_units(endpoint, req_data):
+    if 'upscaling_resize' in req_data:
+        width, height = codec.image_size(req_data.get('image') or '') or (512, 512)
+        passes = 2 if float(req_data.get('extras_upscaler_2_visibility') or 0) > 0 else 1
+        return passes * width * height * float(req_data['upscaling_resize']) ** 2 / _REFERENCE_PIXELS
+    steps = int(req_data.get('steps', 20))
+    if 'init_images' in req_data:
+        # img2img only runs the last denoising_strength part of the steps
+        steps = max(1, math.ceil(steps * float(req_data.get('denoising_strength', 1.0))))
+    pixels = int(req_data.get('width', 512)) * int(req_data.get('height', 512))
+    batch = int(req_data.get('batch_size', 1)) * int(req_data.get('n_iter', 1))
+    return steps * batch * pixels / _REFERENCE_PIXELS
+
+
+# Keys from the most to the least specific. Predictions use the most specific key with enough data.
+def _keys(backend, endpoint, req_data):
+    kind = endpoint + (' ' + req_data['script_name'] if req_data.get('script_name') else '')
+    sampler = str(req_data.get('sampler_index', ''))
+    return [' | '.join([backend, kind, sampler]), ' | '.join([backend, kind]), ' | '.join(['*', kind])]
+
+
+class _Fit:
+    FIELDS = ('n', 'sx', 'sy', 'sxx', 'sxy', 'syy')
+
+    def __init__(self, stats=None):
+        stats = stats or {}
+        for field in self.FIELDS:
+            setattr(self, field, float(stats.get(field, 0.0)))
+        self.samples = int(stats.get('samples', 0))
+
+    def as_dict(self):
+        stats = {field: getattr(self, field) for field in self.FIELDS}
+        stats['samples'] = self.samples
+        return stats
+
+    def add(self, x, y):
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) * DECAY)
+        self.n += 1
+        self.sx += x
+        self.sy += y
+        self.sxx += x * x
+        self.sxy += x * y
+        self.syy += y * y
+        self.samples += 1
+
+    # Returns (overhead, seconds per unit). With too little spread in the work units, the fit goes through the origin.
+    def coefficients(self):
+        spread = self.sxx - self.sx * self.sx / self.n
+        if self.samples >= 3 and spread > 1e-6 * self.sxx:
+            slope = (self.sxy - self.sx * self.sy / self.n) / spread
+            intercept = (self.sy - slope * self.sx) / self.n
+            if slope > 0 and intercept >= 0:
+                return intercept, slope
+        return 0.0, (self.sxy / self.sxx if self.sxx > 0 else 0.0)
+
+    # Returns (predicted seconds, standard deviation of the residuals).
+    def predict(self, x):
+        intercept, slope = self.coefficients()
+        squared_error = (self.syy - 2 * intercept * self.sy - 2 * slope * self.sxy + intercept * intercept * self.n
+                         + 2 * intercept * slope * self.sx + slope * slope * self.sxx)
+        return intercept + slope * x, math.sqrt(max(0.0, squared_error) / self.n)
+
+
+class LatencyModel:
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fits = None
+
+    def _load(self):
+        if self._fits is not None:
+            return self._fits
+        self._fits = {}
+        if self.path:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as model_file:
+                    model = json.load(model_file)
+                if model.get('version') == MODEL_VERSION:
+                    self._fits = {key: _Fit(stats) for key, stats in model.get('fits', {}).items()}
+            except (OSError, ValueError):
+                pass
+        return self._fits
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            directory = os.path.dirname(self.path)
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+            with os.fdopen(fd, 'w', encoding='utf-8') as model_file:
+                json.dump({'version': MODEL_VERSION,
+                           'fits': {key: fit.as_dict() for key, fit in self._fits.items()}}, model_file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Couldn't save latency model: {e}")
+
+    # Records how long a request took.
+    def observe(self, backend, endpoint, req_data, seconds):
+        units = work_units(endpoint, req_data)
+        with self._lock:
+            fits = self._load()
+            for key in _keys(backend, endpoint, req_data):
+                fits.setdefault(key, _Fit()).add(units, seconds)
+            self._save()
+
+    # Returns (predicted seconds, standard deviation) for a request, or None if there isn't enough data.
+    def predict(self, backend, endpoint, req_data):
+        units = work_units(endpoint, req_data)
+        with self._lock:
+            fits = self._load()
+            for key in _keys(backend, endpoint, req_data):
+                fit = fits.get(key)
+                if fit and fit.samples >= MIN_SAMPLES:
+                    return fit.predict(units)
+        return None
+
+    # Returns a timeout for a request, or None if there isn't enough data.
+    def timeout(self, backend, endpoint, req_data):
+        prediction = self.predict(backend, endpoint, req_data)
+        if prediction is None:
+            return None
+        seconds, deviation = prediction
+        return max(MIN_TIMEOUT, TIMEOUT_MARGIN * seconds, seconds + 4 * deviation) * config.TIMEOUT_FACTOR
+
+    # Returns a readable description of the fitted values.
+    def summary(self):
+        with self._lock:
+            fits = self._load()
+            if not fits:
+                return 'The latency model has no data yet.'
+            lines = []
+            for key in sorted(fits):
+                fit = fits[key]
+                intercept, slope = fit.coefficients()
+                _, deviation = fit.predict(0)
+                lines.append(f"{key}: {intercept:.1f} s + {slope:.2f} s per unit (±{deviation:.1f} s, {fit.samples} runs)")
+            return '\n'.join(lines)
+
+    # Forgets all observations.
+    def reset(self):
+        with self._lock:
+            self._fits = {}
+            if self.path:
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+
+
+# The model shared by all commands
+model = LatencyModel(MODEL_PATH)
@@ -0,0 +1,132 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Progress reporting based on the WebUI's /sdapi/v1/progress endpoint. The
+# endpoint is polled in a background thread. The polling interval adapts to the
+# remaining time, so long generations cause few wakeups while short ones still
+# report progress smoothly.
+#
+# With a preview interval, the poller also fetches WebUI's live preview of the
+# image being generated, at most once per interval, and decodes it.
+#
+# WebUI only reports on whatever it's working on at the moment; the endpoint
+# doesn't say which request that is. When other commands or other clients use
+# the same WebUI instance, the progress (and the live preview) shown for a
+# command may thus be theirs, e.g. while the command's own request is queued.
+# With several backends, only the one that got the command's latest request is
+# polled (StableDiffusionCommand.progress_base_url); progress the command
+# tracks itself, like finished tiles or images, is reported alongside.
+
+import json
+from time import monotonic
+from threading import Thread, Event
+from urllib.parse import urljoin
+
+from gimp_stable_boy import codec, http_pool
+
+PROGRESS_URI = 'sdapi/v1/progress?skip_current_image=true'
+PREVIEW_URI = 'sdapi/v1/progress?skip_current_image=false'
+
+MIN_INTERVAL = 0.25  # seconds
+MAX_INTERVAL = 2.0
+INITIAL_INTERVAL = 0.5
+# Number of progress updates we'd like to see over the remaining time of a job
+UPDATES_PER_JOB = 20
+
+
+class ProgressPoller(Thread):
+
+    def __init__(self, api_base_url, request_timeout=5, preview_interval=None):
+        Thread.__init__(self, daemon=True)
+        self.api_base_url = api_base_url  # may be changed while polling
+        self.request_timeout = request_timeout
+        self.preview_interval = preview_interval  # seconds, None: no previews
+        self.fraction = 0.0
+        self.eta = None  # seconds
+        self.text = ''
+        self.interval = INITIAL_INTERVAL
+        self.preview = None  # codec.DecodedImage of the latest live preview
+        self.preview_serial = 0  # incremented for every new preview
+        self._preview_fetched_at = None
+        self._preview_encoded = None
+        self._stopped = Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self._poll()
+            except Exception as e:
+                # Backend is unreachable or doesn't support progress, check back less often
+                if self.interval != MAX_INTERVAL:
+                    print(f"Progress polling failed: {e}")
+                self.interval = MAX_INTERVAL
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _poll(self):
+        now = monotonic()
+        fetch_preview = self.preview_interval is not None and \
+            (self._preview_fetched_at is None or now - self._preview_fetched_at >= self.preview_interval)
+        url = urljoin(self.api_base_url, PREVIEW_URI if fetch_preview else PROGRESS_URI)
+        with http_pool.pool.request('GET', url, timeout=self.request_timeout) as resp:
+            progress = json.loads(resp.read())
+        self.update(progress)
+        if fetch_preview:
+            self._preview_fetched_at = now
+            self._update_preview(progress.get('current_image'))
+
+    # Decodes a new live preview. WebUI keeps returning the same preview until there's a new one.
+    def _update_preview(self, encoded):
+        if not encoded or encoded == self._preview_encoded:
+            return
+        self._preview_encoded = encoded
+        try:
+            self.preview = codec.decode_png(codec.decode_base64(encoded))
+            self.preview_serial += 1
+        except Exception as e:
+            print(f"Couldn't decode live preview: {e}")
+
+    # Updates fraction, ETA, text and polling interval from a progress response.
+    def update(self, progress):
+        state = progress.get('state') or {}
+        fraction = float(progress.get('progress') or 0.0)
+        eta = progress.get('eta_relative')
+        eta = float(eta) if eta and fraction > 0 else None
+
+        # WebUI's progress restarts for every job of a batch, but ours shouldn't go backwards
+        job_count = state.get('job_count') or 0
+        if job_count > 1 and fraction > 0:
+            self.fraction = max(self.fraction, min(1.0, (state.get('job_no', 0) + fraction) / job_count))
+        elif fraction > 0:
+            self.fraction = max(self.fraction, min(1.0, fraction))
+
+        if eta != self.eta and eta is not None:
+            self.interval = min(MAX_INTERVAL, max(MIN_INTERVAL, eta / UPDATES_PER_JOB))
+        elif fraction <= 0:
+            # Nothing is running (yet), no need to keep asking at a high rate
+            self.interval = min(MAX_INTERVAL, self.interval * 1.5)
+        self.eta = eta
+
+        parts = []
+        if state.get('sampling_steps'):
+            parts.append(f"Step {state.get('sampling_step', 0)}/{state['sampling_steps']}")
+        if job_count > 1:
+            parts.append(f"image {state.get('job_no', 0) + 1}/{job_count}")
+        if eta is not None:
+            parts.append(f"{int(round(eta))} s left")
+        self.text = ', '.join(parts)
@@ -0,0 +1,111 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Memoized encodings of init images and masks. Running several commands on an
+# unchanged region encodes the same pixels over and over; this cache returns the
+# previous encoding instead.
+#
+# Entries are keyed by a digest of the region's raw pixels (plus size and
+# encoding options), which changes as soon as anything in the region is edited.
+# GIMP doesn't expose a dirty counter or the undo stack to plug-ins, and reading
+# the region is cheap compared to compressing and base64-encoding it. As GIMP
+# starts a new plug-in process for every command, entries are kept on disk as
+# well as in memory.
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+from gimp_stable_boy.config import Config as config
+from gimp_stable_boy.result_cache import prune_lru
+from gimp_stable_boy import codec
+
+# File name extensions of entries (prune_lru accepts a tuple of suffixes)
+_SUFFIXES = tuple('.' + mime.split('/')[1] for mime in codec.MIME_TYPES.values())
+
+
+class RegionCache:
+
+    def __init__(self, directory, max_bytes, max_entries_in_memory=8):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries_in_memory = max_entries_in_memory
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> codec.EncodedImage
+
+    @staticmethod
+    def key(pixels, width, height, channels, **options):
+        digest = hashlib.blake2b(pixels, digest_size=20)
+        digest.update(repr((width, height, channels, sorted(options.items()))).encode('utf-8'))
+        return digest.hexdigest()
+
+    # This method returns the encoded region (a codec.EncodedImage), encoding it only if it isn't cached yet.
+    # image_format is as for codec.encode_image.
+    def encode(self, pixels, width, height, channels, image_format=('png', 6)):
+        key = self.key(pixels, width, height, channels, format=image_format[0], setting=image_format[1])
+        encoded = self._get(key)
+        if encoded is None:
+            encoded = codec.encode_image(pixels, width, height, channels, image_format)
+            self._put(key, encoded)
+        return encoded
+
+    # Entries are stored with the extension of their format, which may be PNG for other requested formats
+    # (see codec.encode_image)
+    def _entry_path(self, key, mime):
+        return os.path.join(self.directory, key + '.' + mime.split('/')[1])
+
+    def _get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        for mime in codec.MIME_TYPES.values():
+            path = self._entry_path(key, mime)
+            try:
+                with open(path, 'rb') as entry:
+                    encoded = codec.EncodedImage(entry.read(), mime)
+                os.utime(path)
+            except OSError:
+                continue
+            self._remember(key, encoded)
+            return encoded
+        return None
+
+    def _put(self, key, encoded):
+        self._remember(key, encoded)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._entry_path(key, encoded.mime)
+            tmp_path = path + '.' + str(threading.get_ident()) + '.tmp'
+            with open(tmp_path, 'wb') as entry:
+                entry.write(encoded.data)
+            os.replace(tmp_path, path)
+            with self._lock:
+                prune_lru(self.directory, _SUFFIXES, self.max_bytes)
+        except OSError as e:
+            print(f"Couldn't store encoded region: {e}")
+
+    def _remember(self, key, encoded):
+        with self._lock:
+            self._memory[key] = encoded
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries_in_memory:
+                self._memory.popitem(last=False)
+
+
+# The cache shared by all commands
+cache = RegionCache(os.path.join(config.CACHE_DIR, 'regions'), config.REGION_CACHE_MAX_BYTES)
@@ -0,0 +1,129 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Finding separate areas of an inpainting mask. The mask is reduced to a grid of
+# cells, each of which is marked if any of its pixels is masked. Connected
+# groups of marked cells are the mask's regions. Each region gets a window
+# around it, aligned to 64 pixels; windows that overlap are merged, so every
+# masked pixel is processed exactly once. Where an aligned window can't hold all
+# of its region (near the edges of an image that isn't a multiple of 64 wide or
+# high), there are no separate regions: the mask is inpainted as a whole.
+
+from collections import namedtuple
+
+# Position and size of a window around a region
+Region = namedtuple('Region', 'x y width height')
+
+# Gray mask value -> 1 if masked (i.e. painted over the white background), 0 otherwise
+_COVERED = bytes([1] * 255 + [0])
+
+
+# This function returns a grid of cell_size x cell_size cells over an 8-bit gray mask (white = not masked)
+# as a list of rows, with a true value for each cell that contains masked pixels.
+def _cell_grid(mask, width, height, cell_size):
+    grid_width = (width + cell_size - 1) // cell_size
+    grid = []
+    for band_y in range(0, height, cell_size):
+        # OR all rows of the band together, so each column is 1 if it has masked pixels
+        band = 0
+        for row in range(band_y, min(band_y + cell_size, height)):
+            band |= int.from_bytes(mask[row * width:(row + 1) * width].translate(_COVERED), 'big')
+        band = band.to_bytes(width, 'big')
+        grid.append([band.find(1, col * cell_size, (col + 1) * cell_size) != -1 for col in range(grid_width)])
+    return grid
+
+
+# This function returns the bounding boxes (in cells) of the 8-connected groups of marked cells.
+def _components(grid):
+    seen = set()
+    boxes = []
+    for start_row, cells in enumerate(grid):
+        for start_col, marked in enumerate(cells):
+            if not marked or (start_row, start_col) in seen:
+                continue
+            seen.add((start_row, start_col))
+            stack = [(start_row, start_col)]
+            box = [start_col, start_row, start_col, start_row]
+            while stack:
+                row, col = stack.pop()
+                box = [min(box[0], col), min(box[1], row), max(box[2], col), max(box[3], row)]
+                for n_row in range(max(0, row - 1), min(len(grid), row + 2)):
+                    for n_col in range(max(0, col - 1), min(len(cells), col + 2)):
+                        if grid[n_row][n_col] and (n_row, n_col) not in seen:
+                            seen.add((n_row, n_col))
+                            stack.append((n_row, n_col))
+            boxes.append(box)
+    return boxes
+
+
+# This function returns a window of at least min_size pixels per side, a multiple of `align`, centered on a
+# box (x1, y1, x2, y2) and moved inside the bounds (width, height) if necessary. Windows are cut down to
+# the bounds, rounded down to a multiple of `align` too: WebUI would otherwise resize the window, and the
+# result wouldn't line up with the image. Only a side smaller than `align` keeps the size of the image.
+def _fit_window(x1, y1, x2, y2, min_size, align, bounds):
+    def _fit(start, end, limit):
+        size = max(min_size, -(-(end - start) // align) * align)
+        size = min(size, limit // align * align or limit)
+        pos = (start + end) // 2 - size // 2
+        return max(0, min(pos, limit - size)), size
+    x, width = _fit(x1, x2, bounds[0])
+    y, height = _fit(y1, y2, bounds[1])
+    return [x, y, width, height]
+
+
+def _overlap(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+# Tells whether a window holds all of a box (x1, y1, x2, y2)
+def _contains(window, box):
+    return window[0] <= box[0] and window[1] <= box[1] and box[2] <= window[0] + window[2] \
+        and box[3] <= window[1] + window[3]
+
+
+def _union(a, b):
+    return [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+
+
+# This function finds the separate regions of an 8-bit gray mask and returns one window per region.
+# padding is the amount of context added around the masked pixels, in pixels. Regions whose windows
+# would overlap are merged into one. If the mask was read from a part of a larger image, origin is the
+# position of that part and bounds the image size; windows are returned in image coordinates.
+# Returns no windows if a region doesn't fit into an aligned window (see _fit_window).
+def find_regions(mask, width, height, cell_size=16, padding=32, align=64, min_size=512, origin=(0, 0), bounds=None):
+    ox, oy = origin
+    cores = [[ox + col1 * cell_size, oy + row1 * cell_size,
+              ox + min(width, (col2 + 1) * cell_size), oy + min(height, (row2 + 1) * cell_size)]
+             for col1, row1, col2, row2 in _components(_cell_grid(mask, width, height, cell_size))]
+    boxes = [[x1 - padding, y1 - padding, x2 + padding, y2 + padding] for x1, y1, x2, y2 in cores]
+    bounds = bounds or (ox + width, oy + height)
+    windows = [_fit_window(*box, min_size, align, bounds) for box in boxes]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(windows)):
+            for j in range(i + 1, len(windows)):
+                if _overlap(windows[i], windows[j]):
+                    boxes[i], cores[i] = _union(boxes[i], boxes[j]), _union(cores[i], cores[j])
+                    windows[i] = _fit_window(*boxes[i], min_size, align, bounds)
+                    del boxes[j], cores[j], windows[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    if not all(_contains(window, core) for window, core in zip(windows, cores)):
+        return []
+    return [Region(*window) for window in sorted(windows, key=lambda w: (w[1], w[0]))]
@@ -0,0 +1,127 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Maps procedure names to the command modules defining them. GIMP starts the
+# plugin once to query its procedures and again for every procedure it runs,
+# so instead of importing all command modules each time, the mapping is stored
+# in a manifest next to the other caches. Modules are only imported again when
+# their file's size or modification time changed.
+
+import os
+import json
+import inspect
+import tempfile
+from importlib import import_module
+
+from gimp_stable_boy.config import Config as config
+
+MANIFEST_VERSION = 1
+MANIFEST_PATH = os.path.join(config.CACHE_DIR, 'commands.json')
+
+_COMMANDS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'commands')
+
+
+def is_cmd(obj):
+    return inspect.isclass(obj) and obj.__name__ not in ['StableBoyCommand', 'StableDiffusionCommand'] \
+        and 'StableBoyCommand' in [cls.__name__ for cls in inspect.getmro(obj)]
+
+
+# This function returns (module name, file path) for each command module that is enabled.
+def _command_modules():
+    locations = [('gimp_stable_boy.commands', _COMMANDS_DIR)]
+    if config.ENABLE_SCRIPTS:
+        locations.append(('gimp_stable_boy.commands.scripts', os.path.join(_COMMANDS_DIR, 'scripts')))
+    modules = []
+    for package, directory in locations:
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith('.py') and file_name != '__init__.py':
+                modules.append((package + '.' + file_name[:-3], os.path.join(directory, file_name)))
+    return modules
+
+
+# This function returns the commands defined in a module (not the ones it imports from other modules).
+def _module_commands(module):
+    return [cmd_cls for _, cmd_cls in inspect.getmembers(module, is_cmd) if cmd_cls.__module__ == module.__name__]
+
+
+class Registry:
+
+    def __init__(self, manifest_path=None):
+        self.manifest_path = manifest_path
+        self._modules = None  # module name -> {'stamp': [mtime_ns, size], 'procedures': [...]}
+
+    # Returns the names of all procedures, in the order their modules are found.
+    def procedure_names(self):
+        names = []
+        for entry in self._load().values():
+            names.extend(name for name in entry['procedures'] if name not in names)
+        return names
+
+    # Returns the command class for a procedure, importing only the module it's defined in.
+    def command_class(self, proc_name):
+        for module_name, entry in self._load().items():
+            if proc_name in entry['procedures']:
+                for cmd_cls in _module_commands(import_module(module_name)):
+                    if cmd_cls.proc_name == proc_name:
+                        return cmd_cls
+        return None
+
+    # Builds the mapping once per process. Entries from the manifest are used for unchanged files.
+    def _load(self):
+        if self._modules is not None:
+            return self._modules
+        known = self._read_manifest()
+        modules = {}
+        for module_name, path in _command_modules():
+            stat = os.stat(path)
+            stamp = [stat.st_mtime_ns, stat.st_size]
+            entry = known.get(module_name)
+            if not entry or entry.get('stamp') != stamp:
+                entry = {'stamp': stamp, 'procedures': [cmd_cls.proc_name for cmd_cls in _module_commands(import_module(module_name))]}
+            modules[module_name] = entry
+        self._modules = modules
+        if modules != known:
+            self._write_manifest(modules)
+        return modules
+
+    def _read_manifest(self):
+        if not self.manifest_path:
+            return {}
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('version') != MANIFEST_VERSION:
+            return {}
+        return manifest.get('modules') or {}
+
+    def _write_manifest(self, modules):
+        if not self.manifest_path:
+            return
+        try:
+            directory = os.path.dirname(self.manifest_path)
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+            with os.fdopen(fd, 'w', encoding='utf-8') as manifest_file:
+                json.dump({'version': MANIFEST_VERSION, 'modules': modules}, manifest_file)
+            os.replace(tmp_path, self.manifest_path)
+        except OSError as e:
+            print(f"Couldn't write command manifest: {e}")
+
+
+# The registry of this plugin process
+registry = Registry(MANIFEST_PATH if config.CACHE_COMMAND_MANIFEST else None)
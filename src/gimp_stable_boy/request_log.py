@@ -0,0 +1,258 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Log of API requests and responses (Config.LOG_REQUESTS). Records are appended
+# to one gzip compressed JSON lines file per day. Images and other large strings
+# are stored separately, once, in a blob store keyed by their SHA-256, and
+# records refer to them by hash; an init image that is sent ten times is stored
+# once. Base64 images are stored decoded, and restored exactly when read back,
+# so logged requests can be replayed as they were sent.
+#
+# Callers only put records on a queue; hashing, compression and writing happen
+# in a background thread. The queue is bounded (Config.REQUEST_LOG_QUEUE_SIZE):
+# if the disk can't keep up, logging waits, rather than piling up images in
+# memory.
+#
+# Log files and blobs older than Config.REQUEST_LOG_MAX_DAYS are removed, then
+# the least recently used ones until everything fits into
+# Config.REQUEST_LOG_MAX_BYTES. Blobs count as used whenever a record refers to
+# them. Records whose blobs were removed are read back without those values.
+
+import os
+import json
+import gzip
+import time
+import queue
+import base64
+import hashlib
+import binascii
+import threading
+
+from gimp_stable_boy.config import Config as config
+from gimp_stable_boy import codec
+
+LOG_DIR = os.path.join(config.CACHE_DIR, 'log')
+
+# Strings at least this long are stored in the blob store
+BLOB_THRESHOLD = 4096
+
+# Seconds between checks of the log's size and age
+PRUNE_INTERVAL = 10 * 60
+
+
+class RequestLog:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.blob_directory = os.path.join(directory, 'blobs')
+        self._queue = queue.Queue(maxsize=config.REQUEST_LOG_QUEUE_SIZE)
+        self._pruned_at = None  # see _prune
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._responses = {}  # record id -> response being collected (writer thread only)
+
+    # Logs a request. Nothing is copied, so req_data must not be changed afterwards.
+    def log_request(self, record_id, command, uri, backend, req_data):
+        self._put(('request', {'id': record_id, 'time': time.time(), 'command': command, 'uri': uri,
+                               'backend': backend}, req_data))
+
+    # Wraps a generator of (key, value) response members and logs each member while it passes through.
+    def tee_response(self, record_id, members):
+        start = time.monotonic()
+        try:
+            for key, value in members:
+                self._put(('member', record_id, key, value))
+                yield key, value
+        except BaseException as e:
+            self._put(('response', {'id': record_id, 'time': time.time(), 'seconds': time.monotonic() - start,
+                                    'error': str(e) or type(e).__name__}))
+            raise
+        self._put(('response', {'id': record_id, 'time': time.time(), 'seconds': time.monotonic() - start}))
+
+    # Waits until everything logged so far has been written.
+    def flush(self):
+        self._queue.join()
+
+    def _put(self, item):
+        if self._thread is None:
+            with self._thread_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._write_loop, name='request-log', daemon=True)
+                    self._thread.start()
+        self._queue.put(item)
+
+    # Writes everything that's queued as one gzip member, then waits for more.
+    def _write_loop(self):
+        while True:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                lines = [line for line in map(self._handle, items) if line]
+                if lines:
+                    os.makedirs(self.directory, exist_ok=True)
+                    with open(self._log_path(), 'ab') as log_file:
+                        log_file.write(gzip.compress(''.join(lines).encode('utf-8')))
+            except Exception as e:
+                print(f"Couldn't write request log: {e}")
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+            if self._pruned_at is None or time.monotonic() - self._pruned_at > PRUNE_INTERVAL:
+                self._pruned_at = time.monotonic()
+                self._prune()
+
+    # Removes old log files and blobs, then the least recently used ones while there are too many bytes.
+    def _prune(self, max_bytes=None, max_days=None):
+        max_bytes = config.REQUEST_LOG_MAX_BYTES if max_bytes is None else max_bytes
+        max_days = config.REQUEST_LOG_MAX_DAYS if max_days is None else max_days
+        entries = []
+        for directory, _, names in os.walk(self.directory):
+            for name in names:
+                if not (name.endswith('.jsonl.gz') or directory.startswith(self.blob_directory)) \
+                        or name.endswith('.tmp'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        oldest_allowed = time.time() - max_days * 24 * 60 * 60
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= max_bytes and mtime >= oldest_allowed:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    # Turns a queued item into a log line, if it completes a record.
+    def _handle(self, item):
+        kind = item[0]
+        if kind == 'request':
+            _, record, req_data = item
+            record = dict(record, type='request', data=self._store(req_data))
+            return json.dumps(record, separators=(',', ':')) + '\n'
+        if kind == 'member':
+            _, record_id, key, value = item
+            response = self._responses.setdefault(record_id, {})
+            if key == 'images':
+                response.setdefault('images', []).append(self._store(value))
+            else:
+                response[key] = self._store(value)
+            return None
+        _, record = item
+        record = dict(record, type='response', data=self._responses.pop(record['id'], {}))
+        return json.dumps(record, separators=(',', ':')) + '\n'
+
+    def _log_path(self):
+        return os.path.join(self.directory, time.strftime('requests-%Y%m%d.jsonl.gz'))
+
+    # Replaces large strings in a value with references to blobs.
+    def _store(self, value):
+        if isinstance(value, dict):
+            return {key: self._store(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._store(item) for item in value]
+        if isinstance(value, codec.EncodedImage):
+            return self._write_blob(value.sha256(), value.data, {'prefix': value.prefix})
+        if isinstance(value, str) and len(value) >= BLOB_THRESHOLD:
+            return self._store_blob(value)
+        return value
+
+    def _store_blob(self, value):
+        digest = hashlib.sha256(value.encode('utf-8')).hexdigest()
+        prefix, _, payload = value.rpartition(',') if value[:64].find(',') != -1 else ('', '', value)
+        try:
+            decoded = base64.b64decode(payload, validate=True)
+            if base64.b64encode(decoded).decode('ascii') == payload:
+                return self._write_blob(digest, decoded, {'prefix': prefix + ',' if prefix else ''})
+        except (binascii.Error, ValueError):
+            pass
+        return self._write_blob(digest, value.encode('utf-8'), {'encoding': 'utf-8'})
+
+    def _write_blob(self, digest, data, ref):
+        path = self._blob_path(digest)
+        try:
+            os.utime(path)  # used again, see _prune
+        except OSError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.' + str(threading.get_ident()) + '.tmp'
+            with open(tmp_path, 'wb') as blob_file:
+                blob_file.write(data)
+            os.replace(tmp_path, path)
+        return dict(ref, **{'$blob': digest})
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_directory, digest[:2], digest)
+
+    # Replaces blob references in a logged value with the original strings.
+    def resolve(self, value):
+        if isinstance(value, dict):
+            if '$blob' in value:
+                try:
+                    with open(self._blob_path(value['$blob']), 'rb') as blob_file:
+                        data = blob_file.read()
+                except FileNotFoundError:
+                    return None  # removed by _prune
+                if value.get('encoding') == 'utf-8':
+                    return data.decode('utf-8')
+                return value.get('prefix', '') + base64.b64encode(data).decode('ascii')
+            return {key: self.resolve(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.resolve(item) for item in value]
+        return value
+
+    # This generator yields all logged records, oldest first. With resolve, blobs are loaded.
+    def records(self, resolve=False):
+        self.flush()
+        if not os.path.isdir(self.directory):
+            return
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.jsonl.gz'):
+                continue
+            with gzip.open(os.path.join(self.directory, name), 'rt', encoding='utf-8') as log_file:
+                for line in log_file:
+                    record = json.loads(line)
+                    if resolve:
+                        record['data'] = self.resolve(record['data'])
+                    yield record
+
+    # Returns the (request, response) records with the given id, with blobs loaded. The request's
+    # data is exactly what was sent, so it can be sent again to replay the request.
+    def load(self, record_id):
+        request = response = None
+        for record in self.records():
+            if record['id'] == record_id:
+                if record['type'] == 'request':
+                    request = record
+                else:
+                    response = record
+        if request:
+            request['data'] = self.resolve(request['data'])
+        if response:
+            response['data'] = self.resolve(response['data'])
+        return request, response
+
+
+# The log shared by all commands
+log = RequestLog(LOG_DIR)
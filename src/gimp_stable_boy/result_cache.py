@@ -0,0 +1,166 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# On-disk cache for deterministic results. A request with a fixed seed (or an
+# upscale, which has no seed at all) always produces the same pixels on a
+# backend with the same settings (checkpoint, VAE, ...), so its response is
+# stored under a hash of the canonicalized request and the backend's settings,
+# and replayed on the next identical request instead of going back to the GPU.
+#
+# Entries are stored as one JSON encoded [key, value] response member per line,
+# with each image on its own line. That way entries can be written and read back
+# one image at a time, just like responses coming from the network.
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+from gimp_stable_boy.config import Config as config
+from gimp_stable_boy import codec
+
+CACHE_FORMAT_VERSION = 1
+
+# Request fields holding (lists of) base64 images. These are replaced by their digest in the cache key.
+IMAGE_FIELDS = ['init_images', 'mask', 'image']
+
+
+def _digest(value):
+    if isinstance(value, list):
+        return [_digest(v) for v in value]
+    if isinstance(value, codec.EncodedImage):
+        return 'sha256:' + value.sha256()
+    if isinstance(value, str):
+        return 'sha256:' + hashlib.sha256(value.encode('utf-8')).hexdigest()
+    return value
+
+
+# This function tells whether a request always gives the same result: it has a fixed seed, or none at all.
+def deterministic(req_data):
+    if 'seed' in req_data:
+        try:
+            return int(req_data['seed']) != -1
+        except (TypeError, ValueError):
+            return False
+    return True
+
+
+# This function returns the cache key for a request, or None if the result isn't deterministic.
+# The results also depend on the backend's settings, which callers make part of `url`.
+def request_key(url, req_data):
+    if not deterministic(req_data):
+        return None
+    canonical = {key: _digest(value) if key in IMAGE_FIELDS else value for key, value in req_data.items()}
+    canonical['_url'] = url
+    canonical['_version'] = CACHE_FORMAT_VERSION
+    payload = json.dumps(canonical, sort_keys=True, separators=(',', ':'), ensure_ascii=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+# This function removes the least recently used files with the given suffix until the directory fits into max_bytes.
+# Files are considered used when they're modified, so readers touch files they return.
+def prune_lru(directory, suffix, max_bytes):
+    entries = []
+    for name in os.listdir(directory):
+        if not name.endswith(suffix):
+            continue
+        try:
+            stat = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            continue
+        total -= size
+
+
+class ResultCache:
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key + '.jsonl')
+
+    # Returns a generator of (key, value) response members for a cached result, or None on a cache miss.
+    def read(self, key):
+        path = self._entry_path(key)
+        try:
+            entry = open(path, 'r', encoding='utf-8')
+        except OSError:
+            return None
+        try:
+            os.utime(path)  # most recently used
+        except OSError:
+            pass
+
+        def _members():
+            with entry:
+                for line in entry:
+                    member_key, value = json.loads(line)
+                    yield member_key, value
+        return _members()
+
+    # Wraps a generator of response members and stores each member while it passes through.
+    # The entry only becomes visible once all members have been consumed.
+    def write_through(self, key, members):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=key + '.', suffix='.tmp', dir=self.directory)
+        committed = False
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as entry:
+                for member_key, value in members:
+                    entry.write(json.dumps([member_key, value]))
+                    entry.write('\n')
+                    yield member_key, value
+            os.replace(tmp_path, self._entry_path(key))
+            committed = True
+        finally:
+            if not committed:
+                os.remove(tmp_path)
+        self._evict()
+
+    # Removes an entry, e.g. one that turned out to be incomplete.
+    def discard(self, key):
+        try:
+            os.remove(self._entry_path(key))
+        except OSError:
+            pass
+
+    # Removes least recently used entries until the cache fits into max_bytes.
+    def _evict(self):
+        with self._lock:
+            prune_lru(self.directory, '.jsonl', self.max_bytes)
+
+    # Removes all entries.
+    def clear(self):
+        with self._lock:
+            if os.path.isdir(self.directory):
+                for name in os.listdir(self.directory):
+                    os.remove(os.path.join(self.directory, name))
+
+
+# The cache shared by all commands
+cache = ResultCache(os.path.join(config.CACHE_DIR, 'results'), config.RESULT_CACHE_MAX_BYTES)
@@ -0,0 +1,190 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Spreads requests across several WebUI instances. The scheduler keeps track of
+# the requests each backend is working on for us, whether it's busy with work
+# from elsewhere, and whether it's reachable at all. Every request goes to the
+# least loaded healthy backend. Backends that fail are skipped for a while and
+# then retried.
+
+import json
+import threading
+from time import monotonic
+from contextlib import contextmanager
+from urllib.parse import urljoin
+
+from gimp_stable_boy import http_pool
+
+PROBE_URI = 'sdapi/v1/progress?skip_current_image=true'
+PROBE_INTERVAL = 5  # seconds between load/health probes
+PROBE_TIMEOUT = 2
+MAX_BACKOFF = 60  # seconds an unhealthy backend is skipped at most
+
+
+class Backend:
+
+    def __init__(self, url):
+        self.url = url if url.endswith('/') else url + '/'
+        self.in_flight = 0  # requests we sent that haven't finished yet
+        self.busy = False  # working on requests from other clients
+        self.failures = 0
+        self.retry_at = 0.0
+        self.last_response_at = 0.0  # when the latest response to one of our requests arrived
+
+    @property
+    def healthy(self):
+        return self.failures == 0 or monotonic() >= self.retry_at
+
+    @property
+    def load(self):
+        # While our own requests are running, the backend is busy because of them
+        return self.in_flight + (1 if self.busy and not self.in_flight else 0)
+
+    def mark_failed(self):
+        self.failures += 1
+        self.retry_at = monotonic() + min(MAX_BACKOFF, 2 ** self.failures)
+
+    def mark_ok(self):
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def __repr__(self):
+        return f"Backend({self.url!r}, load={self.load}, failures={self.failures})"
+
+
+class Scheduler:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._backends = []
+        self._last_probe = 0.0
+
+    # Sets the backends to schedule requests on. Known backends keep their statistics.
+    def set_backends(self, urls):
+        with self._lock:
+            known = {backend.url: backend for backend in self._backends}
+            backends = []
+            for url in urls:
+                backend = known.get(url if url.endswith('/') else url + '/') or Backend(url)
+                if backend not in backends:
+                    backends.append(backend)
+            self._backends = backends
+
+    @property
+    def backends(self):
+        return list(self._backends)
+
+    # Identifies the set of backends, e.g. for cache keys that should be valid across all of them.
+    @property
+    def scope(self):
+        return ' '.join(sorted(backend.url for backend in self._backends))
+
+    # Returns the least loaded healthy backend and counts a request against it.
+    # Backends that failed recently are only used if all of them did.
+    # If cost(backend) returns the expected duration of the request on every backend, the backend
+    # expected to finish first is picked instead, so faster backends get more work.
+    # A preferred backend (e.g. one that has the request's checkpoint loaded already) is used while it's healthy.
+    # Backends are probed in the background every PROBE_INTERVAL; requests never wait for probes. A single
+    # backend is probed too: whether it's busy with other clients' work tells which request durations
+    # the latency model can learn from.
+    def acquire(self, exclude=(), cost=None, prefer=None):
+        with self._lock:
+            if monotonic() - self._last_probe > PROBE_INTERVAL:
+                self._last_probe = monotonic()
+                idle = [b for b in self._backends if not b.in_flight]
+                threading.Thread(target=self.probe, args=(idle,), name='probe', daemon=True).start()
+            candidates = [b for b in self._backends if b not in exclude] or list(self._backends)
+            if not candidates:
+                raise Exception('No backends configured')
+            healthy = [b for b in candidates if b.healthy]
+            costs = {b: cost(b) for b in healthy} if cost and len(healthy) > 1 and prefer not in healthy else {}
+            if prefer in healthy:
+                backend = prefer
+            elif costs and None not in costs.values():
+                backend = min(healthy, key=lambda b: ((b.load + 1) * costs[b], b.failures))
+            elif healthy:
+                backend = min(healthy, key=lambda b: (b.load, b.failures))
+            else:
+                backend = min(candidates, key=lambda b: (b.load, b.retry_at))
+            backend.in_flight += 1
+            return backend
+
+    def release(self, backend, ok=True):
+        with self._lock:
+            backend.in_flight -= 1
+            if ok:
+                backend.mark_ok()
+            else:
+                backend.mark_failed()
+
+    # Takes note of the response to a request that was sent to a backend at sent_at, when its headers
+    # arrive (WebUI only answers once it's done), and returns (when the backend started working on the
+    # request, now). WebUI works on one request at a time, in order: a request that was queued behind
+    # others started when the response before it arrived.
+    def response_arrived(self, backend, sent_at):
+        now = monotonic()
+        with self._lock:
+            started_at = max(sent_at, backend.last_response_at)
+            backend.last_response_at = now
+        return started_at, now
+
+    # Context manager for a request: yields the backend to use and releases it afterwards.
+    # Connection problems mark the backend as failed; HTTP errors, timeouts and aborted requests don't.
+    @contextmanager
+    def dispatch(self, exclude=(), cost=None, prefer=None):
+        backend = self.acquire(exclude, cost, prefer)
+        ok = True
+        try:
+            yield backend
+        except OSError as e:
+            ok = isinstance(e, (TimeoutError, http_pool.RequestAborted))
+            raise
+        finally:
+            self.release(backend, ok)
+
+    # Checks all backends concurrently for reachability and whether they're busy, and waits for the results.
+    # The job a backend is working on may be one of our requests, so only those in idle (default: the
+    # backends none of our requests were sent to) can be found busy with work from other clients.
+    def probe(self, idle=None):
+        with self._lock:
+            self._last_probe = monotonic()
+            backends = list(self._backends)
+            idle = [b for b in backends if not b.in_flight] if idle is None else idle
+        threads = [threading.Thread(target=self._probe_backend, args=(backend, backend in idle), daemon=True)
+                   for backend in backends]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(PROBE_TIMEOUT + 1)
+
+    def _probe_backend(self, backend, idle):
+        try:
+            with http_pool.pool.request('GET', urljoin(backend.url, PROBE_URI), timeout=PROBE_TIMEOUT) as resp:
+                progress = json.loads(resp.read())
+        except Exception:
+            with self._lock:
+                if backend.healthy:
+                    backend.mark_failed()
+            return
+        state = progress.get('state') or {}
+        with self._lock:
+            if idle:
+                backend.busy = bool(progress.get('progress')) or bool(state.get('job'))
+            backend.mark_ok()
+
+
+# The scheduler shared by all commands
+scheduler = Scheduler()
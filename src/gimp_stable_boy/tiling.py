@@ -0,0 +1,64 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Splitting regions into overlapping tiles, e.g. for upscaling images that are
+# too large to process in one go. Tiles are numbered in raster order. When
+# stitching, later tiles go on top of earlier ones and fade in over the part
+# they share with the tiles to their left and above, which hides the seams.
+
+from collections import namedtuple
+
+# x, y, width and height are relative to the region. fade_left and fade_top are the
+# number of pixels shared with the tiles to the left and above.
+Tile = namedtuple('Tile', 'index x y width height fade_left fade_top')
+
+
+def _positions(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    step = max(1, tile_size - overlap)
+    positions = list(range(0, length - tile_size + 1, step))
+    if positions[-1] + tile_size < length:
+        positions.append(length - tile_size)  # last tile is aligned with the end
+    return positions
+
+
+# This function splits a width x height region into tiles of at most tile_size x tile_size pixels,
+# with neighboring tiles overlapping by at least `overlap` pixels.
+def plan_tiles(width, height, tile_size, overlap):
+    overlap = min(overlap, tile_size // 2)
+    xs = _positions(width, tile_size, overlap)
+    ys = _positions(height, tile_size, overlap)
+    tile_w, tile_h = min(tile_size, width), min(tile_size, height)
+    tiles = []
+    for row, y in enumerate(ys):
+        for col, x in enumerate(xs):
+            fade_left = xs[col - 1] + tile_w - x if col > 0 else 0
+            fade_top = ys[row - 1] + tile_h - y if row > 0 else 0
+            tiles.append(Tile(len(tiles), x, y, tile_w, tile_h, fade_left, fade_top))
+    return tiles
+
+
+# This function returns the contents of a tile's layer mask as 8-bit gray pixels: transparent at
+# the left and top edges, ramping up linearly to opaque over fade_left and fade_top pixels.
+def feather_mask(width, height, fade_left, fade_top):
+    ramp_x = bytes(min(255, (x + 1) * 255 // (fade_left + 1)) if x < fade_left else 255 for x in range(width))
+    rows = []
+    for y in range(min(fade_top, height)):
+        row_alpha = (y + 1) * 255 // (fade_top + 1)
+        rows.append(bytes(min(a, row_alpha) for a in ramp_x))
+    rows.append(ramp_x * (height - len(rows)))
+    return b''.join(rows)
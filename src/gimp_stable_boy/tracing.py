@@ -0,0 +1,119 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Records how long each phase of a command takes (encoding, sending,
+# receiving, decoding, creating layers, ...) and exports the spans in the Chrome
+# trace event format, which can be opened in chrome://tracing or Perfetto.
+#
+# Tracing is enabled with Config.TRACE. When it's off, `traced` returns functions
+# unchanged and `span` returns a shared object that does nothing.
+
+import os
+import json
+import time
+import threading
+from functools import wraps
+
+from gimp_stable_boy.config import Config as config
+
+TRACE_DIR = os.path.join(config.CACHE_DIR, 'traces')
+
+_events = []
+_events_lock = threading.Lock()
+_thread_names = {}
+
+
+class _Span:
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    # Adds arguments to the span, e.g. the number of bytes processed.
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        thread = threading.current_thread()
+        event = {'name': self.name, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+                 'ts': self.start * 1e6, 'dur': (end - self.start) * 1e6, 'args': self.args}
+        with _events_lock:
+            _events.append(event)
+            _thread_names.setdefault(thread.ident, thread.name)
+        return False
+
+
+class _NoSpan:
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+# Returns a context manager that records a span. Use `with span('name') as s: ... s.set(bytes_out=n)`.
+def span(name, **args):
+    if not config.TRACE:
+        return _NO_SPAN
+    return _Span(name, args)
+
+
+# Decorator recording a span for each call of a function.
+def traced(name):
+    def decorator(func):
+        if not config.TRACE:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# This function writes the recorded spans as a Chrome trace file and clears them. Returns the file path,
+# or None if nothing was recorded.
+def export(path=None):
+    with _events_lock:
+        events = list(_events)
+        names = dict(_thread_names)
+        _events.clear()
+    if not events:
+        return None
+    pid = os.getpid()
+    metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                for tid, name in names.items()]
+    if path is None:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        path = os.path.join(TRACE_DIR, time.strftime('trace_%Y%m%d_%H%M%S_') + str(pid) + '.json')
+    with open(path, 'w', encoding='utf-8') as trace_file:
+        json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, trace_file)
+    return path
@@ -0,0 +1,257 @@
+# Stable Boy
+# Copyright (C) 2022-2023 Torben Giesselmann
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# X/Y plots on the client side. Instead of having WebUI's X/Y plot script
+# generate the whole grid in one request, the X and Y values are expanded into
+# one request per cell here, in the same way the script does it (value lists,
+# ranges like "1-5" or "10-30 (+5)" or "0.1-0.9 [5]", Prompt S/R, ...). The
+# cells can then be generated concurrently, on several backends, and each one
+# is added as soon as it's done. The grid image is assembled in GIMP.
+
+import re
+import random
+from itertools import permutations
+from collections import namedtuple
+
+from gimp_stable_boy import constants
+
+# One cell of the plot: column, row, the values' labels, and the request that generates it
+Cell = namedtuple('Cell', 'index col row x_label y_label req_data')
+
+# Sizes for drawing the grid, in pixels: margins for the legend (left, top) and its font size
+GridLayout = namedtuple('GridLayout', 'width height left top font_size')
+
+_RANGE = re.compile(r'\s*([+-]?\s*\d+)\s*-\s*([+-]?\s*\d+)(?:\s*\(([+-]\d+)\s*\))?\s*$')
+_RANGE_FLOAT = re.compile(r'\s*([+-]?\s*\d+(?:\.\d*)?)\s*-\s*([+-]?\s*\d+(?:\.\d*)?)(?:\s*\(([+-]\d+(?:\.\d*)?)\s*\))?\s*$')
+_RANGE_COUNT = re.compile(r'\s*([+-]?\s*\d+)\s*-\s*([+-]?\s*\d+)(?:\s*\[(\d+)\s*\])?\s*$')
+_RANGE_COUNT_FLOAT = re.compile(r'\s*([+-]?\s*\d+(?:\.\d*)?)\s*-\s*([+-]?\s*\d+(?:\.\d*)?)(?:\s*\[(\d+(?:\.\d*)?)\s*\])?\s*$')
+
+# Largest seed WebUI picks for random seeds
+_MAX_SEED = 4294967294
+
+
+def _split(values):
+    return [value.strip() for value in re.split(r'\s*,\s*', values or '') if value.strip()]
+
+
+# This function expands ranges of integers: "1-5" -> 1, 2, 3, 4, 5; "1-9 (+3)" -> 1, 4, 7; "1-9 [3]" -> 1, 5, 9.
+def _int_values(values):
+    result = []
+    for value in _split(values):
+        match, count_match = _RANGE.match(value), _RANGE_COUNT.match(value)
+        if match:
+            start, end = int(match.group(1).replace(' ', '')), int(match.group(2).replace(' ', ''))
+            step = int(match.group(3)) if match.group(3) is not None else 1
+            result.extend(range(start, end + (1 if step > 0 else -1), step))
+        elif count_match:
+            start, end = int(count_match.group(1).replace(' ', '')), int(count_match.group(2).replace(' ', ''))
+            count = int(count_match.group(3))
+            result.extend(int(round(start + (end - start) * i / max(1, count - 1))) for i in range(count))
+        else:
+            result.append(int(value))
+    return result
+
+
+# This function expands ranges of numbers: "0.25-1 (+0.25)" -> 0.25, 0.5, 0.75, 1.0; "0-1 [3]" -> 0.0, 0.5, 1.0;
+# "5-7" -> 5.0, 6.0, 7.0 (a step of 1, like the script).
+def _float_values(values):
+    result = []
+    for value in _split(values):
+        match, count_match = _RANGE_FLOAT.match(value), _RANGE_COUNT_FLOAT.match(value)
+        if match:
+            start, end = float(match.group(1).replace(' ', '')), float(match.group(2).replace(' ', ''))
+            step = float(match.group(3)) if match.group(3) is not None else 1.0
+            count = int((end - start) / step + 1e-9) + 1
+            result.extend(round(start + step * i, 8) for i in range(max(0, count)))
+        elif count_match:
+            start, end = float(count_match.group(1).replace(' ', '')), float(count_match.group(2).replace(' ', ''))
+            count = int(float(count_match.group(3)))
+            result.extend(round(start + (end - start) * i / max(1, count - 1), 8) for i in range(count))
+        else:
+            result.append(float(value))
+    return result
+
+
+def _str_values(values):
+    return _split(values)
+
+
+# "Prompt order" plots every order of the given terms
+def _order_values(values):
+    return [list(order) for order in permutations(_split(values))]
+
+
+# The functions below set an axis value in a request (a copy that may be changed). `values` are all
+# values of the axis.
+
+def _setter(key):
+    def apply(req_data, value, values):
+        req_data[key] = value
+    return apply
+
+
+def _override(key):
+    def apply(req_data, value, values):
+        req_data['override_settings'] = dict(req_data.get('override_settings') or {}, **{key: value})
+    return apply
+
+
+def _nothing(req_data, value, values):
+    pass
+
+
+# Prompt S/R replaces the first value with each of the values, in the prompt and the negative prompt
+def _prompt_sr(req_data, value, values):
+    for key in ('prompt', 'negative_prompt'):
+        if req_data.get(key):
+            req_data[key] = req_data[key].replace(values[0], value)
+
+
+# Prompt order puts the terms into the prompt in the order given, at the positions where the terms are now
+def _prompt_order(req_data, order, values):
+    prompt = req_data.get('prompt') or ''
+    parts = []
+    for _, term in sorted((prompt.find(term), term) for term in order):
+        position = prompt.find(term)
+        parts.append(prompt[:position])
+        prompt = prompt[position + len(term):]
+    req_data['prompt'] = ''.join(part + term for part, term in zip(parts, order)) + prompt
+
+
+def _sampler(req_data, value, values):
+    names = {name.lower(): name for name in constants.SAMPLERS}
+    req_data['sampler_index'] = names.get(value.lower(), value)
+
+
+# Axis name (constants.SCRIPT_XY_PLOT_AXIS_OPTIONS) -> (function parsing the values, function applying a value)
+AXES = {
+    'Nothing': (lambda values: [None], _nothing),
+    'Seed': (_int_values, _setter('seed')),
+    'Var. seed': (_int_values, _setter('subseed')),
+    'Var. strength': (_float_values, _setter('subseed_strength')),
+    'Steps': (_int_values, _setter('steps')),
+    'CFG Scale': (_float_values, _setter('cfg_scale')),
+    'Prompt S/R': (_str_values, _prompt_sr),
+    'Prompt order': (_order_values, _prompt_order),
+    'Sampler': (_str_values, _sampler),
+    'Checkpoint name': (_str_values, _override('sd_model_checkpoint')),
+    'Hypernetwork': (_str_values, _override('sd_hypernetwork')),
+    'Hypernet str.': (_float_values, _override('sd_hypernetwork_strength')),
+    'Sigma Churn': (_float_values, _setter('s_churn')),
+    'Sigma min': (_float_values, _setter('s_tmin')),
+    'Sigma max': (_float_values, _setter('s_tmax')),
+    'Sigma noise': (_float_values, _setter('s_noise')),
+    'Eta': (_float_values, _setter('eta')),
+    'Clip skip': (_int_values, _override('CLIP_stop_at_last_layers')),
+    'Denoising': (_float_values, _setter('denoising_strength')),
+    'Cond. Image Mask Weight': (_float_values, _override('inpainting_mask_weight')),
+}
+
+
+# This function returns the values of an axis. Raises an exception for values that can't be parsed.
+def axis_values(axis, values):
+    parse, _ = AXES[axis]
+    try:
+        parsed = parse(values)
+    except ValueError as e:
+        raise Exception(f"Invalid values for {axis}: {values} ({e})")
+    if not parsed:
+        raise Exception(f"No values for {axis}")
+    return parsed
+
+
+# This function raises an exception if the prompt lacks terms an axis replaces or reorders: the
+# first Prompt S/R value (in the prompt or the negative prompt), or any Prompt order term. WebUI's
+# script stops with an error, too; otherwise all cells would get the same prompt, or a mangled one.
+def _check_terms(axis, values, req_data):
+    prompt, negative_prompt = req_data.get('prompt') or '', req_data.get('negative_prompt') or ''
+    if axis == 'Prompt S/R' and values[0] not in prompt and values[0] not in negative_prompt:
+        raise Exception(f"Prompt S/R: \"{values[0]}\" not found in the prompt or the negative prompt")
+    if axis == 'Prompt order':
+        missing = [term for term in values[0] if term not in prompt]
+        if missing:
+            raise Exception('Prompt order: ' + ', '.join(f'"{term}"' for term in missing) + ' not found in the prompt')
+
+
+def _label(axis, value):
+    if axis == 'Nothing':
+        return ''
+    return axis + ': ' + (', '.join(value) if isinstance(value, list) else str(value))
+
+
+# This function expands an X/Y plot into one request per cell, row by row. Returns the X labels,
+# the Y labels and the cells. Raises an exception for values that can't be parsed or applied. Unless no_fixed_seeds is set, a random seed (-1) is replaced by one
+# random seed for all cells, so that the cells only differ in the plotted values.
+def plan_cells(req_data, x_axis, x_values, y_axis, y_values, no_fixed_seeds=False):
+    xs, ys = axis_values(x_axis, x_values), axis_values(y_axis, y_values)
+    _check_terms(x_axis, xs, req_data)
+    _check_terms(y_axis, ys, req_data)
+    base = dict(req_data)
+    if not no_fixed_seeds and str(base.get('seed', -1)).strip() in ('', '-1'):
+        base['seed'] = random.randint(0, _MAX_SEED)
+    cells = []
+    for row, y in enumerate(ys):
+        for col, x in enumerate(xs):
+            cell_data = dict(base)
+            AXES[x_axis][1](cell_data, x, xs)
+            AXES[y_axis][1](cell_data, y, ys)
+            cells.append(Cell(len(cells), col, row, _label(x_axis, x), _label(y_axis, y), cell_data))
+    return [_label(x_axis, x) for x in xs], [_label(y_axis, y) for y in ys], cells
+
+
+# This function returns the model a checkpoint value stands for, the way WebUI's X/Y plot finds it: the model
+# of that name, else the one with the shortest name containing the value (ignoring case, and the value's
+# hash in brackets). The value is returned as is if no model matches.
+def closest_checkpoint(value, names):
+    if value in names:
+        return value
+    for search in (value.lower(), re.sub(r'\s*\[[0-9a-f]{8,10}\]', '', value).lower()):
+        matches = [name for name in names if search in name.lower()]
+        if matches:
+            return min(matches, key=len)
+    return value
+
+
+# This function replaces the checkpoints of the cells with the models they stand for (see closest_checkpoint).
+def resolve_checkpoints(cells, names):
+    for cell in cells:
+        override_settings = cell.req_data.get('override_settings') or {}
+        if override_settings.get('sd_model_checkpoint'):
+            checkpoint = closest_checkpoint(override_settings['sd_model_checkpoint'], names)
+            cell.req_data['override_settings'] = dict(override_settings, sd_model_checkpoint=checkpoint)
+
+
+# This function groups the cells by their checkpoint, keeping their order. WebUI loads a request's checkpoint,
+# and by default the previous one again when it's done; in each group, only the last cell has it restored, so
+# a group sent one cell after the other to one backend loads its checkpoint once.
+def checkpoint_groups(cells):
+    groups = {}
+    for cell in cells:
+        checkpoint = (cell.req_data.get('override_settings') or {}).get('sd_model_checkpoint')
+        groups.setdefault(checkpoint, []).append(cell)
+    for group in groups.values():
+        for cell in group[:-1]:
+            cell.req_data['override_settings_restore_afterwards'] = False
+    return list(groups.values())
+
+
+# This function lays out a grid of cols x rows cells. With a legend, there's room for the X labels
+# above the grid and for the Y labels to its left, like in WebUI's grids.
+def grid_layout(cell_width, cell_height, cols, rows, draw_legend=True, x_labels=(), y_labels=()):
+    font_size = max(12, (cell_width + cell_height) // 25)
+    left = cell_width * 3 // 4 if draw_legend and any(y_labels) else 0
+    top = font_size * 2 if draw_legend and any(x_labels) else 0
+    return GridLayout(left + cols * cell_width, top + rows * cell_height, left, top, font_size)
@@ -0,0 +1,65 @@
+# Shared setup for the tests. Like the benchmarks, the tests run outside of
+# GIMP: the plugin package is registered without its GIMP-only __init__ (see
+# benchmarks/_common.py) and the GIMP bindings are stubbed out (see
+# benchmarks/_gimp_stubs.py). Caches go to a temporary directory, and the
+# result and region caches are off unless a test turns them on.
+#
+# Import this module before any of the plugin's modules.
+
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import _common
+import _gimp_stubs
+
+_gimp_stubs.install_gi()
+
+from gimp_stable_boy.config import Config
+Config.CACHE_DIR = tempfile.mkdtemp(prefix='sb_test_')  # before any module derives paths from it
+Config.CACHE_RESULTS = Config.CACHE_ENCODED_REGIONS = False
+
+import gimp_stable_boy as sb
+from gimp_stable_boy import constants, config, gimp_funcs
+sb.constants, sb.config, sb.gimp = constants, config, gimp_funcs
+
+from fake_a1111 import FakeA1111
+
+# Width and height of the stubbed image
+SIZE = 64
+
+COMMON = {'prompt': 'a lighthouse', 'negative_prompt': '', 'seed': '-1', 'steps': 4, 'sampler_index': 0,
+          'restore_faces': False, 'cfg_scale': 7.5, 'img_target': 0, 'live_preview': False}
+INPAINTING = dict(COMMON, denoising_strength=75.0, autofit_inpainting=True, mask_blur=4, inpainting_fill=1,
+                  inpaint_full_res=True, inpaint_full_res_padding=0, apply_inpainting_mask=True,
+                  inpaint_regions_separately=False)
+
+
+# A test case with a fake WebUI server (fake_a1111.py) as the only backend, and gimp_funcs stubbed out
+# for the duration of each test. server_options are passed on to FakeA1111.
+class ServerTestCase(unittest.TestCase):
+
+    server_options = {}
+
+    def setUp(self):
+        self.server = FakeA1111(**dict({'latency': 0.01, 'per_step': 0.0}, **self.server_options)).start()
+        self.original = dict(vars(gimp_funcs))
+        self.sink = _gimp_stubs.ResultSink()
+        _gimp_stubs.install_gimp_funcs(gimp_funcs, self.server.url, SIZE, SIZE, self.sink)
+
+    def tearDown(self):
+        for name, value in self.original.items():
+            setattr(gimp_funcs, name, value)
+        self.server.stop()
+
+    # Runs a command like StableBoyCommand.run does and returns it. The plugin's console output is discarded.
+    def run_command(self, cmd_cls, **properties):
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            command = cmd_cls(_gimp_stubs.Stub('image'), _gimp_stubs.ProcedureConfig(**properties))
+            command.start()
+            command.wait()
+        return command
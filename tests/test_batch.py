@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# Tests for the batch command against the fake WebUI server: all jobs of a
+# manifest run, a few at a time, and save their results; a second run skips
+# the jobs that are done. The main thread sleeps until a job has a task for it
+# or has finished.
+#
+# Usage: python -m unittest discover tests
+
+import os
+import json
+import tempfile
+import threading
+import unittest
+
+from _support import ServerTestCase, COMMON, _gimp_stubs, gimp_funcs
+from gimp_stable_boy import batch
+
+JOBS = [{'command': 'txt2img', 'prompt': 'a lighthouse', 'width': 64, 'height': 64, 'num_images': 2},
+        {'command': 'txt2img', 'id': 'boats', 'prompt': 'boats', 'width': 64, 'height': 64},
+        {'command': 'txt2img', 'prompt': 'a harbor', 'width': 64, 'height': 64, 'sampler_index': 'DDIM'}]
+
+
+# Stands in for CancelDialog, see test_cancel.py
+class FakeDialog:
+
+    def __init__(self):
+        self.sleeps = 0
+        self.wake_ups = 0
+        self.woken_up = threading.Event()
+
+    def sleep(self, timeout=None):
+        self.sleeps += 1
+        assert timeout is None
+        assert self.woken_up.wait(5), 'nobody woke the dialog up'
+        self.woken_up.clear()
+
+    def wake_up(self):
+        self.wake_ups += 1
+        self.woken_up.set()
+
+    def update(self, fraction, text):
+        pass
+
+    def process_events(self):
+        pass
+
+
+class BatchTest(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp(prefix='sb_test_')
+        self.manifest = os.path.join(self.directory, 'jobs.jsonl')
+        with open(self.manifest, 'w', encoding='utf-8') as manifest_file:
+            manifest_file.write(''.join(json.dumps(job) + '\n' for job in JOBS))
+        self.output_dir = os.path.join(self.directory, 'out')
+        for name in ('new_image', 'procedure_config'):
+            self.addCleanup(setattr, gimp_funcs, name, getattr(gimp_funcs, name))
+        gimp_funcs.new_image = lambda width, height: _gimp_stubs.Stub('image')
+        gimp_funcs.procedure_config = lambda proc_name: _gimp_stubs.ProcedureConfig(**dict(COMMON, num_images=1))
+
+    def run_batch(self, dialog=None):
+        from gimp_stable_boy.commands.batch import BatchCommand
+        command = BatchCommand(_gimp_stubs.ProcedureConfig(manifest=self.manifest, output_dir=self.output_dir,
+                                                           max_jobs=2))
+        command.run_jobs(dialog)
+        return command
+
+    def test_jobs_run_once(self):
+        command = self.run_batch()
+        self.assertEqual((command.done, command.failed, command.skipped), (3, 0, 0))
+        self.assertEqual(sorted(os.listdir(self.output_dir)),
+                         sorted(['00001-txt2img', 'boats', '00003-txt2img', batch.PROGRESS_FILE]))
+        self.assertEqual(len(os.listdir(os.path.join(self.output_dir, '00001-txt2img'))), 2)
+        self.assertEqual(self.server.requests, 3)
+        command = self.run_batch()
+        self.assertEqual((command.done, command.failed, command.skipped), (0, 0, 3))
+        self.assertEqual(self.server.requests, 3)
+
+    def test_dialog_sleeps_until_woken_up(self):
+        dialog = FakeDialog()
+        command = self.run_batch(dialog)
+        self.assertEqual(command.done, 3)
+        self.assertGreaterEqual(dialog.wake_ups, 3)  # at least when each job finished
+        self.assertLessEqual(dialog.sleeps, dialog.wake_ups)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Tests for cancelling commands against the fake WebUI server: a command's own
+# running request is interrupted once and its images are still inserted, while
+# a request queued behind another client's job only has its connection closed,
+# so that job runs to the end. While waiting with the dialog, the main thread
+# only wakes up for progress updates and new tasks.
+#
+# Usage: python -m unittest discover tests
+
+import os
+import json
+import time
+import threading
+import unittest
+import urllib.request
+from contextlib import redirect_stdout
+
+from _support import ServerTestCase, COMMON, _gimp_stubs
+from gimp_stable_boy import progress
+from gimp_stable_boy.commands.text_to_image import Txt2ImgCommand
+
+# 0.05 s per step: 20 steps take a second
+SLOW = dict(COMMON, steps=20, num_images=1)
+
+
+# Stands in for CancelDialog: sleeps until woken up, and keeps track of how long it was asked to sleep
+class FakeDialog:
+
+    def __init__(self):
+        self.timeouts = []
+        self.wake_ups = 0
+        self._woken = threading.Event()
+
+    def sleep(self, timeout):
+        self.timeouts.append(timeout)
+        self._woken.wait(timeout)
+        self._woken.clear()
+
+    def wake_up(self):
+        self.wake_ups += 1
+        self._woken.set()
+
+    def update(self, fraction, text):
+        pass
+
+    def process_events(self):
+        pass
+
+
+class CancelTest(ServerTestCase):
+
+    server_options = {'per_step': 0.05}
+
+    # Waits until condition() is true, for at most a few seconds
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    # Starts a command, cancels it once ready() is true and waits for it to finish
+    def cancel_command(self, ready, **properties):
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            command = Txt2ImgCommand(_gimp_stubs.Stub('image'), _gimp_stubs.ProcedureConfig(**properties))
+            command.start()
+            self.wait_for(ready)
+            command.cancel()
+            command.wait()
+        return command
+
+    def test_running_request_is_interrupted(self):
+        started = time.monotonic()
+        command = self.cancel_command(lambda: self.server._current_task is not None, **SLOW)
+        self.assertEqual(command.status, 'CANCELLED')
+        self.assertEqual(self.server.interrupts, 1)
+        self.assertLess(time.monotonic() - started, 0.9)
+        self.assertEqual(self.sink.images, 1)  # what WebUI returned for the interrupted job
+
+    def test_other_clients_jobs_are_not_interrupted(self):
+        other = {}
+
+        def other_client():
+            body = json.dumps(dict(steps=30, width=64, height=64, batch_size=1)).encode('utf-8')
+            request = urllib.request.Request(self.server.url + 'sdapi/v1/txt2img', body,
+                                             {'Content-Type': 'application/json'})
+            started = time.monotonic()
+            with urllib.request.urlopen(request) as resp:
+                other['images'] = len(json.loads(resp.read())['images'])
+            other['seconds'] = time.monotonic() - started
+
+        thread = threading.Thread(target=other_client)
+        thread.start()
+        self.wait_for(lambda: self.server._job is not None)
+        started = time.monotonic()
+        command = self.cancel_command(lambda: self.server._pending_tasks, **SLOW)
+        self.assertEqual(command.status, 'CANCELLED')
+        self.assertLess(time.monotonic() - started, 1)  # didn't wait for the other job
+        thread.join()
+        self.assertEqual(self.server.interrupts, 0)
+        self.assertGreaterEqual(other['seconds'], 1.5)
+        self.assertEqual(other['images'], 1)
+        self.assertEqual(self.sink.images, 0)
+
+    def test_dialog_sleeps_until_there_is_something_to_do(self):
+        dialog = FakeDialog()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            command = Txt2ImgCommand(_gimp_stubs.Stub('image'), _gimp_stubs.ProcedureConfig(**SLOW))
+            command.start()
+            command.wait(dialog)
+        self.assertEqual(command.status, 'DONE')
+        self.assertEqual(self.sink.images, 1)
+        self.assertGreaterEqual(dialog.wake_ups, 2)  # the result, and the end of run()
+        self.assertTrue(dialog.timeouts)
+        self.assertGreaterEqual(min(dialog.timeouts), progress.MIN_INTERVAL)
+
+
+if __name__ == '__main__':
+    unittest.main()
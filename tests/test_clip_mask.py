@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# Checks that Inpainting with "Apply inpainting mask" reads the mask once per
+# command, however many results are streamed in. Runs the real command against
+# the fake WebUI server (see _support.py); only the layer operations are
+# replaced.
+#
+# Usage: python -m unittest discover tests
+
+import unittest
+
+from _support import ServerTestCase, INPAINTING, SIZE, config, gimp_funcs
+
+
+# A result layer, as far as create_layers needs one
+class FakeLayer:
+
+    def __init__(self):
+        self.masked = False
+
+    def get_width(self):
+        return SIZE
+
+    def get_height(self):
+        return SIZE
+
+    def set_name(self, name):
+        pass
+
+    def set_offsets(self, x, y):
+        pass
+
+    def add_alpha(self):
+        pass
+
+
+class ClipMaskTest(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        gimp_funcs.create_layers = self.original['create_layers']
+        self.layers = []
+        self.mask_reads = 0
+        gimp_funcs._load_layer = lambda img, image_data: self._new_layer()
+        gimp_funcs._set_layer_mask = lambda layer, pixels: setattr(layer, 'masked', True)
+        gimp_funcs.inpainting_clip_mask = self._read_mask
+
+    def _new_layer(self):
+        layer = FakeLayer()
+        self.layers.append(layer)
+        return layer
+
+    def _read_mask(self, img, x, y, width, height):
+        self.mask_reads += 1
+        return b'\xff' * (width * height)
+
+    def test_mask_is_read_once_per_streamed_batch(self):
+        from gimp_stable_boy.commands.inpainting import InpaintingCommand
+        num_images = 3 * config.Config.MAX_IMAGES_PER_REQUEST
+        command = self.run_command(InpaintingCommand, **INPAINTING, num_images=num_images)
+        self.assertEqual(command.status, 'DONE')
+        self.assertEqual(self.server.requests, 3)  # streamed in several responses
+        self.assertEqual(len(self.layers), num_images)
+        self.assertTrue(all(layer.masked for layer in self.layers))
+        self.assertEqual(self.mask_reads, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#
+# Unit tests for codec's pure-Python PNG decoder, used where GdkPixbuf isn't
+# available: every row filter and color type A1111 (or PIL) may write, checked
+# against the pixels that went in; and reading image sizes from headers.
+#
+# Usage: python -m unittest discover tests
+
+import zlib
+import base64
+import struct
+import unittest
+
+import _support  # registers the plugin package, see _support.py
+from _common import synthetic_pixels
+from gimp_stable_boy import codec
+
+# PNG color type -> channels stored
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+def _paeth(left, up, up_left):
+    p = left + up - up_left
+    pa, pb, pc = abs(p - left), abs(p - up), abs(p - up_left)
+    if pa <= pb and pa <= pc:
+        return left
+    return up if pb <= pc else up_left
+
+
+# Applies PNG row filter filter_type to a row, given the previous (unfiltered) row
+def _filter_row(filter_type, row, prev, bpp):
+    out = bytearray([filter_type])
+    for i, value in enumerate(row):
+        left = row[i - bpp] if i >= bpp else 0
+        up_left = prev[i - bpp] if i >= bpp else 0
+        predictor = [0, left, prev[i], (left + prev[i]) >> 1, _paeth(left, prev[i], up_left)][filter_type]
+        out.append((value - predictor) & 0xff)
+    return out
+
+
+# Writes a PNG the way other encoders may: with the given row filters (cycled through the rows) and
+# optional palette and transparency chunks.
+def make_png(pixels, width, height, color_type, filters=(0,), palette=None, transparency=None):
+    bpp = CHANNELS[color_type]
+    stride = width * bpp
+    raw = bytearray()
+    prev = bytes(stride)
+    for y in range(height):
+        row = pixels[y * stride:(y + 1) * stride]
+        raw += _filter_row(filters[y % len(filters)], row, prev, bpp)
+        prev = row
+    chunks = [codec._png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0))]
+    if palette is not None:
+        chunks.append(codec._png_chunk(b'PLTE', palette))
+    if transparency is not None:
+        chunks.append(codec._png_chunk(b'tRNS', transparency))
+    # Split IDAT, like encoders writing fixed-size chunks
+    data = zlib.compress(bytes(raw))
+    chunks.extend(codec._png_chunk(b'IDAT', data[i:i + 100]) for i in range(0, len(data), 100))
+    chunks.append(codec._png_chunk(b'IEND', b''))
+    return codec.PNG_SIGNATURE + b''.join(chunks)
+
+
+class DecodePngTest(unittest.TestCase):
+
+    def test_filters_and_color_types(self):
+        width, height = 13, 11
+        for color_type in (0, 2, 4, 6):
+            pixels = synthetic_pixels(width, height, CHANNELS[color_type], seed=color_type)
+            for filters in ((0,), (1,), (2,), (3,), (4,), (0, 1, 2, 3, 4)):
+                with self.subTest(color_type=color_type, filters=filters):
+                    decoded = codec._decode_png_python(make_png(pixels, width, height, color_type, filters))
+                    self.assertEqual((decoded.width, decoded.height), (width, height))
+                    if color_type in (2, 6):
+                        self.assertEqual((decoded.pixels, decoded.channels), (pixels, CHANNELS[color_type]))
+                    elif color_type == 0:
+                        self.assertEqual(decoded.channels, 3)
+                        self.assertEqual(decoded.pixels, bytes(v for v in pixels for _ in range(3)))
+                    else:
+                        self.assertEqual(decoded.channels, 4)
+                        expected = bytes(v for i in range(0, len(pixels), 2) for v in (pixels[i],) * 3 + (pixels[i + 1],))
+                        self.assertEqual(decoded.pixels, expected)
+
+    def test_palette(self):
+        palette = bytes(range(12))  # 4 colors
+        indices = bytes([0, 1, 2, 3, 3, 2])
+        decoded = codec._decode_png_python(make_png(indices, 3, 2, 3, palette=palette))
+        self.assertEqual(decoded.channels, 3)
+        self.assertEqual(decoded.pixels, b''.join(palette[i * 3:i * 3 + 3] for i in indices))
+        decoded = codec._decode_png_python(make_png(indices, 3, 2, 3, palette=palette, transparency=b'\x00\x80'))
+        self.assertEqual(decoded.channels, 4)
+        self.assertEqual(decoded.pixels[3::4], bytes([0, 0x80, 255, 255, 255, 255]))
+
+    def test_round_trip(self):
+        for channels in (1, 2, 3, 4):
+            pixels = synthetic_pixels(40, 30, channels, seed=channels)
+            with self.subTest(channels=channels):
+                decoded = codec._decode_png_python(codec.encode_png(pixels, 40, 30, channels))
+                self.assertEqual((decoded.width, decoded.height), (40, 30))
+                if channels in (3, 4):
+                    self.assertEqual(decoded.pixels, pixels)
+
+    def test_unsupported_images_raise(self):
+        png = make_png(bytes(12), 2, 2, 2)
+        with self.assertRaises(ValueError):
+            codec._decode_png_python(b'GIF89a' + png[6:])
+        sixteen_bit = png.replace(struct.pack('>IIBB', 2, 2, 8, 2), struct.pack('>IIBB', 2, 2, 16, 2))
+        with self.assertRaises(ValueError):
+            codec._decode_png_python(sixteen_bit)
+        truncated = make_png(bytes(12), 2, 2, 2).replace(codec._png_chunk(b'IDAT', zlib.compress(bytes(14))),
+                                                         codec._png_chunk(b'IDAT', zlib.compress(bytes(7))))
+        with self.assertRaises(ValueError):
+            codec._decode_png_python(truncated)
+
+
+class ImageSizeTest(unittest.TestCase):
+
+    def test_png(self):
+        png = codec.encode_png(bytes(5 * 7 * 3), 5, 7, 3)
+        self.assertEqual(codec.image_size(codec.data_url(png)), (5, 7))
+        self.assertEqual(codec.image_size(base64.b64encode(png).decode('ascii')), (5, 7))
+        self.assertEqual(codec.image_size(codec.EncodedImage(png)), (5, 7))
+
+    def test_jpeg(self):
+        # SOI, an APP0 segment, then a baseline start of frame with height 600 and width 800
+        jpeg = b'\xff\xd8' + b'\xff\xe0\x00\x06JFIF' + b'\xff\xc0\x00\x11\x08' + struct.pack('>HH', 600, 800) + bytes(12)
+        self.assertEqual(codec.image_size(base64.b64encode(jpeg).decode('ascii')), (800, 600))
+
+    def test_webp(self):
+        vp8x = b'RIFF' + bytes(4) + b'WEBP' + b'VP8X' + bytes(8) + (1023).to_bytes(3, 'little') + (767).to_bytes(3, 'little')
+        self.assertEqual(codec.image_size(base64.b64encode(vp8x).decode('ascii')), (1024, 768))
+
+    def test_other_data(self):
+        self.assertIsNone(codec.image_size(base64.b64encode(b'not an image').decode('ascii')))
+
+
+if __name__ == '__main__':
+    unittest.main()
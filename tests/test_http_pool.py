@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Unit tests for http_pool: connections are reused, a kept-alive connection the
+# server closed while it was idle is replaced transparently, and HTTP errors
+# and aborted requests raise.
+#
+# Usage: python -m unittest discover tests
+
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import _support  # registers the plugin package, see _support.py
+from gimp_stable_boy import http_pool
+
+
+# Answers every request with its path. With close_after_response, the server closes the connection after
+# answering, without saying so (no "Connection: close"), like a server whose keep-alive timeout ran out.
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    close_after_response = False
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        status = 404 if self.path == '/missing' else 200
+        payload = self.path.encode('ascii')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        self.close_connection = self.close_after_response
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), type('TestHandler', (Handler,), {}))
+        self.server.daemon_threads = True
+        self.server.connections = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.pool = http_pool.ConnectionPool(max_idle_per_backend=2, idle_timeout=60)
+
+    def tearDown(self):
+        self.pool.close_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, path, **kwargs):
+        with self.pool.request('GET', self.url + path, **kwargs) as resp:
+            return resp.read()
+
+    def test_connections_are_reused(self):
+        self.assertEqual(self.get('/a'), b'/a')
+        self.assertEqual(self.get('/b'), b'/b')
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_closed_idle_connection_is_detected(self):
+        self.server.RequestHandlerClass.close_after_response = True
+        self.assertEqual(self.get('/a'), b'/a')
+        self.assertEqual(self.get('/b'), b'/b')
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_request_is_resent_on_stale_connection(self):
+        # The health check misses that the server has closed the connection, so the request hits a dead socket
+        self.server.RequestHandlerClass.close_after_response = True
+        self.pool._is_healthy = lambda conn: True
+        discarded = []
+        self.pool._discard = lambda conn, abort: discarded.append(conn) or conn.close()
+        self.assertEqual(self.get('/a'), b'/a')
+        self.assertEqual(self.get('/b'), b'/b')
+        self.assertEqual(len(self.server.connections), 2)
+        self.assertEqual(len(discarded), 1)
+
+    def test_http_errors_raise(self):
+        with self.assertRaisesRegex(Exception, 'HTTP Error 404'):
+            self.get('/missing')
+
+    def test_aborted_requests_raise(self):
+        abort = http_pool.AbortHandle()
+        abort.abort()
+        with self.assertRaises(http_pool.RequestAborted):
+            self.get('/a', abort=abort)
+        self.assertEqual(self.server.connections, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
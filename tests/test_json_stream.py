@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# Unit tests for json_stream.iter_members: responses parsed member by member
+# come out as json.loads would parse them, wherever the reads split the data.
+# Request bodies written piece by piece (iter_json, iter_json_body) are the
+# JSON json.dumps would write, with images as data URLs, also when sent to the
+# fake WebUI server with chunked transfer encoding.
+#
+# Usage: python -m unittest discover tests
+
+import io
+import json
+import unittest
+from functools import partial
+from urllib.parse import urljoin
+
+import _support  # registers the plugin package, see _support.py
+from _common import synthetic_pixels
+from fake_a1111 import FakeA1111
+from gimp_stable_boy import json_stream, codec, http_pool
+
+RESPONSE = {
+    'images': ['iVBORw0KGgo' + 'A' * 300, 'quote " and backslash \\ inside', '', 'ünïcödé ✓'],
+    'parameters': {'prompt': 'a "cat", {braces} [brackets]', 'steps': 20, 'cfg_scale': 7.5, 'tiling': False,
+                   'nested': [[1, 2], {'a': None}], 'escaped': '\\"\\\\'},
+    'info': json.dumps({'seed': 42, 'infotexts': ['x, y']}),
+    'empty': [],
+    'number': -1.5e3,
+}
+
+
+def members(data, unpack_keys=(), read_size=json_stream.READ_SIZE):
+    return list(json_stream.iter_members(io.BytesIO(data), unpack_keys, read_size))
+
+
+class IterMembersTest(unittest.TestCase):
+
+    def test_members_match_json_loads(self):
+        data = json.dumps(RESPONSE).encode('utf-8')
+        for read_size in (1, 2, 3, 7, 64, json_stream.READ_SIZE):
+            with self.subTest(read_size=read_size):
+                self.assertEqual(dict(members(data, read_size=read_size)), RESPONSE)
+
+    def test_compact_json(self):
+        data = json.dumps(RESPONSE, separators=(',', ':')).encode('utf-8')
+        for read_size in (1, 5, 64):
+            with self.subTest(read_size=read_size):
+                self.assertEqual(dict(members(data, read_size=read_size)), RESPONSE)
+
+    def test_arrays_are_unpacked(self):
+        data = json.dumps(RESPONSE).encode('utf-8')
+        for read_size in (1, 3, 64):
+            with self.subTest(read_size=read_size):
+                parsed = members(data, ['images', 'empty'], read_size)
+                self.assertEqual([value for key, value in parsed if key == 'images'], RESPONSE['images'])
+                self.assertNotIn('empty', [key for key, _ in parsed])
+                self.assertEqual(dict(parsed)['parameters'], RESPONSE['parameters'])
+
+    def test_empty_object(self):
+        self.assertEqual(members(b' { } '), [])
+
+    def test_rest_of_stream_is_read(self):
+        stream = io.BytesIO(json.dumps({'a': 1}).encode('utf-8') + b'\n')
+        list(json_stream.iter_members(stream))
+        self.assertEqual(stream.read(), b'')
+
+    def test_truncated_data_raises(self):
+        data = json.dumps(RESPONSE).encode('utf-8')
+        for end in (1, 20, len(data) // 2, len(data) - 1):
+            with self.subTest(end=end), self.assertRaises(ValueError):
+                members(data[:end], ['images'], read_size=16)
+
+
+class IterJsonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.image = codec.EncodedImage(codec.encode_png(synthetic_pixels(40, 30, 3), 40, 30, 3))
+        self.request = dict(RESPONSE, init_images=[self.image, self.image], mask=self.image, tuple=(1, 'two'))
+        self.expected = dict(RESPONSE, init_images=[str(self.image)] * 2, mask=str(self.image), tuple=[1, 'two'])
+
+    def test_json_matches_json_dumps(self):
+        text = ''.join(json_stream.iter_json(self.request))
+        self.assertEqual(json.loads(text), self.expected)
+        self.assertEqual(text, json.dumps(self.expected))
+
+    def test_body_chunks(self):
+        for write_size in (1, 100, 4096, json_stream.WRITE_SIZE):
+            with self.subTest(write_size=write_size):
+                chunks = list(json_stream.iter_json_body(self.request, write_size))
+                self.assertEqual(json.loads(b''.join(chunks)), self.expected)
+                self.assertTrue(all(chunks))
+                # Chunks are write_size plus at most one piece, the largest of which are base64 chunks of images
+                self.assertTrue(all(write_size <= len(chunk) <= write_size + codec.BASE64_CHUNK_SIZE * 4 // 3
+                                    for chunk in chunks[:-1]))
+
+    def test_chunked_request(self):
+        server = FakeA1111().start()
+        try:
+            body = partial(json_stream.iter_json_body, {'init': self.image, 'prompt': 'ünïcödé'}, 1000)
+            with http_pool.pool.request('POST', urljoin(server.url, 'sdapi/v1/options'), body=body,
+                                        headers={'Content-Type': 'application/json'}) as resp:
+                resp.read()
+            with http_pool.pool.request('GET', urljoin(server.url, 'sdapi/v1/options')) as resp:
+                options = json.loads(resp.read())
+        finally:
+            server.stop()
+        self.assertEqual((options['init'], options['prompt']), (str(self.image), 'ünïcödé'))
+
+
+if __name__ == '__main__':
+    unittest.main()
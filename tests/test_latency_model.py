@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# Unit tests for latency_model: work units of the different requests, fits
+# recovering overhead and time per unit from observed durations, falling back
+# to less specific keys, timeouts, and the model carrying over to a new session.
+# Against the fake WebUI server: requests that waited for another client's job
+# aren't learned from, also with a single backend.
+#
+# Usage: python -m unittest discover tests
+
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+import urllib.request
+
+from _support import ServerTestCase, COMMON
+from gimp_stable_boy import latency_model, codec
+from gimp_stable_boy.scheduler import scheduler
+
+TXT2IMG = {'steps': 20, 'width': 512, 'height': 512, 'batch_size': 1, 'n_iter': 1, 'sampler_index': 'Euler a'}
+
+
+class WorkUnitsTest(unittest.TestCase):
+
+    def test_generation(self):
+        self.assertEqual(latency_model.work_units('txt2img', TXT2IMG), 20)
+        self.assertEqual(latency_model.work_units('txt2img', dict(TXT2IMG, width=1024, batch_size=2, n_iter=2)), 160)
+        img2img = dict(TXT2IMG, init_images=[], denoising_strength=0.5)
+        self.assertEqual(latency_model.work_units('img2img', img2img), 10)
+        self.assertEqual(latency_model.work_units('img2img', dict(img2img, denoising_strength=0.01)), 1)
+
+    def test_upscaling(self):
+        image = codec.EncodedImage(codec.encode_png(bytes(256 * 128 * 3), 256, 128, 3))
+        request = {'image': image, 'upscaling_resize': 4, 'extras_upscaler_2_visibility': 0}
+        self.assertEqual(latency_model.work_units('extra-single-image', request), 2)
+        request['extras_upscaler_2_visibility'] = 0.5
+        self.assertEqual(latency_model.work_units('extra-single-image', request), 4)
+
+
+class LatencyModelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(prefix='sb_test_'), 'latency.json')
+        self.model = latency_model.LatencyModel(self.path)
+
+    # Observes runs of 3 s overhead + 0.5 s per step
+    def _observe_runs(self, backend='http://a', sampler='Euler a'):
+        for steps in (10, 20, 30, 40, 20, 10):
+            request = dict(TXT2IMG, steps=steps, sampler_index=sampler)
+            self.model.observe(backend, 'txt2img', request, 3 + 0.5 * steps)
+
+    def test_fit_recovers_overhead_and_rate(self):
+        self._observe_runs()
+        seconds, deviation = self.model.predict('http://a', 'txt2img', dict(TXT2IMG, steps=50))
+        self.assertAlmostEqual(seconds, 28, places=6)
+        self.assertAlmostEqual(deviation, 0, places=4)
+
+    def test_not_enough_data(self):
+        self.assertIsNone(self.model.predict('http://a', 'txt2img', TXT2IMG))
+        self.model.observe('http://a', 'txt2img', TXT2IMG, 10)
+        self.assertIsNone(self.model.predict('http://a', 'txt2img', TXT2IMG))
+        self.assertIsNone(self.model.timeout('http://a', 'txt2img', TXT2IMG))
+        self.model.observe('http://a', 'txt2img', TXT2IMG, 10)
+        self.assertAlmostEqual(self.model.predict('http://a', 'txt2img', TXT2IMG)[0], 10)
+
+    def test_less_specific_keys(self):
+        self._observe_runs()
+        # Another sampler on the same backend, then another backend
+        self.assertAlmostEqual(self.model.predict('http://a', 'txt2img', dict(TXT2IMG, sampler_index='DDIM'))[0], 13)
+        self.assertAlmostEqual(self.model.predict('http://b', 'txt2img', TXT2IMG)[0], 13)
+        self.assertIsNone(self.model.predict('http://a', 'img2img', TXT2IMG))
+        self.assertIsNone(self.model.predict('http://a', 'txt2img', dict(TXT2IMG, script_name='x/y/z plot')))
+
+    def test_timeouts(self):
+        self._observe_runs()
+        self.assertEqual(self.model.timeout('http://a', 'txt2img', dict(TXT2IMG, steps=2)), latency_model.MIN_TIMEOUT)
+        self.assertAlmostEqual(self.model.timeout('http://a', 'txt2img', dict(TXT2IMG, steps=100)),
+                               latency_model.TIMEOUT_MARGIN * 53)
+
+    def test_older_runs_weigh_less(self):
+        for _ in range(10):
+            self.model.observe('http://a', 'txt2img', TXT2IMG, 10)
+        for _ in range(30):
+            self.model.observe('http://a', 'txt2img', TXT2IMG, 20)
+        self.assertGreater(self.model.predict('http://a', 'txt2img', TXT2IMG)[0], 17)
+
+    def test_model_carries_over(self):
+        self._observe_runs()
+        next_session = latency_model.LatencyModel(self.path)
+        self.assertEqual(next_session.predict('http://a', 'txt2img', TXT2IMG),
+                         self.model.predict('http://a', 'txt2img', TXT2IMG))
+        self.assertIn('http://a | txt2img | Euler a', next_session.summary())
+
+    def test_other_versions_are_ignored(self):
+        self._observe_runs()
+        with open(self.path, 'r', encoding='utf-8') as model_file:
+            model = json.load(model_file)
+        model['version'] = latency_model.MODEL_VERSION + 1
+        with open(self.path, 'w', encoding='utf-8') as model_file:
+            json.dump(model, model_file)
+        self.assertIsNone(latency_model.LatencyModel(self.path).predict('http://a', 'txt2img', TXT2IMG))
+
+    def test_reset(self):
+        self._observe_runs()
+        self.model.reset()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertIsNone(self.model.predict('http://a', 'txt2img', TXT2IMG))
+        self.assertEqual(self.model.summary(), 'The latency model has no data yet.')
+
+
+class BusyBackendTest(ServerTestCase):
+
+    server_options = {'per_step': 0.05}
+
+    def setUp(self):
+        super().setUp()
+        latency_model.model.reset()
+
+    def test_own_requests_are_learned_from(self):
+        from gimp_stable_boy.commands.text_to_image import Txt2ImgCommand
+        scheduler.set_backends([self.server.url])
+        scheduler.probe()  # idle, and not probed again while the command runs
+        self.assertEqual(self.run_command(Txt2ImgCommand, **dict(COMMON, num_images=1)).status, 'DONE')
+        self.assertIn(self.server.url, latency_model.model.summary())
+
+    def test_waits_for_other_clients_are_not_learned_from(self):
+        from gimp_stable_boy.commands.text_to_image import Txt2ImgCommand
+        body = json.dumps({'steps': 20, 'width': 64, 'height': 64}).encode('utf-8')
+        other = threading.Thread(target=lambda: urllib.request.urlopen(urllib.request.Request(
+            self.server.url + 'sdapi/v1/txt2img', body, {'Content-Type': 'application/json'})).read())
+        other.start()
+        while self.server._job is None:
+            time.sleep(0.01)
+        scheduler._last_probe = 0.0  # the command's request gets probed along with it
+        self.assertEqual(self.run_command(Txt2ImgCommand, **dict(COMMON, num_images=1)).status, 'DONE')
+        other.join()
+        self.assertNotIn(self.server.url, latency_model.model.summary())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+# Unit tests for region_cache: unchanged regions are encoded once, also across
+# processes (a new cache over the same directory), while any change to the
+# pixels, size or format encodes again. Memory and disk use stay bounded.
+#
+# Usage: python -m unittest discover tests
+
+import os
+import tempfile
+import unittest
+
+import _support  # registers the plugin package, see _support.py
+from _common import synthetic_pixels
+from gimp_stable_boy import region_cache, codec
+
+SIZE = 32
+
+
+class RegionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='sb_test_')
+        self.cache = region_cache.RegionCache(self.directory, max_bytes=10 ** 6)
+        self.encodings = 0
+        self.original_encode = codec.encode_image
+        codec.encode_image = self._count_encoding
+
+    def tearDown(self):
+        codec.encode_image = self.original_encode
+
+    def _count_encoding(self, *args):
+        self.encodings += 1
+        return self.original_encode(*args)
+
+    def test_unchanged_regions_are_encoded_once(self):
+        pixels = synthetic_pixels(SIZE, SIZE)
+        encoded = self.cache.encode(pixels, SIZE, SIZE, 4)
+        self.assertEqual(self.cache.encode(bytes(pixels), SIZE, SIZE, 4).data, encoded.data)
+        self.assertEqual(self.encodings, 1)
+        self.assertEqual(codec.decode_png(encoded.data).pixels, pixels)
+
+    def test_entries_are_kept_on_disk(self):
+        pixels = synthetic_pixels(SIZE, SIZE)
+        encoded = self.cache.encode(pixels, SIZE, SIZE, 4)
+        other_process = region_cache.RegionCache(self.directory, max_bytes=10 ** 6)
+        self.assertEqual(other_process.encode(pixels, SIZE, SIZE, 4).data, encoded.data)
+        self.assertEqual(self.encodings, 1)
+
+    def test_changes_are_encoded_again(self):
+        pixels = synthetic_pixels(SIZE, SIZE)
+        self.cache.encode(pixels, SIZE, SIZE, 4)
+        edited = bytearray(pixels)
+        edited[100] ^= 1
+        self.cache.encode(bytes(edited), SIZE, SIZE, 4)
+        self.cache.encode(pixels, SIZE * 2, SIZE // 2, 4)
+        self.cache.encode(pixels, SIZE, SIZE, 4, ('png', 9))
+        self.assertEqual(self.encodings, 4)
+
+    def test_memory_and_disk_are_bounded(self):
+        self.cache.max_entries_in_memory = 2
+        self.cache.max_bytes = 3 * len(self.cache.encode(synthetic_pixels(SIZE, SIZE, seed=0), SIZE, SIZE, 4).data)
+        for seed in range(1, 6):
+            self.cache.encode(synthetic_pixels(SIZE, SIZE, seed=seed), SIZE, SIZE, 4)
+        self.assertEqual(len(self.cache._memory), 2)
+        self.assertLessEqual(sum(os.path.getsize(os.path.join(self.directory, name))
+                                 for name in os.listdir(self.directory)), self.cache.max_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
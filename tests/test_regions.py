@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# Unit tests for regions.find_regions: the windows around the separate parts of
+# an inpainting mask are aligned, stay inside the image, don't overlap, and
+# hold every masked pixel, so that each one is inpainted exactly once. Where
+# that isn't possible, there are no windows and the mask is inpainted as a whole.
+#
+# Usage: python -m unittest discover tests
+
+import random
+import unittest
+
+import _support  # registers the plugin package, see _support.py
+from gimp_stable_boy import regions
+
+
+# Returns an 8-bit gray mask (white = not masked) of width x height pixels with the given rectangles
+# (x1, y1, x2, y2) masked
+def make_mask(width, height, rects):
+    mask = bytearray(b'\xff' * (width * height))
+    for x1, y1, x2, y2 in rects:
+        for y in range(y1, y2):
+            mask[y * width + x1:y * width + x2] = bytes(x2 - x1)
+    return bytes(mask)
+
+
+class FindRegionsTest(unittest.TestCase):
+
+    def check_windows(self, mask, width, height, windows, origin=(0, 0), bounds=None):
+        if not windows:
+            return
+        bounds = bounds or (width, height)
+        for i, window in enumerate(windows):
+            self.assertTrue(0 <= window.x and window.x + window.width <= bounds[0], window)
+            self.assertTrue(0 <= window.y and window.y + window.height <= bounds[1], window)
+            for size, limit in ((window.width, bounds[0]), (window.height, bounds[1])):
+                self.assertTrue(size % 64 == 0 or size == limit < 64, window)
+            for other in windows[i + 1:]:
+                self.assertFalse(regions._overlap(window, other), (window, other))
+        # As windows don't overlap, every masked pixel is in exactly one if they hold all of them between them
+        ox, oy = origin
+        inside = 0
+        for window in windows:
+            x1, x2 = max(0, window.x - ox), min(width, window.x + window.width - ox)
+            for y in range(max(0, window.y - oy), min(height, window.y + window.height - oy)):
+                row = mask[y * width + x1:y * width + x2]
+                inside += len(row) - row.count(255)
+        self.assertEqual(inside, len(mask) - mask.count(255))
+
+    def test_separate_regions(self):
+        mask = make_mask(1600, 1024, [(10, 10, 60, 60), (1500, 900, 1590, 1000)])
+        windows = regions.find_regions(mask, 1600, 1024)
+        self.assertEqual(len(windows), 2)
+        self.check_windows(mask, 1600, 1024, windows)
+
+    def test_close_regions_are_merged(self):
+        mask = make_mask(1024, 1024, [(100, 100, 150, 150), (400, 100, 450, 150)])
+        windows = regions.find_regions(mask, 1024, 1024)
+        self.assertEqual(len(windows), 1)
+        self.check_windows(mask, 1024, 1024, windows)
+
+    def test_regions_wider_than_an_aligned_window(self):
+        # Merged, the strokes at both edges need all 700 pixels, but aligned windows are at most 640 wide
+        mask = make_mask(700, 300, [(0, 100, 40, 150), (660, 100, 700, 150)])
+        self.assertEqual(regions.find_regions(mask, 700, 300), [])
+
+    def test_part_of_an_image(self):
+        # The mask was read from its bounds at (300, 200) in a 2000 x 1500 image
+        mask = make_mask(1200, 900, [(0, 0, 30, 30), (1150, 850, 1200, 900)])
+        windows = regions.find_regions(mask, 1200, 900, origin=(300, 200), bounds=(2000, 1500))
+        self.assertEqual(len(windows), 2)
+        self.check_windows(mask, 1200, 900, windows, (300, 200), (2000, 1500))
+
+    # Random masks either get windows as above, or none (one request for the whole area)
+    def test_random_masks(self):
+        rng = random.Random(1)
+        split = 0
+        for _ in range(40):
+            width, height = rng.randint(40, 2000), rng.randint(40, 2000)
+            rects = []
+            for _ in range(rng.randint(1, 5)):
+                x1, y1 = rng.randrange(width), rng.randrange(height)
+                rects.append((x1, y1, min(width, x1 + rng.randint(1, 120)), min(height, y1 + rng.randint(1, 120))))
+            mask = make_mask(width, height, rects)
+            with self.subTest(width=width, height=height, rects=rects):
+                windows = regions.find_regions(mask, width, height)
+                self.check_windows(mask, width, height, windows)
+                split += len(windows) > 1
+        self.assertGreater(split, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
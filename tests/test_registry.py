@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# Unit tests for registry: all commands are found, and with a manifest from an
+# earlier run, listing procedures imports no command module and running one
+# imports only the module defining it, unless a module's file has changed.
+#
+# Usage: python -m unittest discover tests
+
+import os
+import json
+import tempfile
+import unittest
+
+import _support  # registers the plugin package, see _support.py
+from gimp_stable_boy import registry
+
+PROCEDURES = {'stable-boy-txt2img', 'stable-boy-img2img', 'stable-boy-inpaint', 'stable-boy-upscale',
+              'stable-boy-xyplot', 'stable-boy-prefs', 'stable-boy-batch', 'stable-boy-latency-model'}
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manifest_path = os.path.join(tempfile.mkdtemp(prefix='sb_test_'), 'commands.json')
+        self.imported = []
+        self.original_import = registry.import_module
+        registry.import_module = self._import
+
+    def tearDown(self):
+        registry.import_module = self.original_import
+
+    def _import(self, name):
+        self.imported.append(name)
+        return self.original_import(name)
+
+    def test_all_commands_are_found(self):
+        names = registry.Registry(self.manifest_path).procedure_names()
+        self.assertEqual(set(names), PROCEDURES)
+        self.assertEqual(len(names), len(PROCEDURES))
+        self.assertTrue(os.path.exists(self.manifest_path))
+
+    def test_manifest_avoids_imports(self):
+        registry.Registry(self.manifest_path).procedure_names()
+        self.imported = []
+        next_run = registry.Registry(self.manifest_path)
+        self.assertEqual(set(next_run.procedure_names()), PROCEDURES)
+        self.assertEqual(self.imported, [])
+        cmd_cls = next_run.command_class('stable-boy-upscale')
+        self.assertEqual(cmd_cls.proc_name, 'stable-boy-upscale')
+        self.assertEqual(self.imported, ['gimp_stable_boy.commands.upscale'])
+        self.assertIsNone(next_run.command_class('no-such-procedure'))
+
+    def test_changed_modules_are_imported_again(self):
+        registry.Registry(self.manifest_path).procedure_names()
+        with open(self.manifest_path, 'r', encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+        manifest['modules']['gimp_stable_boy.commands.text_to_image']['stamp'] = [0, 0]
+        with open(self.manifest_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump(manifest, manifest_file)
+        self.imported = []
+        self.assertEqual(set(registry.Registry(self.manifest_path).procedure_names()), PROCEDURES)
+        self.assertEqual(self.imported, ['gimp_stable_boy.commands.text_to_image'])
+
+
+if __name__ == '__main__':
+    unittest.main()
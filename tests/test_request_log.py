@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# Unit tests for request_log: requests and responses read back exactly as they
+# were sent and received, images stored once however often they're logged,
+# pruning by age and size, and logging waiting for the writer once the queue
+# is full.
+#
+# Usage: python -m unittest discover tests
+
+import os
+import time
+import base64
+import tempfile
+import threading
+import unittest
+
+import _support  # registers the plugin package, see _support.py
+from _common import synthetic_pixels
+from gimp_stable_boy import request_log, codec, config
+
+SIZE = 48
+
+
+def make_image(seed=0):
+    return codec.EncodedImage(codec.encode_png(synthetic_pixels(SIZE, SIZE, 3, seed=seed), SIZE, SIZE, 3))
+
+
+class RequestLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log = request_log.RequestLog(os.path.join(tempfile.mkdtemp(prefix='sb_test_'), 'log'))
+
+    def blobs(self):
+        return [name for _, _, names in os.walk(self.log.blob_directory) for name in names]
+
+    def test_round_trip(self):
+        image = make_image()
+        mask = 'data:image/png;base64,' + base64.b64encode(os.urandom(6000)).decode('ascii')
+        request = {'prompt': 'a lighthouse', 'steps': 4, 'init_images': [image], 'mask': mask,
+                   'script_args': ['x' * 5000, 7]}
+        self.log.log_request('r1', 'stable-boy-img2img', 'sdapi/v1/img2img', 'http://a/', request)
+        members = [('images', str(make_image(1))), ('images', str(make_image(2))), ('info', '{"seed": 1}')]
+        self.assertEqual(list(self.log.tee_response('r1', iter(members))), members)
+        logged_request, logged_response = self.log.load('r1')
+        self.assertEqual(logged_request['data'], dict(request, init_images=[str(image)]))
+        self.assertEqual((logged_request['command'], logged_request['uri'], logged_request['backend']),
+                         ('stable-boy-img2img', 'sdapi/v1/img2img', 'http://a/'))
+        self.assertEqual(logged_response['data'], {'images': [members[0][1], members[1][1]], 'info': members[2][1]})
+        self.assertNotIn('error', logged_response)
+        self.assertEqual(self.log.load('no such record'), (None, None))
+
+    def test_failed_responses(self):
+        def members():
+            yield 'images', 'image 1'
+            raise ConnectionResetError('connection reset')
+        self.log.log_request('r1', 'stable-boy-txt2img', 'sdapi/v1/txt2img', 'http://a/', {'prompt': 'a cat'})
+        with self.assertRaises(ConnectionResetError):
+            list(self.log.tee_response('r1', members()))
+        _, logged_response = self.log.load('r1')
+        self.assertEqual(logged_response['error'], 'connection reset')
+        self.assertEqual(logged_response['data'], {'images': ['image 1']})
+
+    def test_images_are_stored_once(self):
+        image = make_image()
+        for record_id in ('r1', 'r2', 'r3'):
+            self.log.log_request(record_id, 'stable-boy-img2img', 'sdapi/v1/img2img', 'http://a/',
+                                 {'init_images': [image], 'mask': str(image)})
+        self.log.flush()
+        self.assertEqual(len(self.blobs()), 1)  # also as the data URL string, the image is the same blob
+        for record_id in ('r1', 'r2', 'r3'):
+            self.assertEqual(self.log.load(record_id)[0]['data'], {'init_images': [str(image)], 'mask': str(image)})
+
+    def test_pruning(self):
+        for seed in range(4):
+            self.log.log_request(f"r{seed}", 'stable-boy-img2img', 'sdapi/v1/img2img', 'http://a/',
+                                 {'init_images': [make_image(seed)]})
+        self.log.flush()
+        paths = sorted(os.path.join(self.log.blob_directory, name[:2], name) for name in self.blobs())
+        for age, path in enumerate(paths):
+            os.utime(path, (time.time() - 1000 + age,) * 2)
+        # Too old
+        os.utime(paths[0], (time.time() - 3 * 24 * 60 * 60,) * 2)
+        self.log._prune(max_bytes=10 ** 9, max_days=2)
+        self.assertEqual(len(self.blobs()), 3)
+        # Too many bytes: the least recently used go first, the log file was written last
+        log_files = [os.path.join(self.log.directory, name) for name in os.listdir(self.log.directory)
+                     if name.endswith('.jsonl.gz')]
+        self.log._prune(max_bytes=sum(os.path.getsize(path) for path in paths[2:] + log_files), max_days=2)
+        self.assertEqual(sorted(self.blobs()), sorted(os.path.basename(path) for path in paths[2:]))
+        self.assertTrue(all(os.path.exists(path) for path in log_files))
+
+    def test_removed_blobs_read_back_as_none(self):
+        image = make_image()
+        self.log.log_request('r1', 'stable-boy-img2img', 'sdapi/v1/img2img', 'http://a/',
+                             {'prompt': 'a cat', 'init_images': [image]})
+        self.log.flush()
+        self.log._prune(max_bytes=0, max_days=30)
+        self.assertEqual(self.log.load('r1')[0], None)  # the log file went too
+        self.log.log_request('r2', 'stable-boy-img2img', 'sdapi/v1/img2img', 'http://a/',
+                             {'prompt': 'a cat', 'init_images': [image]})
+        self.log.flush()
+        for name in self.blobs():
+            os.remove(os.path.join(self.log.blob_directory, name[:2], name))
+        self.assertEqual(self.log.load('r2')[0]['data'], {'prompt': 'a cat', 'init_images': [None]})
+
+    def test_logging_waits_for_the_writer(self):
+        written = threading.Event()
+        original_queue_size = config.Config.REQUEST_LOG_QUEUE_SIZE
+        config.Config.REQUEST_LOG_QUEUE_SIZE = 2
+        try:
+            self.log = request_log.RequestLog(self.log.directory)
+        finally:
+            config.Config.REQUEST_LOG_QUEUE_SIZE = original_queue_size
+        original_handle = self.log._handle
+        self.log._handle = lambda item: written.wait() and original_handle(item)
+
+        def log_requests():
+            for i in range(6):
+                self.log.log_request(f"r{i}", 'stable-boy-txt2img', 'sdapi/v1/txt2img', 'http://a/', {'steps': i})
+        thread = threading.Thread(target=log_requests, daemon=True)
+        thread.start()
+        thread.join(0.3)
+        self.assertTrue(thread.is_alive())  # the queue is full while the writer is stuck
+        self.assertLessEqual(self.log._queue.qsize(), 2)
+        written.set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([record['data'] for record in self.log.records()], [{'steps': i} for i in range(6)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Unit tests for result_cache: which requests are cached and under which key,
+# entries written while a response streams through, eviction of the least
+# recently used entries, and a command replaying a result unless the backend's
+# settings have changed since.
+#
+# Usage: python -m unittest discover tests
+
+import os
+import time
+import tempfile
+import unittest
+
+from _support import ServerTestCase, COMMON, config
+from gimp_stable_boy import result_cache, capabilities, codec
+
+TXT2IMG = dict(COMMON, seed='1234', num_images=1)
+
+
+class RequestKeyTest(unittest.TestCase):
+
+    def test_deterministic(self):
+        self.assertTrue(result_cache.deterministic({'seed': 5}))
+        self.assertTrue(result_cache.deterministic({'seed': '5'}))
+        self.assertTrue(result_cache.deterministic({'upscaling_resize': 2}))  # upscales have no seed
+        self.assertFalse(result_cache.deterministic({'seed': -1}))
+        self.assertFalse(result_cache.deterministic({'seed': '-1'}))
+        self.assertFalse(result_cache.deterministic({'seed': 'random'}))
+
+    def test_keys(self):
+        request = {'prompt': 'a cat', 'seed': 1, 'steps': 20}
+        key = result_cache.request_key('scope uri', request)
+        self.assertEqual(result_cache.request_key('scope uri', dict(reversed(list(request.items())))), key)
+        self.assertNotEqual(result_cache.request_key('scope uri', dict(request, steps=21)), key)
+        self.assertNotEqual(result_cache.request_key('other settings', request), key)
+        self.assertIsNone(result_cache.request_key('scope uri', dict(request, seed=-1)))
+
+    def test_images_are_keyed_by_content(self):
+        image = codec.EncodedImage(codec.encode_png(b'\x00\x80\xff' * 4, 2, 2, 3))
+        copy = codec.EncodedImage(codec.encode_png(b'\x00\x80\xff' * 4, 2, 2, 3))
+        other = codec.EncodedImage(codec.encode_png(b'\xff\x80\x00' * 4, 2, 2, 3))
+        key = result_cache.request_key('uri', {'seed': 1, 'init_images': [image]})
+        self.assertEqual(result_cache.request_key('uri', {'seed': 1, 'init_images': [copy]}), key)
+        self.assertNotEqual(result_cache.request_key('uri', {'seed': 1, 'init_images': [other]}), key)
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = result_cache.ResultCache(tempfile.mkdtemp(prefix='sb_test_'), max_bytes=10 ** 6)
+
+    def test_round_trip(self):
+        members = [('images', 'image 1'), ('images', 'image 2'), ('info', '{"seed": 1}')]
+        self.assertIsNone(self.cache.read('key'))
+        self.assertEqual(list(self.cache.write_through('key', iter(members))), members)
+        self.assertEqual(list(self.cache.read('key')), members)
+
+    def test_incomplete_entries_are_not_stored(self):
+        members = self.cache.write_through('key', iter([('images', 'image 1'), ('images', 'image 2')]))
+        next(members)
+        members.close()  # e.g. the connection broke after the first image
+        self.assertIsNone(self.cache.read('key'))
+        self.assertEqual(os.listdir(self.cache.directory), [])
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.cache.max_bytes = 3500  # three entries of about 1 KB
+        for i, key in enumerate(('a', 'b', 'c')):
+            list(self.cache.write_through(key, iter([('images', 'x' * 1000)])))
+            os.utime(self.cache._entry_path(key), (time.time() - 100 + i,) * 2)
+        list(self.cache.read('a'))  # now the most recently used
+        list(self.cache.write_through('d', iter([('images', 'x' * 1000)])))
+        self.assertEqual(sorted(os.listdir(self.cache.directory)), ['a.jsonl', 'c.jsonl', 'd.jsonl'])
+
+
+class CommandCacheTest(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        config.Config.CACHE_RESULTS = True
+        capabilities.options.ttl = 0  # settings are fetched for every request
+        result_cache.cache.clear()
+
+    def tearDown(self):
+        config.Config.CACHE_RESULTS = False
+        capabilities.options.ttl = config.Config.SERVER_OPTIONS_TTL
+        super().tearDown()
+
+    def test_results_are_replayed_for_the_same_settings(self):
+        from gimp_stable_boy.commands.text_to_image import Txt2ImgCommand
+        for _ in range(2):
+            self.assertEqual(self.run_command(Txt2ImgCommand, **TXT2IMG).status, 'DONE')
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(self.sink.images, 2)
+        self.server.options['sd_model_checkpoint'] = 'Fake-XL.safetensors [1111111111]'
+        self.assertEqual(self.run_command(Txt2ImgCommand, **TXT2IMG).status, 'DONE')
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(self.run_command(Txt2ImgCommand, **dict(TXT2IMG, seed='-1')).status, 'DONE')
+        self.assertEqual(self.server.requests, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# Unit tests for tiling: tiles cover the whole region, stay inside it, overlap
+# their neighbors by at least the requested amount and fade in over exactly the
+# part they share with them.
+#
+# Usage: python -m unittest discover tests
+
+import unittest
+
+import _support  # registers the plugin package, see _support.py
+from gimp_stable_boy import tiling
+
+CASES = [(512, 512, 512, 64), (300, 200, 512, 64), (1000, 700, 512, 64), (1024, 1024, 512, 0),
+         (2049, 513, 512, 96), (700, 700, 256, 200)]
+
+
+class PlanTilesTest(unittest.TestCase):
+
+    def test_tiles_cover_the_region(self):
+        for width, height, tile_size, overlap in CASES:
+            with self.subTest(width=width, height=height, tile_size=tile_size, overlap=overlap):
+                tiles = tiling.plan_tiles(width, height, tile_size, overlap)
+                self.assertEqual([tile.index for tile in tiles], list(range(len(tiles))))
+                for tile in tiles:
+                    self.assertTrue(0 <= tile.x and tile.x + tile.width <= width)
+                    self.assertTrue(0 <= tile.y and tile.y + tile.height <= height)
+                    self.assertLessEqual(max(tile.width, tile.height), tile_size)
+                # Tiles form a grid: every column meets every row, and the columns and rows cover the region
+                columns = {(tile.x, tile.width) for tile in tiles}
+                rows = {(tile.y, tile.height) for tile in tiles}
+                self.assertEqual(len(tiles), len(columns) * len(rows))
+                self.assertEqual(set().union(*(range(x, x + w) for x, w in columns)), set(range(width)))
+                self.assertEqual(set().union(*(range(y, y + h) for y, h in rows)), set(range(height)))
+
+    def test_fades_match_the_overlap(self):
+        for width, height, tile_size, overlap in CASES:
+            with self.subTest(width=width, height=height, tile_size=tile_size, overlap=overlap):
+                tiles = tiling.plan_tiles(width, height, tile_size, overlap)
+                by_position = {(tile.x, tile.y): tile for tile in tiles}
+                xs = sorted({tile.x for tile in tiles})
+                ys = sorted({tile.y for tile in tiles})
+                for tile in tiles:
+                    col, row = xs.index(tile.x), ys.index(tile.y)
+                    left = by_position.get((xs[col - 1], tile.y)) if col else None
+                    above = by_position.get((tile.x, ys[row - 1])) if row else None
+                    self.assertEqual(tile.fade_left, left.x + left.width - tile.x if left else 0)
+                    self.assertEqual(tile.fade_top, above.y + above.height - tile.y if above else 0)
+                    if left:
+                        self.assertGreaterEqual(tile.fade_left, min(overlap, tile_size // 2))
+
+    def test_small_regions_are_one_tile(self):
+        self.assertEqual(tiling.plan_tiles(300, 200, 512, 64), [tiling.Tile(0, 0, 0, 300, 200, 0, 0)])
+
+
+class FeatherMaskTest(unittest.TestCase):
+
+    def test_feather_mask(self):
+        mask = tiling.feather_mask(8, 6, 4, 2)
+        self.assertEqual(len(mask), 8 * 6)
+        rows = [mask[y * 8:(y + 1) * 8] for y in range(6)]
+        self.assertEqual(list(rows[5]), [51, 102, 153, 204, 255, 255, 255, 255])
+        self.assertEqual(rows[2:], [rows[5]] * 4)
+        self.assertEqual(list(rows[0]), [51, 85, 85, 85, 85, 85, 85, 85])
+        self.assertTrue(all(a <= b for a, b in zip(rows[0], rows[1])))
+
+    def test_no_fade_is_opaque(self):
+        self.assertEqual(tiling.feather_mask(5, 3, 0, 0), b'\xff' * 15)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+#
+# Checks that an X/Y plot with a checkpoint axis loads each checkpoint once
+# (plus once to restore WebUI's own), rather than twice per cell, and that the
+# axis values are sent as the names of the models the backend has. Runs the
+# real command against the fake WebUI server (see _support.py).
+#
+# Usage: python -m unittest discover tests
+
+import unittest
+
+from _support import ServerTestCase, INPAINTING, constants
+from gimp_stable_boy import capabilities, xy_grid
+from fake_a1111 import OPTIONS
+
+XY_PLOT = dict(INPAINTING, num_images=1, autofit_inpainting=False, apply_inpainting_mask=False, mode=0,
+               draw_legend=True, no_fixed_seeds=False, grid_only=True,
+               x_type=constants.SCRIPT_XY_PLOT_AXIS_OPTIONS.index('Checkpoint name'), x_values='xl, fake.safetensors',
+               y_type=constants.SCRIPT_XY_PLOT_AXIS_OPTIONS.index('Steps'), y_values='4, 5, 6')
+
+
+class CheckpointAxisTest(ServerTestCase):
+
+    server_options = {'load_time': 0.01}
+
+    def setUp(self):
+        super().setUp()
+        capabilities.cache.clear()
+
+    def test_closest_checkpoint(self):
+        names = ['fake', 'fake.safetensors [0000000000]', 'Fake-XL', 'Fake-XL.safetensors [1111111111]']
+        self.assertEqual(xy_grid.closest_checkpoint('fake', names), 'fake')
+        self.assertEqual(xy_grid.closest_checkpoint('xl', names), 'Fake-XL')
+        self.assertEqual(xy_grid.closest_checkpoint('fake-xl.safetensors [2222222222]', names),
+                         'Fake-XL.safetensors [1111111111]')
+        self.assertEqual(xy_grid.closest_checkpoint('missing', names), 'missing')
+
+    def test_checkpoints_are_loaded_once_per_group(self):
+        from gimp_stable_boy.commands.scripts.xy_plot import XyPlotCommand
+        command = self.run_command(XyPlotCommand, **XY_PLOT)
+        self.assertEqual(command.status, 'DONE')
+        self.assertEqual(self.server.requests, 6)
+        self.assertEqual({cell.req_data['override_settings']['sd_model_checkpoint'] for cell in command.cells},
+                         {'Fake-XL', 'fake.safetensors [0000000000]'})
+        self.assertEqual(self.server.model_loads, 2)  # Fake-XL, then the first model again
+        self.assertEqual(self.server.options['sd_model_checkpoint'], OPTIONS['sd_model_checkpoint'])
+
+
+if __name__ == '__main__':
+    unittest.main()
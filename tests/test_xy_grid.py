@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# Unit tests for xy_grid: axis values expanded like WebUI's X/Y plot script
+# does it, the values applied to the cells' requests, and prompts that lack
+# the terms Prompt S/R or Prompt order work on being rejected.
+#
+# Usage: python -m unittest discover tests
+
+import unittest
+
+import _support  # registers the plugin package, see _support.py
+from gimp_stable_boy import xy_grid
+
+REQUEST = {'prompt': 'a cat, a dog, a bird', 'negative_prompt': 'blurry', 'seed': -1, 'steps': 20}
+
+
+class AxisValuesTest(unittest.TestCase):
+
+    def test_ints(self):
+        values = {'1, 3,5': [1, 3, 5], '1-5': [1, 2, 3, 4, 5], '1-9 (+3)': [1, 4, 7], '10-1 (-4)': [10, 6, 2],
+                  '1-9 [3]': [1, 5, 9], '-3 - -1': [-3, -2, -1], '1-3, 10': [1, 2, 3, 10]}
+        for text, expected in values.items():
+            with self.subTest(text=text):
+                self.assertEqual(xy_grid.axis_values('Steps', text), expected)
+
+    def test_floats(self):
+        values = {'7.5': [7.5], '5-7': [5.0, 6.0, 7.0], '5 - 7, 9': [5.0, 6.0, 7.0, 9.0],
+                  '0.25-1 (+0.25)': [0.25, 0.5, 0.75, 1.0], '0-1 [3]': [0.0, 0.5, 1.0], '1-0 (-0.5)': [1.0, 0.5, 0.0],
+                  '0.1-0.3 (+0.1)': [0.1, 0.2, 0.3]}
+        for text, expected in values.items():
+            with self.subTest(text=text):
+                self.assertEqual(xy_grid.axis_values('CFG Scale', text), expected)
+
+    def test_strings(self):
+        self.assertEqual(xy_grid.axis_values('Prompt S/R', 'a cat, a fox ,a wolf'), ['a cat', 'a fox', 'a wolf'])
+        self.assertEqual(xy_grid.axis_values('Prompt order', 'a, b'), [['a', 'b'], ['b', 'a']])
+        self.assertEqual(len(xy_grid.axis_values('Prompt order', 'a, b, c')), 6)
+        self.assertEqual(xy_grid.axis_values('Nothing', ''), [None])
+
+    def test_invalid_values(self):
+        for axis, text in (('Steps', 'many'), ('Steps', '1.5'), ('CFG Scale', '5-'), ('Seed', ''), ('Sampler', ' , ')):
+            with self.subTest(axis=axis, text=text), self.assertRaises(Exception):
+                xy_grid.axis_values(axis, text)
+
+
+class SettersTest(unittest.TestCase):
+
+    def apply(self, axis, value, values):
+        req_data = dict(REQUEST)
+        xy_grid.AXES[axis][1](req_data, value, values)
+        return req_data
+
+    def test_request_values(self):
+        self.assertEqual(self.apply('CFG Scale', 5.0, [5.0])['cfg_scale'], 5.0)
+        self.assertEqual(self.apply('Var. seed', 3, [3])['subseed'], 3)
+        self.assertEqual(self.apply('Sampler', 'euler a', ['euler a'])['sampler_index'], 'Euler a')
+        self.assertEqual(self.apply('Sampler', 'New sampler', ['New sampler'])['sampler_index'], 'New sampler')
+        self.assertEqual(self.apply('Nothing', None, [None]), REQUEST)
+
+    def test_overrides(self):
+        req_data = dict(REQUEST, override_settings={'sd_vae': 'x.vae'})
+        xy_grid.AXES['Clip skip'][1](req_data, 2, [1, 2])
+        xy_grid.AXES['Checkpoint name'][1](req_data, 'model', ['model'])
+        self.assertEqual(req_data['override_settings'],
+                         {'sd_vae': 'x.vae', 'CLIP_stop_at_last_layers': 2, 'sd_model_checkpoint': 'model'})
+
+    def test_prompt_sr(self):
+        values = ['a dog', 'a fox']
+        self.assertEqual(self.apply('Prompt S/R', 'a fox', values)['prompt'], 'a cat, a fox, a bird')
+        self.assertEqual(self.apply('Prompt S/R', 'a dog', values)['prompt'], REQUEST['prompt'])
+        self.assertEqual(self.apply('Prompt S/R', 'sharp', ['blurry', 'sharp'])['negative_prompt'], 'sharp')
+
+    def test_prompt_order(self):
+        self.assertEqual(self.apply('Prompt order', ['a bird', 'a cat'], [])['prompt'], 'a bird, a dog, a cat')
+        self.assertEqual(self.apply('Prompt order', ['a dog', 'a cat', 'a bird'], [])['prompt'],
+                         'a dog, a cat, a bird')
+
+
+class PlanCellsTest(unittest.TestCase):
+
+    def test_cells(self):
+        x_labels, y_labels, cells = xy_grid.plan_cells(REQUEST, 'Steps', '10, 20, 30', 'CFG Scale', '5-6')
+        self.assertEqual(x_labels, ['Steps: 10', 'Steps: 20', 'Steps: 30'])
+        self.assertEqual(y_labels, ['CFG Scale: 5.0', 'CFG Scale: 6.0'])
+        self.assertEqual([(cell.col, cell.row) for cell in cells], [(0, 0), (1, 0), (2, 0), (0, 1), (1, 1), (2, 1)])
+        self.assertEqual([(cell.req_data['steps'], cell.req_data['cfg_scale']) for cell in cells],
+                         [(10, 5.0), (20, 5.0), (30, 5.0), (10, 6.0), (20, 6.0), (30, 6.0)])
+        self.assertEqual(len({cell.req_data['seed'] for cell in cells}), 1)
+        self.assertNotEqual(cells[0].req_data['seed'], -1)
+        self.assertEqual(REQUEST['seed'], -1)  # the request itself isn't changed
+        _, _, cells = xy_grid.plan_cells(REQUEST, 'Steps', '10, 20', 'Nothing', '', no_fixed_seeds=True)
+        self.assertEqual([cell.req_data['seed'] for cell in cells], [-1, -1])
+        self.assertEqual([cell.y_label for cell in cells], ['', ''])
+
+    def test_missing_prompt_terms(self):
+        with self.assertRaisesRegex(Exception, 'a wolf'):
+            xy_grid.plan_cells(REQUEST, 'Prompt S/R', 'a wolf, a fox', 'Nothing', '')
+        with self.assertRaisesRegex(Exception, 'a fish'):
+            xy_grid.plan_cells(REQUEST, 'Nothing', '', 'Prompt order', 'a cat, a fish')
+        # Terms in the negative prompt are fine for Prompt S/R
+        _, _, cells = xy_grid.plan_cells(REQUEST, 'Prompt S/R', 'blurry, sharp', 'Nothing', '')
+        self.assertEqual([cell.req_data['negative_prompt'] for cell in cells], ['blurry', 'sharp'])
+
+
+if __name__ == '__main__':
+    unittest.main()